@@ -0,0 +1,301 @@
+"""
+analysis.py - Score every move of the finished games against perfect play.
+
+Each move of a finished 3x3 game is compared with the solved value of the
+position it was played in. A move that keeps the best result the player
+could get is optimal, one that turns a win into a draw is an inaccuracy,
+and one that turns a win or a draw into a loss is a blunder. The counts
+of each player are saved in a PlayerAccuracy entity.
+
+A run is split into shards of games that are analyzed in parallel by
+tasks. A scan task pages through the finished games by key and queues one
+task per shard, with the cursors of the start and end of the shard. Each
+shard saves its counts in an AnalysisShard entity under the AnalysisRun,
+in the same transaction that marks the shard done, so a retried task is
+not counted twice. The last shard to finish queues a task that merges the
+counts of every shard into the PlayerAccuracy entities.
+"""
+
+import logging
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import bitboard
+import solver
+from models import TicTacToeGame
+
+QUEUE_NAME = 'analysis'
+SCAN_URL = '/tasks/analysis/scan'
+ANALYZE_URL = '/tasks/analysis/analyze'
+MERGE_URL = '/tasks/analysis/merge'
+
+# Games analyzed by each shard.
+SHARD_SIZE = 500
+
+# Shards queued by each scan task. A transaction can queue at most 5
+# tasks, and each scan also queues the next scan.
+SHARDS_PER_SCAN = 4
+
+# PlayerAccuracy entities written in each put_multi of a merge.
+MERGE_BATCH_SIZE = 500
+
+# Move classifications.
+OPTIMAL = 'optimal'
+INACCURACY = 'inaccuracy'
+BLUNDER = 'blunder'
+
+# Index of each count in the per player lists of an AnalysisShard.
+_MOVES, _OPTIMAL, _INACCURACIES, _BLUNDERS = range(4)
+_COUNT_INDEX = {OPTIMAL: _OPTIMAL,
+                INACCURACY: _INACCURACIES,
+                BLUNDER: _BLUNDERS}
+
+
+class AnalysisRun(ndb.Model):
+    """Progress of one analysis of the finished games."""
+    started = ndb.DateTimeProperty(required=True, auto_now_add=True)
+    cursor = ndb.StringProperty(indexed=False)
+    shards = ndb.IntegerProperty(required=True, default=0)
+    shards_done = ndb.IntegerProperty(required=True, default=0)
+    scan_done = ndb.BooleanProperty(required=True, default=False)
+    merged = ndb.BooleanProperty(required=True, default=False)
+
+
+class AnalysisShard(ndb.Model):
+    """The counts of one shard of an AnalysisRun, keyed by shard number."""
+    games = ndb.IntegerProperty(required=True, default=0)
+    # Urlsafe user key -> [moves, optimal, inaccuracies, blunders]
+    counts = ndb.JsonProperty(required=True)
+
+
+class PlayerAccuracy(ndb.Model):
+    """How often a player's moves keep the best result. Keyed by user id."""
+    player = ndb.KeyProperty(required=True, kind='User')
+    moves = ndb.IntegerProperty(required=True, default=0)
+    optimal = ndb.IntegerProperty(required=True, default=0)
+    inaccuracies = ndb.IntegerProperty(required=True, default=0)
+    blunders = ndb.IntegerProperty(required=True, default=0)
+    accuracy = ndb.ComputedProperty(
+        lambda self: float(self.optimal) / self.moves if self.moves else 0.0)
+    run_id = ndb.StringProperty(required=True)
+
+
+def _result(value):
+    """Get the result of a position value: 1 win, 0 draw, -1 loss."""
+    return cmp(value, 0)
+
+
+def classify_move(mover, other, square):
+    """
+    Classify a move against perfect play.
+
+    Args:
+        mover: The bitmask of the player making the move.
+        other: The bitmask of the other player.
+        square: The square moved into.
+    Returns:
+        OPTIMAL, INACCURACY or BLUNDER.
+    """
+    best = _result(solver.position_value(mover, other))
+    played = -_result(solver.position_value(
+        other, mover | bitboard.SQUARE_MASKS[square]))
+    if played == best:
+        return OPTIMAL
+    if played < 0:
+        return BLUNDER
+    return INACCURACY
+
+
+def analyze_game(game, counts):
+    """
+    Classify the moves of a finished game, adding them to the counts of
+    its players. Moves made by the computer, and games on boards other than
+    3x3, are not analyzed.
+
+    Args:
+        game: The finished TicTacToeGame.
+        counts: A dict of urlsafe user key to a list of the number of
+        moves, optimal moves, inaccuracies and blunders, updated in place.
+    Returns:
+        None
+    """
+    if game.shape is not bitboard.STANDARD:
+        return
+    masks = [0, 0]
+    players = (game.player1, game.player2)
+    for n, square in enumerate(game.get_moves()):
+        mover = n % 2
+        player = players[mover]
+        if player is not None:
+            classification = classify_move(masks[mover], masks[1 - mover],
+                                           square)
+            player_counts = counts.setdefault(player.urlsafe(), [0, 0, 0, 0])
+            player_counts[_MOVES] += 1
+            player_counts[_COUNT_INDEX[classification]] += 1
+        masks[mover] |= bitboard.SQUARE_MASKS[square]
+
+
+def _finished_games():
+    return TicTacToeGame.query(TicTacToeGame.game_over == True).order(
+        TicTacToeGame.key)
+
+
+def start():
+    """
+    Start analyzing every finished game.
+
+    Args:
+        None
+    Returns:
+        The id of the AnalysisRun.
+    """
+    run_id = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    AnalysisRun(id=run_id).put()
+    taskqueue.add(url=SCAN_URL, params={'run_id': run_id},
+                  queue_name=QUEUE_NAME)
+    return run_id
+
+
+def scan(run_id):
+    """
+    Find the next shards of finished games and queue a task to analyze
+    each of them.
+
+    Args:
+        run_id: The id of the AnalysisRun.
+    Returns:
+        None
+    """
+    run = AnalysisRun.get_by_id(run_id)
+    if not run or run.scan_done:
+        return
+    cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+    shards = []
+    more = True
+    while more and len(shards) < SHARDS_PER_SCAN:
+        keys, next_cursor, more = _finished_games().fetch_page(
+            SHARD_SIZE, start_cursor=cursor, keys_only=True)
+        if not keys:
+            break
+        shards.append((cursor.urlsafe() if cursor else '',
+                       next_cursor.urlsafe()))
+        cursor = next_cursor
+    next_cursor = cursor.urlsafe() if more and cursor else None
+    _checkpoint(run.key, run.cursor, next_cursor, shards)
+
+
+@ndb.transactional
+def _checkpoint(run_key, cursor, next_cursor, shards):
+    """
+    Save the cursor of the next scan and queue the tasks of the shards.
+    Nothing is done if another task has already handled the scan.
+    """
+    run = run_key.get()
+    if run.scan_done or run.cursor != cursor:
+        return
+    for start_cursor, end_cursor in shards:
+        taskqueue.add(url=ANALYZE_URL,
+                      params={'run_id': run_key.id(),
+                              'shard': run.shards,
+                              'start_cursor': start_cursor,
+                              'end_cursor': end_cursor},
+                      queue_name=QUEUE_NAME,
+                      transactional=True)
+        run.shards += 1
+    run.cursor = next_cursor
+    run.scan_done = next_cursor is None
+    if not run.scan_done:
+        taskqueue.add(url=SCAN_URL, params={'run_id': run_key.id()},
+                      queue_name=QUEUE_NAME, transactional=True)
+    elif run.shards_done == run.shards:
+        _queue_merge(run)
+    run.put()
+
+
+def analyze(run_id, shard, start_cursor, end_cursor):
+    """
+    Analyze the finished games of one shard.
+
+    Args:
+        run_id: The id of the AnalysisRun.
+        shard: The number of the shard.
+        start_cursor: The urlsafe cursor of the first game of the shard, or
+        an empty string to start from the first finished game.
+        end_cursor: The urlsafe cursor after the last game of the shard.
+    Returns:
+        None
+    """
+    start_cursor = Cursor(urlsafe=start_cursor) if start_cursor else None
+    games = _finished_games().fetch(SHARD_SIZE,
+                                    start_cursor=start_cursor,
+                                    end_cursor=Cursor(urlsafe=end_cursor))
+    counts = {}
+    for game in games:
+        analyze_game(game, counts)
+    _save_shard(ndb.Key(AnalysisRun, run_id), shard, len(games), counts)
+
+
+@ndb.transactional
+def _save_shard(run_key, shard, games, counts):
+    """
+    Save the counts of a shard and mark it done, queueing the merge if it
+    is the last shard. Nothing is done if the shard was already saved.
+    """
+    shard_key = ndb.Key(AnalysisShard, shard + 1, parent=run_key)
+    run, saved = ndb.get_multi([run_key, shard_key])
+    if run is None or saved is not None:
+        return
+    run.shards_done += 1
+    if run.scan_done and run.shards_done == run.shards:
+        _queue_merge(run)
+    ndb.put_multi([run, AnalysisShard(key=shard_key, games=games,
+                                      counts=counts)])
+
+
+def _queue_merge(run):
+    taskqueue.add(url=MERGE_URL, params={'run_id': run.key.id()},
+                  queue_name=QUEUE_NAME, transactional=True)
+
+
+def merge(run_id):
+    """
+    Merge the counts of every shard of a run into the PlayerAccuracy
+    entities.
+
+    Args:
+        run_id: The id of the AnalysisRun.
+    Returns:
+        None
+    """
+    run = AnalysisRun.get_by_id(run_id)
+    if not run or run.merged:
+        return
+    totals = {}
+    games = 0
+    for shard in AnalysisShard.query(ancestor=run.key):
+        games += shard.games
+        for player, counts in shard.counts.iteritems():
+            player_totals = totals.setdefault(player, [0, 0, 0, 0])
+            for i, count in enumerate(counts):
+                player_totals[i] += count
+
+    accuracies = []
+    for player, counts in totals.iteritems():
+        player = ndb.Key(urlsafe=player)
+        accuracies.append(PlayerAccuracy(
+            id=player.id(),
+            player=player,
+            moves=counts[_MOVES],
+            optimal=counts[_OPTIMAL],
+            inaccuracies=counts[_INACCURACIES],
+            blunders=counts[_BLUNDERS],
+            run_id=run_id))
+    for i in range(0, len(accuracies), MERGE_BATCH_SIZE):
+        ndb.put_multi(accuracies[i:i + MERGE_BATCH_SIZE])
+    run.merged = True
+    run.put()
+    logging.info('Analysis %s scored the moves of %d players in %d games',
+                 run_id, len(accuracies), games)
@@ -4,38 +4,306 @@ api.py - Create and configure the Tic Tac Toe game API.
 
 """
 
+import logging
+import time
+
 import endpoints
+from google.appengine.api import oauth
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 
 from models import (
+    CacheStatsForm,
+    CacheStatsForms,
+    EndpointStatsForm,
+    EndpointStatsForms,
     StringMessage,
+    TicTacToeBatchMoveForms,
+    TicTacToeBatchMoveResultForm,
+    TicTacToeBatchMoveResultForms,
     TicTacToeGame,
+    TicTacToeGameChangesForm,
     TicTacToeGameForm,
     TicTacToeGameForms,
     TicTacToeGameHistoryForm,
     TicTacToeMakeMoveForm,
+    TicTacToeMatchForm,
     TicTacToeNewGameForm,
+    TicTacToeOpeningForms,
+    TicTacToeOpeningMoveForm,
+    TicTacToePlayerRankForm,
     TicTacToePlayerRanking,
+    TicTacToePlayerRankingForm,
     TicTacToePlayerRankingForms,
+    TicTacToePositionForm,
     TicTacToeScore,
     TicTacToeScoreForms,
     User,
 )
 
-from utils import get_by_urlsafe
+import bitboard
+import counters
+import gamecache
+from gamecache import (
+    ACTIVE_GAMES_COUNTER,
+    ACTIVE_MOVES_COUNTER,
+    ACTIVE_SQUARES_COUNTER,
+)
+import leaderboard
+import matchmaking
+import openings
+import rpcstats
+import solver
+import usercache
+from utils import get_key_by_urlsafe
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(TicTacToeNewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
+GAME_CHANGES_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    if_version=messages.IntegerField(2),
+    wait=messages.IntegerField(3))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     TicTacToeMakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(limit=messages.IntegerField(1),
+                                           cursor=messages.StringField(2))
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1))
+POSITION_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    ply=messages.IntegerField(2))
+OPENING_REQUEST = endpoints.ResourceContainer(board=messages.StringField(1))
+STATS_REQUEST = endpoints.ResourceContainer(minutes=messages.IntegerField(1))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    cursor=messages.StringField(3))
+
+# Number of items returned by list endpoints when no limit is given, and
+# the most that can be asked for.
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Sharded counters of the moves rejected by make_move because the game
+# changed while they were made, and of retried moves that had already been
+# made, used to watch contention.
+MOVE_CONFLICTS_COUNTER = 'move_conflicts'
+MOVE_RETRIES_COUNTER = 'move_retries'
+
+# The most seconds get_game_if_changed waits for a game to change, well
+# inside the endpoints request deadline, and how often it checks.
+MAX_WAIT_SECONDS = 25
+WAIT_POLL_SECONDS = 0.5
+
+# The most moves that can be made in one call to make_moves. This is the
+# most games the datastore accepts in a single put_multi.
+MAX_BATCH_MOVES = 500
+
+
+def _validate_move(game, player_symbol, square):
+    """
+    Check that a move is legal.
+
+    Args:
+        game: The TicTacToeGame the move is made in.
+        player_symbol: The symbol of the player making the move.
+        square: The square the player is moving into.
+    Returns:
+        None
+    Raises:
+        endpoints.BadRequestException: If the move is not legal.
+    """
+    # make sure it is the correct player's move
+    if not (player_symbol == game.next_to_move()):
+        raise endpoints.BadRequestException(
+            "It's not {}'s turn!".format(player_symbol))
+
+    # make sure that the square is on the board
+    if not game.shape.is_valid_square(square):
+        raise endpoints.BadRequestException(
+            "That's an invalid move: {}".format(square))
+
+    # make sure that the square is unoccupied
+    if game.is_square_occupied(square):
+        current_symbol = game.get_square(square)
+        raise endpoints.BadRequestException(
+            "There is already an {} in square {}".format(current_symbol,
+                                                         square))
+
+
+def _check_admin():
+    """
+    Check that the caller is signed in as an administrator of the app.
+    Endpoints are not covered by the login settings in app.yaml, so the
+    admin endpoints check the caller themselves.
+
+    Args:
+        None
+    Returns:
+        None
+    Raises:
+        endpoints.UnauthorizedException: If the caller is not signed in
+        or is not an administrator.
+    """
+    if endpoints.get_current_user() is None:
+        raise endpoints.UnauthorizedException('Sign in as an administrator')
+    try:
+        is_admin = oauth.is_current_user_admin(endpoints.EMAIL_SCOPE)
+    except oauth.Error:
+        is_admin = False
+    if not is_admin:
+        raise endpoints.UnauthorizedException(
+            'Only administrators can see this')
+
+
+@ndb.tasklet
+def _fetch_page_async(query, request):
+    """
+    Fetch one page of query results.
+
+    Args:
+        query: The ndb query.
+        request: A request with the optional page size limit and the
+        cursor returned with the previous page.
+    Returns:
+        A future for a tuple of the list of results and the cursor string
+        for the next page, or None if there are no more results.
+    Raises:
+        endpoints.BadRequestException: If the limit or cursor is invalid.
+    """
+    limit = request.limit or DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise endpoints.BadRequestException(
+            'Invalid limit: {}'.format(limit))
+    limit = min(limit, MAX_PAGE_SIZE)
+    try:
+        cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+    results, next_cursor, more = yield query.fetch_page_async(
+        limit, start_cursor=cursor)
+    if more and next_cursor:
+        raise ndb.Return((results, next_cursor.urlsafe()))
+    raise ndb.Return((results, None))
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+
+def _player_keys(entities):
+    """
+    Get the player keys of games or scores.
+
+    Args:
+        entities: TicTacToeGame or TicTacToeScore entities.
+    Returns:
+        A list of the User keys of both players of every entity.
+    """
+    keys = []
+    for entity in entities:
+        keys.append(entity.player1)
+        keys.append(entity.player2)
+    return keys
+
+
+def _update_active_game_counters_async(moves_before):
+    """
+    Update the active game counters after moves have been made. Only games
+    that have ended change the counters here; the moves of games still in
+    progress are counted by gamecache as their queued versions are
+    written, so those moves make no datastore writes.
+
+    Args:
+        moves_before: A list of (game, number of moves) pairs, giving the
+        number of moves each game had before the moves were made.
+    Returns:
+        A future that is done when the counters have been updated.
+    """
+    games = 0
+    moves = 0
+    squares = 0
+    for game, number_of_moves in moves_before:
+        if game.game_over:
+            # the game and all of its earlier moves, which were counted
+            # from the queue, are no longer active
+            games -= 1
+            moves -= number_of_moves
+            squares -= game.shape.number_of_squares
+    return counters.increment_async({ACTIVE_GAMES_COUNTER: games,
+                                     ACTIVE_MOVES_COUNTER: moves,
+                                     ACTIVE_SQUARES_COUNTER: squares})
+
+
+@ndb.tasklet
+def _match_form_async(game, created):
+    """
+    Get the form of a player's place in the matchmaking queue.
+
+    Args:
+        game: The player's TicTacToeGame, or None if they are waiting.
+        created: Whether the game was just created, so the active game
+        counters must count it.
+    Returns:
+        A future for the TicTacToeMatchForm.
+    """
+    if game is None:
+        raise ndb.Return(TicTacToeMatchForm(
+            matched=False, message='Waiting for an opponent.'))
+    if created:
+        counters.increment_async(
+            {ACTIVE_GAMES_COUNTER: 1,
+             ACTIVE_SQUARES_COUNTER: game.shape.number_of_squares})
+    names = yield User.get_names_async([game.player1, game.player2])
+    raise ndb.Return(TicTacToeMatchForm(
+        matched=True,
+        game=game.to_form('Good luck playing Tic Tac Toe!', names),
+        message='Matched with an opponent!'))
+
+
+def _get_game(urlsafe_game_key):
+    """
+    Get a game, through the cache of games in progress.
+
+    Args:
+        urlsafe_game_key: The urlsafe key of the game.
+    Returns:
+        The TicTacToeGame, or None if it does not exist.
+    Raises:
+        endpoints.BadRequestException: If the key is invalid.
+    """
+    key = get_key_by_urlsafe(urlsafe_game_key)
+    if key.kind() != TicTacToeGame._get_kind():
+        return None
+    return gamecache.get_game(key)
+
+
+def _game_message(game):
+    """Get the message shown with a game that is fetched."""
+    if game.game_over:
+        return "This game has ended."
+    return "Time for '{}' to make a move!".format(game.next_to_move())
+
+
+def _apply_move(game, player_symbol, square):
+    """
+    Make a player's move, followed by the computer's reply in a single
+    player game. The game is not saved.
+
+    Args:
+        game: The TicTacToeGame the move is made in.
+        player_symbol: The symbol of the player making the move.
+        square: The square the player is moving into.
+    Returns:
+        A message about the game state.
+    """
+    message = game.apply_move(player_symbol, square)
+
+    # In a single player game the computer replies straight away
+    if game.computer_game and not game.game_over:
+        message = game.apply_computer_move()
+    return message
 
 
 @endpoints.api(name='tic_tac_toe', version='v1')
@@ -49,6 +317,8 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @rpcstats.instrument
+    @ndb.toplevel
     def create_user(self, request):
         """Creates a new user.
 
@@ -62,51 +332,151 @@ class TicTacToeApi(remote.Service):
             endpoints.ConflictException: If a user already exists with the
             user name.
         """
-        if User.query(User.name == request.user_name).get():
+        user_key = yield User.get_key_by_name_async(request.user_name)
+        if user_key:
             raise endpoints.ConflictException('User name already exists!')
         user = User.new_user(request.user_name, request.email)
-        return StringMessage(message='User {} created!'.format(user.name))
+        raise ndb.Return(
+            StringMessage(message='User {} created!'.format(user.name)))
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=TicTacToeGameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @rpcstats.instrument
+    @ndb.toplevel
     def new_game(self, request):
         """
         Creates new 2-player game. Player 1 and Player 2 must both already be
-        registered users.
+        registered users. If no Player 2 is given, a single player game
+        against the computer is created instead. Two player games can be
+        played on larger boards, such as 15x15 with five in a row to win.
 
         Args:
             request: A NEW_GAME_REQUEST object containing the user name
-            of player 1 and player 2.
+            of player 1 and player 2, the optional computer difficulty, and
+            the optional width, height and number in a row to win.
         Returns:
             TicTacToeGameForm: A form representation of the newly created
             game.
         Raises:
             endpoints.NotFoundException: If either user does not exist.
+            endpoints.BadRequestException: If the difficulty or the board
+            is invalid.
         """
-        player1 = User.query(User.name == request.player1_name).get()
+        try:
+            shape = bitboard.get_shape(request.width, request.height,
+                                       request.win_length)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+        # Look up both players at the same time
+        if request.player2_name:
+            player1, player2 = yield (
+                User.get_key_by_name_async(request.player1_name),
+                User.get_key_by_name_async(request.player2_name))
+        else:
+            player1 = yield User.get_key_by_name_async(request.player1_name)
         if not player1:
             raise endpoints.NotFoundException('Player 1 does not exist!')
 
-        player2 = User.query(User.name == request.player2_name).get()
-        if not player2:
-            raise endpoints.NotFoundException('Player 2 does not exist!')
-        game = TicTacToeGame.new_two_player_game(player1.key, player2.key)
+        if request.player2_name:
+            if not player2:
+                raise endpoints.NotFoundException('Player 2 does not exist!')
+            game = yield TicTacToeGame.new_two_player_game_async(
+                player1, player2, shape)
+            names = {player1: request.player1_name,
+                     player2: request.player2_name}
+        else:
+            if shape is not bitboard.STANDARD:
+                raise endpoints.BadRequestException(
+                    'Games against the computer are played on a 3x3 board')
+            difficulty = request.difficulty or solver.PERFECT
+            if difficulty not in solver.DIFFICULTIES:
+                raise endpoints.BadRequestException(
+                    "Invalid difficulty: {}".format(difficulty))
+            game = yield TicTacToeGame.new_single_player_game_async(
+                player1, difficulty)
+            names = {player1: request.player1_name}
+
+        gamecache.add_games([game])
+        # The counter is updated in the background; ndb.toplevel waits for
+        # it before the request finishes.
+        counters.increment_async(
+            {ACTIVE_GAMES_COUNTER: 1,
+             ACTIVE_SQUARES_COUNTER: shape.number_of_squares})
+        raise ndb.Return(game.to_form('Good luck playing Tic Tac Toe!',
+                                      names))
 
-        # Use a task queue to update the average moves remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        #
-        taskqueue.add(url='/tasks/cache_average_moves')
-        return game.to_form('Good luck playing Tic Tac Toe!')
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=TicTacToeMatchForm,
+                      path='matchmaking/{user_name}',
+                      name='join_queue',
+                      http_method='POST')
+    @rpcstats.instrument
+    @ndb.toplevel
+    def join_queue(self, request):
+        """
+        Join the matchmaking queue, to be matched with another player of a
+        similar ranking for a two player game. If an opponent is waiting
+        the game is created straight away; otherwise poll with poll_match
+        until it is. The longer a player waits, the wider the range of
+        rankings they can be matched with.
+
+        Args:
+            request: A USER_REQUEST object with the user name.
+        Returns:
+            TicTacToeMatchForm: The new game, or that the user is waiting.
+        Raises:
+            endpoints.NotFoundException: If the user does not exist.
+        """
+        user_key = yield User.get_key_by_name_async(request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        game, created = matchmaking.join(user_key)
+        form = yield _match_form_async(game, created)
+        raise ndb.Return(form)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=TicTacToeMatchForm,
+                      path='matchmaking/{user_name}',
+                      name='poll_match',
+                      http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
+    def poll_match(self, request):
+        """
+        Check whether a user in the matchmaking queue has been matched. A
+        user who stops polling leaves the queue after two minutes.
+
+        Args:
+            request: A USER_REQUEST object with the user name.
+        Returns:
+            TicTacToeMatchForm: The user's game, or that they are waiting.
+        Raises:
+            endpoints.NotFoundException: If the user does not exist or is
+            not in the queue.
+        """
+        user_key = yield User.get_key_by_name_async(request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        game, queued, created = matchmaking.poll(user_key)
+        if not queued:
+            raise endpoints.NotFoundException(
+                'That user is not in the matchmaking queue!')
+        form = yield _match_form_async(game, created)
+        raise ndb.Return(form)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=TicTacToeGameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
     def get_game(self, request):
         """
         Retrieve a game.
@@ -119,143 +489,349 @@ class TicTacToeApi(remote.Service):
         Raises:
             endpoints.NotFoundException: If the game is not found.
         """
-        game = get_by_urlsafe(request.urlsafe_game_key, TicTacToeGame)
+        game = _get_game(request.urlsafe_game_key)
         if game:
-            if game.game_over:
-                message = "This game has ended."
-            else:
-                message = "Time for '{}' to make a move!".format(
-                    game.next_to_move())
-            return game.to_form(message)
+            form = yield game.to_form_async(_game_message(game))
+            raise ndb.Return(form)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GAME_CHANGES_REQUEST,
+                      response_message=TicTacToeGameChangesForm,
+                      path='game/changes/{urlsafe_game_key}',
+                      name='get_game_if_changed',
+                      http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
+    def get_game_if_changed(self, request):
+        """
+        Retrieve a game if it has changed since the version the client
+        last saw. The version of each game is cached, so a poll of a game
+        that has not changed is answered without reading the datastore. A
+        client can also wait for up to MAX_WAIT_SECONDS for a change,
+        instead of polling again.
+
+        Args:
+            request: A GAME_CHANGES_REQUEST object containing the URL safe
+            game ID, and the optional version the client has and number of
+            seconds to wait for a newer one.
+        Returns:
+            TicTacToeGameChangesForm: Whether the game has changed, its
+            version, and the game if it has changed.
+        Raises:
+            endpoints.NotFoundException: If the game is not found.
+            endpoints.BadRequestException: If the key or wait is invalid.
+        """
+        key = get_key_by_urlsafe(request.urlsafe_game_key)
+        wait = request.wait or 0
+        if wait < 0:
+            raise endpoints.BadRequestException(
+                'Invalid wait: {}'.format(wait))
+        deadline = time.time() + min(wait, MAX_WAIT_SECONDS)
+
+        game = None
+        while True:
+            version = yield TicTacToeGame.get_cached_version_async(key)
+            if version is None:
+                game = gamecache.get_game(key)
+                if not isinstance(game, TicTacToeGame):
+                    raise endpoints.NotFoundException('Game not found!')
+                # A save may be caching a newer version at the same time
+                TicTacToeGame.cache_versions([game], replace=False)
+                version = game.version
+            if version != request.if_version:
+                break
+            if time.time() >= deadline:
+                raise ndb.Return(TicTacToeGameChangesForm(modified=False,
+                                                          version=version))
+            time.sleep(WAIT_POLL_SECONDS)
+
+        if game is None or game.version != version:
+            game = gamecache.get_game(key)
+            if not isinstance(game, TicTacToeGame):
+                raise endpoints.NotFoundException('Game not found!')
+        form = yield game.to_form_async(_game_message(game))
+        raise ndb.Return(TicTacToeGameChangesForm(modified=True,
+                                                  version=game.version,
+                                                  game=form))
+
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=TicTacToeGameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @rpcstats.instrument
+    @ndb.toplevel
     def make_move(self, request):
         """
         Make a move.
 
+        The game is saved only if no other move has been made since it was
+        read, so two moves made at the same time cannot overwrite each
+        other; the second is rejected. A client can also pass the version
+        of the game it chose the move against as expected_version, and a
+        move_id so that a retried move is not made twice.
+
         Args:
             request: A MAKE_MOVE_REQUEST object containing the player
-            symbol and the square indicating the move.
+            symbol and the square indicating the move, and the optional
+            expected version and move id.
         Returns:
             TicTacToeGameForm: A form represetnation of the game state
             after the move.
         Raises:
             endpoints.NotFoundException: If the game is not found.
+            endpoints.ConflictException: If the game has changed since the
+            expected version, or while the move was made.
         """
-        game = get_by_urlsafe(request.urlsafe_game_key, TicTacToeGame)
+        key = get_key_by_urlsafe(request.urlsafe_game_key)
+        game, client = None, None
+        if key.kind() == TicTacToeGame._get_kind():
+            game, client = gamecache.get_game_for_update(key)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
 
+        # Look up the player names while the move is made
+        names_future = User.get_names_async([game.player1, game.player2])
+
+        # A retried move that was already made succeeds again without
+        # being made twice
+        if request.move_id and request.move_id in game.move_ids:
+            counters.increment_async({MOVE_RETRIES_COUNTER: 1})
+            names = yield names_future
+            raise ndb.Return(game.to_form('Move already made.', names))
+
         # Check to see if the game has already ended
         if game.game_over:
-            return game.to_form('Game already over!')
+            names = yield names_future
+            raise ndb.Return(game.to_form('Game already over!', names))
 
-        # make sure it is the correct player's move
-        if not (request.player_symbol == game.next_to_move()):
-            raise endpoints.BadRequestException(
-                "It's not {}'s turn!".format(request.player_symbol))
+        version = game.version
+        if (request.expected_version is not None and
+                request.expected_version != version):
+            counters.increment_async({MOVE_CONFLICTS_COUNTER: 1})
+            raise endpoints.ConflictException(
+                'The game has changed since version {}!'.format(
+                    request.expected_version))
 
-        # make sure that the square is a valid tic-tac-toe square
-        if request.square not in range(9):
-            raise endpoints.BadRequestException(
-                "That's an invalid move: {}".format(request.square))
+        _validate_move(game, request.player_symbol, request.square)
+        number_of_moves = game.number_of_moves
+        message = _apply_move(game, request.player_symbol, request.square)
+        game.add_move_id(request.move_id)
+        if not gamecache.save_move(game, client,
+                                   game.number_of_moves - number_of_moves):
+            game = gamecache.get_game(key)
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            if request.move_id and request.move_id in game.move_ids:
+                # The same move was retried at the same time and won
+                counters.increment_async({MOVE_RETRIES_COUNTER: 1})
+                names = yield names_future
+                raise ndb.Return(game.to_form('Move already made.', names))
+            counters.increment_async({MOVE_CONFLICTS_COUNTER: 1})
+            raise endpoints.ConflictException(
+                'Another move was made at the same time!')
+        _update_active_game_counters_async([(game, number_of_moves)])
+        names = yield names_future
+        raise ndb.Return(game.to_form(message, names))
+
+    @endpoints.method(request_message=TicTacToeBatchMoveForms,
+                      response_message=TicTacToeBatchMoveResultForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @rpcstats.instrument
+    @ndb.toplevel
+    def make_moves(self, request):
+        """
+        Make moves in many games at once. All of the games are fetched
+        together and saved together. Each move is checked on its own, so
+        an illegal move does not stop the other moves from being made.
+        Moves for the same game are made in the order they are given. If
+        another move is made in a game at the same time, the moves in that
+        game are rejected, as make_move rejects them.
 
-        # make sure that the square is unoccupied
-        current_symbol = game.get_square(request.square)
-        if (current_symbol != " "):
+        Args:
+            request: A TicTacToeBatchMoveForms object containing the game
+            key, player symbol and square of each move.
+        Returns:
+            TicTacToeBatchMoveResultForms: The game state after each move,
+            or an error message for each move that could not be made.
+        Raises:
+            endpoints.BadRequestException: If there are too many moves.
+        """
+        if len(request.moves) > MAX_BATCH_MOVES:
             raise endpoints.BadRequestException(
-                "There is already an {} in square {}".format(current_symbol,
-                                                             request.square))
+                'At most {} moves can be made at once'.format(
+                    MAX_BATCH_MOVES))
+
+        # Look up every game in one call
+        keys = {}
+        for move in request.moves:
+            if move.urlsafe_game_key in keys:
+                continue
+            try:
+                key = get_key_by_urlsafe(move.urlsafe_game_key)
+            except endpoints.BadRequestException:
+                key = None
+            if key is not None and key.kind() != TicTacToeGame._get_kind():
+                key = None
+            keys[move.urlsafe_game_key] = key
+        valid_keys = list(set(key for key in keys.values()
+                              if key is not None))
+        updates = dict(zip(valid_keys,
+                           gamecache.get_games_for_update(valid_keys)))
+        games = dict((key, game) for key, (game, _) in updates.iteritems())
+        names = yield User.get_names_async(_player_keys(
+            game for game in games.values() if game))
+
+        items = []
+        changed = {}
+        moves_before = {}
+        for move in request.moves:
+            result = TicTacToeBatchMoveResultForm(
+                urlsafe_game_key=move.urlsafe_game_key)
+            items.append(result)
+
+            key = keys[move.urlsafe_game_key]
+            if key is None:
+                result.error = 'Invalid Key'
+                continue
+            game = games[key]
+            if not game:
+                result.error = 'Game not found!'
+                continue
+            if game.game_over:
+                result.error = 'Game already over!'
+                continue
+            try:
+                _validate_move(game, move.player_symbol, move.square)
+            except endpoints.BadRequestException as e:
+                result.error = e.message
+                continue
+            moves_before.setdefault(key, game.number_of_moves)
+            message = _apply_move(game, move.player_symbol, move.square)
+            changed[key] = game
+            result.game = game.to_form(message, names)
 
-        message = game.make_move(request.player_symbol, request.square)
-        return game.to_form(message)
+        conflicts = set(game.key for game in gamecache.save_moves(
+            [(game, updates[key][1], game.number_of_moves - moves_before[key])
+             for key, game in changed.iteritems()]))
+        if conflicts:
+            counters.increment_async({MOVE_CONFLICTS_COUNTER: len(conflicts)})
+            for move, result in zip(request.moves, items):
+                if (keys[move.urlsafe_game_key] in conflicts and
+                        result.game is not None):
+                    result.game = None
+                    result.error = 'Another move was made at the same time!'
+        _update_active_game_counters_async(
+            [(game, moves_before[key]) for key, game in changed.iteritems()
+             if key not in conflicts])
+        raise ndb.Return(TicTacToeBatchMoveResultForms(items=items))
 
-    @endpoints.method(response_message=TicTacToeScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=TicTacToeScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
     def get_scores(self, request):
         """
-        Return all scores.
+        Return a page of scores.
 
         Args:
-            None
+            request: A PAGE_REQUEST object with the optional page size
+            limit and the cursor of the page.
         Returns:
-            TicTacToeScoreForms: A container object containing all of the
-            scores of completed games.
+            TicTacToeScoreForms: A container object containing a page of
+            the scores of completed games, and the cursor of the next page.
+        Raises:
+            endpoints.BadRequestException: If the limit or cursor is
+            invalid.
         """
-        return TicTacToeScoreForms(
-            items=[score.to_form() for score in TicTacToeScore.query()])
+        scores, next_cursor = yield _fetch_page_async(TicTacToeScore.query(),
+                                                      request)
+        names = yield User.get_names_async(_player_keys(scores))
+        raise ndb.Return(TicTacToeScoreForms(
+            items=[score.to_form(names) for score in scores],
+            next_cursor=next_cursor))
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=TicTacToeScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
     def get_user_scores(self, request):
         """
-        Return all of an individual User's scores.
+        Return a page of an individual User's scores.
 
         Args:
-            request: A USER_REQUEST object with the user name.
+            request: A USER_PAGE_REQUEST object with the user name, the
+            optional page size limit and the cursor of the page.
         Returns:
-            TicTacToeScoreForms: A container object containing all of the
-            user's scores.
+            TicTacToeScoreForms: A container object containing a page of
+            the user's scores, and the cursor of the next page.
         Raises:
             endpoints.NotFoundException: If the user does not exist.
+            endpoints.BadRequestException: If the limit or cursor is
+            invalid.
         """
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = yield User.get_key_by_name_async(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        # Get the scores for when the user was player1 or player2 and join the
-        # results.
-        scores1 = TicTacToeScore.query(TicTacToeScore.player1 == user.key)
-        scores2 = TicTacToeScore.query(TicTacToeScore.player2 == user.key)
-        score_items = [score.to_form() for score in scores1]
-        score_items += [score.to_form() for score in scores2]
-        return TicTacToeScoreForms(items=score_items)
+        scores = TicTacToeScore.query(TicTacToeScore.players == user_key)
+        scores, next_cursor = yield _fetch_page_async(scores, request)
+        names = yield User.get_names_async(_player_keys(scores))
+        score_items = [score.to_form(names) for score in scores]
+        raise ndb.Return(TicTacToeScoreForms(items=score_items,
+                                             next_cursor=next_cursor))
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=TicTacToeGameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
     def get_user_games(self, request):
         """
-        Get a list of all of a user's active games.
+        Get a page of a user's active games.
 
         Args:
-            request: A USER_REQUEST object containing the user name.
+            request: A USER_PAGE_REQUEST object containing the user name,
+            the optional page size limit and the cursor of the page.
         Returns:
-            TicTacToeGameForms: A container object containing all of
-            the user's active games.
+            TicTacToeGameForms: A container object containing a page of
+            the user's active games, and the cursor of the next page.
         Raises:
             endpoints.NotFoundException: If the user does not exist.
+            endpoints.BadRequestException: If the limit or cursor is
+            invalid.
         """
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = yield User.get_key_by_name_async(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games1 = TicTacToeGame.query(TicTacToeGame.player1 == user.key,
-                                     TicTacToeGame.game_over is not True)
-        games2 = TicTacToeGame.query(TicTacToeGame.player2 == user.key,
-                                     TicTacToeGame.game_over is not True)
-        game_items = [game.to_form() for game in games1]
-        game_items += [game.to_form() for game in games2]
-        return TicTacToeGameForms(games=game_items)
+        games = TicTacToeGame.query(TicTacToeGame.players == user_key,
+                                    TicTacToeGame.game_over == False)
+        games, next_cursor = yield _fetch_page_async(games, request)
+        games = gamecache.get_latest(games)
+        names = yield User.get_names_async(_player_keys(games))
+        game_items = [game.to_form(names=names) for game in games]
+        raise ndb.Return(TicTacToeGameForms(games=game_items,
+                                            next_cursor=next_cursor))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @rpcstats.instrument
+    @ndb.toplevel
     def cancel_game(self, request):
         """
         Cancel a game that has already been started.
@@ -269,41 +845,184 @@ class TicTacToeApi(remote.Service):
             endpoints.NotFoundException: If the game is not found.
 
         """
-        game = get_by_urlsafe(request.urlsafe_game_key, TicTacToeGame)
+        game = _get_game(request.urlsafe_game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
             message = "This game has already ended."
         else:
-            game.cancel_game()
+            yield (game.cancel_game_async(),
+                   counters.increment_async(
+                       {ACTIVE_GAMES_COUNTER: -1,
+                        ACTIVE_MOVES_COUNTER: -game.number_of_moves,
+                        ACTIVE_SQUARES_COUNTER:
+                            -game.shape.number_of_squares}))
+            gamecache.delete_game(game.key)
             message = "The game has been cancelled."
-        return StringMessage(message=message)
+        raise ndb.Return(StringMessage(message=message))
 
-    @endpoints.method(response_message=TicTacToePlayerRankingForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=TicTacToePlayerRankingForms,
                       path='scores/rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
     def get_user_rankings(self, request):
         """
-        Get the user rankings.
+        Get a page of the user rankings.
 
         Args:
-            None
+            request: A PAGE_REQUEST object with the optional page size
+            limit and the cursor of the page.
         Returns:
             TicTacToePlayerRankingForms: A container object containing
-            all of the user rankings.
+            a page of the user rankings, and the cursor of the next page.
+        Raises:
+            endpoints.BadRequestException: If the limit or cursor is
+            invalid.
         """
         # Get the rankings in reverse order (from high to low)
         rankings = TicTacToePlayerRanking.query().order(
             -TicTacToePlayerRanking.ranking)
-        return TicTacToePlayerRankingForms(
-            items=[ranking.to_form() for ranking in rankings])
+        rankings, next_cursor = yield _fetch_page_async(rankings, request)
+        names = yield User.get_names_async(
+            [ranking.player for ranking in rankings])
+        raise ndb.Return(TicTacToePlayerRankingForms(
+            items=[ranking.to_form(names) for ranking in rankings],
+            next_cursor=next_cursor))
+
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=TicTacToePlayerRankingForms,
+                      path='scores/leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
+    def get_leaderboard(self, request):
+        """
+        Get the top players, from highest ranking to lowest.
+
+        Args:
+            request: A LEADERBOARD_REQUEST object with the optional number
+            of players to return.
+        Returns:
+            TicTacToePlayerRankingForms: A container object containing
+            the rankings of the top players.
+        Raises:
+            endpoints.BadRequestException: If the limit is invalid.
+        """
+        limit = request.limit or leaderboard.TOP_N
+        if limit < 1:
+            raise endpoints.BadRequestException(
+                'Invalid limit: {}'.format(limit))
+        entries = leaderboard.get_top(limit)
+        names = yield User.get_names_async(
+            [ndb.Key(urlsafe=entry['player']) for entry in entries])
+        items = [TicTacToePlayerRankingForm(
+            player_name=names[ndb.Key(urlsafe=entry['player'])],
+            total_games=entry['total_games'],
+            wins=entry['wins'],
+            draws=entry['draws'],
+            ranking=entry['ranking']) for entry in entries]
+        raise ndb.Return(TicTacToePlayerRankingForms(items=items))
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=TicTacToePlayerRankForm,
+                      path='scores/rank/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
+    def get_user_rank(self, request):
+        """
+        Get a user's position in the player rankings.
+
+        Args:
+            request: A USER_REQUEST object with the user name.
+        Returns:
+            TicTacToePlayerRankForm: The user's rank and ranking.
+        Raises:
+            endpoints.NotFoundException: If the user does not exist.
+        """
+        user_key = yield User.get_key_by_name_async(request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        ranking = TicTacToePlayerRanking.get_for_players([user_key])[0]
+        rank, total_players = leaderboard.get_rank(ranking)
+        raise ndb.Return(TicTacToePlayerRankForm(
+            player_name=request.user_name,
+            rank=rank,
+            total_players=total_players,
+            ranking=ranking.ranking))
+
+    @endpoints.method(response_message=CacheStatsForms,
+                      path='admin/user_cache',
+                      name='get_user_cache_stats',
+                      http_method='GET')
+    @rpcstats.instrument
+    def get_user_cache_stats(self, request):
+        """
+        Get the hit and miss counters of the user name and key caches on
+        the instance that handles the request.
+
+        Args:
+            None
+        Returns:
+            CacheStatsForms: The counters of each cache.
+        Raises:
+            endpoints.UnauthorizedException: If the caller is not an
+            administrator.
+        """
+        _check_admin()
+        caches = (('user_names', usercache.user_names),
+                  ('user_keys', usercache.user_keys))
+        return CacheStatsForms(
+            items=[CacheStatsForm(name=name, **cache.stats())
+                   for name, cache in caches])
+
+    @endpoints.method(request_message=STATS_REQUEST,
+                      response_message=EndpointStatsForms,
+                      path='admin/stats',
+                      name='get_stats',
+                      http_method='GET')
+    def get_stats(self, request):
+        """
+        Get the latency and RPC counts of each endpoint on the instance
+        that handles the request, and the number of conflicting and
+        retried moves on every instance.
+
+        Args:
+            request: A STATS_REQUEST object containing the number of
+            recent minutes to include, up to 15.
+        Returns:
+            EndpointStatsForms: The stats of each endpoint.
+        Raises:
+            endpoints.UnauthorizedException: If the caller is not an
+            administrator.
+        """
+        _check_admin()
+        minutes = request.minutes or rpcstats.NUM_WINDOWS
+        if minutes < 1:
+            raise endpoints.BadRequestException(
+                "Invalid minutes: {}".format(minutes))
+        counts = counters.get_counts([MOVE_CONFLICTS_COUNTER,
+                                      MOVE_RETRIES_COUNTER])
+        return EndpointStatsForms(
+            window_minutes=min(minutes, rpcstats.NUM_WINDOWS),
+            items=[EndpointStatsForm(**stats)
+                   for stats in rpcstats.get_stats(minutes)],
+            move_conflicts=counts[MOVE_CONFLICTS_COUNTER],
+            move_retries=counts[MOVE_RETRIES_COUNTER])
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=TicTacToeGameHistoryForm,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
     def get_game_history(self, request):
         """
         Get the move history for a game.
@@ -317,18 +1036,102 @@ class TicTacToeApi(remote.Service):
         Raises:
             endpoints.NotFoundException: If the game is not found.
         """
-        game = get_by_urlsafe(request.urlsafe_game_key, TicTacToeGame)
+        game = _get_game(request.urlsafe_game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
-        return game.get_game_history_form()
+        names = yield User.get_names_async([game.player1, game.player2])
+        raise ndb.Return(game.get_game_history_form(names))
+
+    @endpoints.method(request_message=POSITION_REQUEST,
+                      response_message=TicTacToePositionForm,
+                      path='game/position/{urlsafe_game_key}',
+                      name='get_game_position',
+                      http_method='GET')
+    @rpcstats.instrument
+    def get_game_position(self, request):
+        """
+        Get the board of a game after a number of moves, for stepping
+        through a game.
+
+        Args:
+            request: A POSITION_REQUEST object containing the URL safe
+            game ID and the number of moves, which defaults to all of them.
+        Returns:
+            TicTacToePositionForm: The board after the moves.
+        Raises:
+            endpoints.NotFoundException: If the game is not found.
+            endpoints.BadRequestException: If the number of moves is
+            invalid.
+        """
+        game = _get_game(request.urlsafe_game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        ply = request.ply
+        if ply is None:
+            ply = game.number_of_moves
+        if not 0 <= ply <= game.number_of_moves:
+            raise endpoints.BadRequestException(
+                "Invalid ply: {}".format(ply))
+        return game.get_position_form(ply)
+
+    @endpoints.method(request_message=OPENING_REQUEST,
+                      response_message=TicTacToeOpeningForms,
+                      path='openings',
+                      name='get_opening_moves',
+                      http_method='GET')
+    @rpcstats.instrument
+    def get_opening_moves(self, request):
+        """
+        Get the results of every move played from a position in finished
+        3x3 games, counting reflections and rotations of the position as
+        the same position.
+
+        Args:
+            request: An OPENING_REQUEST object containing the board, 9
+            characters of 'X', 'O' and '-' for an empty square. It
+            defaults to the empty board.
+        Returns:
+            TicTacToeOpeningForms: The wins, draws and losses of the
+            player who made each move.
+        Raises:
+            endpoints.BadRequestException: If the board is invalid.
+        """
+        board = (request.board or '').replace('-', ' ').upper()
+        board = board or ' ' * bitboard.NUMBER_OF_SQUARES
+        if (len(board) != bitboard.NUMBER_OF_SQUARES or
+                set(board) - set('XO ')):
+            raise endpoints.BadRequestException(
+                "Invalid board: {}".format(request.board))
+        mask1 = bitboard.board_to_mask(board, 'X')
+        mask2 = bitboard.board_to_mask(board, 'O')
+        moves = bin(mask1).count('1') - bin(mask2).count('1')
+        if moves not in (0, 1):
+            raise endpoints.BadRequestException(
+                "Invalid board: {}".format(request.board))
+
+        items = []
+        for square, counts in sorted(
+                openings.get_moves(mask1, mask2).iteritems()):
+            items.append(TicTacToeOpeningMoveForm(
+                square=square,
+                games=sum(counts),
+                wins=counts[openings.WINS],
+                draws=counts[openings.DRAWS],
+                losses=counts[openings.LOSSES]))
+        return TicTacToeOpeningForms(
+            board=board.replace(' ', '-'),
+            next_to_move='O' if moves else 'X',
+            items=items)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @rpcstats.instrument
+    @ndb.toplevel
     def get_average_moves(self, request):
         """
-        Get the cached average moves remaining.
+        Get the average moves remaining.
 
         Args:
             None
@@ -336,28 +1139,49 @@ class TicTacToeApi(remote.Service):
             StringMessage: A message with the average moves remaining
             of all active games.
         """
-        return StringMessage(
-            message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
+        counts = yield counters.get_counts_async([ACTIVE_GAMES_COUNTER,
+                                                  ACTIVE_MOVES_COUNTER,
+                                                  ACTIVE_SQUARES_COUNTER])
+        count = counts[ACTIVE_GAMES_COUNTER]
+        if count <= 0:
+            raise ndb.Return(StringMessage(message=''))
+        total_moves_remaining = (counts[ACTIVE_SQUARES_COUNTER] -
+                                 counts[ACTIVE_MOVES_COUNTER])
+        average = float(total_moves_remaining) / count
+        raise ndb.Return(StringMessage(
+            message='The average moves remaining is {:.2f}'.format(average)))
 
     @staticmethod
-    def _cache_average_moves():
+    def _reconcile_game_counters():
         """
-        Populates memcache with the average moves remaining of all unfinished
-        tic-tac-toe games.
+        Recount the unfinished tic-tac-toe games, their moves and their
+        squares, and correct the active game counters if they have drifted.
+        The moves are counted as they are written to the datastore, so the
+        games are recounted from the datastore too, not the cache.
 
         Args:
             None
         Returns:
             None
         """
-        games = TicTacToeGame.query(TicTacToeGame.game_over is False).fetch()
-        if games:
-            count = len(games)
-            total_num_moves = sum([game.number_of_moves for game in games])
-            total_moves_remaining = 9 * count - total_num_moves
-            average = float(total_moves_remaining) / count
-            memcache.set(
-                MEMCACHE_MOVES_REMAINING,
-                'The average moves remaining is {:.2f}'.format(average))
+        actual = {ACTIVE_GAMES_COUNTER: 0,
+                  ACTIVE_MOVES_COUNTER: 0,
+                  ACTIVE_SQUARES_COUNTER: 0}
+        query = TicTacToeGame.query(TicTacToeGame.game_over == False)
+        cursor = None
+        more = True
+        while more:
+            games, cursor, more = query.fetch_page(500, start_cursor=cursor)
+            for game in games:
+                actual[ACTIVE_GAMES_COUNTER] += 1
+                actual[ACTIVE_MOVES_COUNTER] += game.number_of_moves
+                actual[ACTIVE_SQUARES_COUNTER] += (
+                    game.shape.number_of_squares)
+        counts = counters.get_counts(actual.keys())
+        for name, value in sorted(actual.iteritems()):
+            if counts[name] != value:
+                logging.warning('Counter %s was %d, should be %d',
+                                name, counts[name], value)
+                counters.set_count(name, value)
 
 api = endpoints.api_server([TicTacToeApi])
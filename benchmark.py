@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py - Local load test of the Tic Tac Toe API.
+
+Runs the real TicTacToeApi handlers in process against the App Engine
+SDK's in memory datastore, memcache and task queue stubs. A number of
+users are created, and then a mix of calls is made by players with many
+games in progress at once. The latency of every call and the datastore
+and memcache RPCs it makes are recorded, and a report is printed per
+endpoint. The report can be saved as a baseline and later runs compared
+against it.
+
+The stubs are much faster than the real services, so the numbers are only
+useful for comparing one version of the code with another on the same
+machine, and the RPC counts are the most reliable of them.
+
+Usage:
+    python benchmark.py --sdk ~/google_appengine --users 1000 --ops 20000
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Default share of calls made to each endpoint.
+DEFAULT_MIX = {'make_move': 60,
+               'new_game': 10,
+               'get_game': 10,
+               'get_scores': 5,
+               'get_user_rankings': 5,
+               'get_user_games': 10,
+               # Matchmaking is left out by default; give it a weight
+               # with --mix to load test the queue
+               'join_queue': 0,
+               'poll_match': 0}
+
+# A change of more than this percentage in a latency, or in the RPCs per
+# call, is reported as a regression.
+DEFAULT_THRESHOLD = 10.0
+
+PERCENTILES = (50, 95, 99)
+
+
+def _setup_sdk(sdk_path):
+    """Put the App Engine SDK and its bundled libraries on the path."""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def _activate_testbed():
+    """Start the in memory service stubs."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # Queries see every write straight away, like a single client would
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    return bed
+
+
+class RpcCounter(object):
+    """Counts the API calls made to each service."""
+
+    SERVICES = ('datastore_v3', 'memcache')
+
+    def __init__(self):
+        self.counts = dict((service, 0) for service in self.SERVICES)
+
+    def install(self):
+        """Start counting calls through the API proxy."""
+        from google.appengine.api import apiproxy_stub_map
+        hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+        for service in self.SERVICES:
+            hooks.Append('benchmark_' + service, self._hook, service)
+
+    def _hook(self, service, call, request, response):
+        self.counts[service] += 1
+
+    def snapshot(self):
+        return dict(self.counts)
+
+
+class Recorder(object):
+    """Records the latency and RPCs of each call, by endpoint."""
+
+    def __init__(self, rpcs):
+        self.rpcs = rpcs
+        self.calls = {}
+
+    def call(self, name, method, request):
+        """
+        Call an API method and record its cost.
+
+        Args:
+            name: The endpoint name to record the call under.
+            method: The bound API method.
+            request: The request message.
+        Returns:
+            The response message, or None if the method raised an error.
+        """
+        import endpoints
+
+        before = self.rpcs.snapshot()
+        start = time.time()
+        try:
+            response = method(request)
+            error = False
+        except endpoints.ServiceException:
+            response = None
+            error = True
+        elapsed = time.time() - start
+        after = self.rpcs.snapshot()
+
+        stats = self.calls.setdefault(
+            name, {'latencies': [], 'errors': 0,
+                   'rpcs': dict((s, 0) for s in RpcCounter.SERVICES)})
+        stats['latencies'].append(elapsed)
+        stats['errors'] += error
+        for service in RpcCounter.SERVICES:
+            stats['rpcs'][service] += after[service] - before[service]
+        return response
+
+
+def _percentile(values, percentile):
+    """Get a percentile of a sorted list, by the nearest rank."""
+    index = int(round(percentile / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def summarize(recorder, elapsed):
+    """
+    Summarize the recorded calls.
+
+    Args:
+        recorder: The Recorder of the run.
+        elapsed: The wall clock seconds the run took.
+    Returns:
+        A dict with the total calls and ops/sec of the run, and per
+        endpoint the number of calls and errors, latency percentiles in
+        milliseconds, ops/sec and RPCs per call.
+    """
+    endpoints_summary = {}
+    total = 0
+    for name, stats in sorted(recorder.calls.iteritems()):
+        latencies = sorted(stats['latencies'])
+        count = len(latencies)
+        total += count
+        summary = {'calls': count,
+                   'errors': stats['errors'],
+                   'ops_per_sec': count / sum(latencies)}
+        for percentile in PERCENTILES:
+            summary['p{}_ms'.format(percentile)] = (
+                _percentile(latencies, percentile) * 1000)
+        for service, rpcs in stats['rpcs'].iteritems():
+            summary['{}_rpcs'.format(service)] = float(rpcs) / count
+        endpoints_summary[name] = summary
+    return {'calls': total,
+            'ops_per_sec': total / elapsed,
+            'endpoints': endpoints_summary}
+
+
+class Simulation(object):
+    """
+    Players making a mix of calls with many games in progress.
+
+    Args:
+        api: A TicTacToeApi instance.
+        recorder: The Recorder of the run.
+        rng: The random.Random used to make every choice.
+        max_active_games: The most games in progress at once. New games
+            are only started while there are fewer than this.
+        single_player: The fraction of new games played against the
+            computer.
+    """
+
+    def __init__(self, api, recorder, rng, max_active_games, single_player):
+        self.api = api
+        self.recorder = recorder
+        self.rng = rng
+        self.max_active_games = max_active_games
+        self.single_player = single_player
+        self.users = []
+        # urlsafe game key -> the last TicTacToeGameForm of the game
+        self.active_games = {}
+        # Names of the users waiting in the matchmaking queue
+        self.waiting = set()
+
+    def _call(self, name, container, **fields):
+        import api
+        request_type = getattr(api, container).combined_message_class
+        return self.recorder.call(name, getattr(self.api, name),
+                                  request_type(**fields))
+
+    def create_users(self, count):
+        """Create the users taking part."""
+        for i in range(count):
+            name = 'user{}'.format(i)
+            self._call('create_user', 'USER_REQUEST', user_name=name,
+                       email='{}@example.com'.format(name))
+            self.users.append(name)
+
+    def new_game(self):
+        player1 = self.rng.choice(self.users)
+        player2 = None
+        if self.rng.random() >= self.single_player:
+            player2 = self.rng.choice(self.users)
+            while player2 == player1:
+                player2 = self.rng.choice(self.users)
+        game = self._call('new_game', 'NEW_GAME_REQUEST',
+                          player1_name=player1, player2_name=player2)
+        if game and not game.game_over:
+            self.active_games[game.urlsafe_key] = game
+
+    def make_move(self):
+        key = self.rng.choice(self.active_games.keys())
+        game = self.active_games[key]
+        if game.number_of_moves % 2 == 0:
+            symbol = game.player1_symbol
+        else:
+            symbol = game.player2_symbol
+        free = [i for i, square in enumerate(game.board) if square == ' ']
+        game = self._call('make_move', 'MAKE_MOVE_REQUEST',
+                          urlsafe_game_key=key, player_symbol=symbol,
+                          square=self.rng.choice(free))
+        if game is None or game.game_over:
+            del self.active_games[key]
+        else:
+            self.active_games[key] = game
+
+    def get_game(self):
+        self._call('get_game', 'GET_GAME_REQUEST',
+                   urlsafe_game_key=self.rng.choice(self.active_games.keys()))
+
+    def get_scores(self):
+        self._call('get_scores', 'PAGE_REQUEST')
+
+    def get_user_rankings(self):
+        self._call('get_user_rankings', 'PAGE_REQUEST')
+
+    def get_user_games(self):
+        self._call('get_user_games', 'USER_PAGE_REQUEST',
+                   user_name=self.rng.choice(self.users))
+
+    def _matched(self, name, form):
+        if form is None or form.matched:
+            self.waiting.discard(name)
+        if form is not None and form.matched:
+            self.active_games[form.game.urlsafe_key] = form.game
+        elif form is not None:
+            self.waiting.add(name)
+
+    def join_queue(self):
+        name = self.rng.choice(self.users)
+        self._matched(name, self._call('join_queue', 'USER_REQUEST',
+                                       user_name=name))
+
+    def poll_match(self):
+        name = self.rng.choice(sorted(self.waiting))
+        self._matched(name, self._call('poll_match', 'USER_REQUEST',
+                                       user_name=name))
+
+    def step(self, name):
+        """
+        Make one call. Calls that need a game in progress start a game
+        when there is none, and new games are not started while the most
+        games are in progress; a move is made instead.
+        """
+        if name == 'new_game' and (
+                len(self.active_games) >= self.max_active_games):
+            name = 'make_move'
+        if name in ('make_move', 'get_game') and not self.active_games:
+            name = 'new_game'
+        if name == 'poll_match' and not self.waiting:
+            name = 'join_queue'
+        getattr(self, name)()
+
+
+def parse_mix(text):
+    """
+    Parse an endpoint mix such as 'make_move=60,get_scores=5'.
+
+    Args:
+        text: Comma separated endpoint=weight pairs.
+    Returns:
+        A dict of endpoint name to weight.
+    Raises:
+        argparse.ArgumentTypeError: If the mix is malformed.
+    """
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(
+                'Unknown endpoint: {}'.format(name))
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'Invalid weight: {}'.format(part))
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError('The mix has no weight')
+    return mix
+
+
+def _weighted_choice(rng, mix):
+    point = rng.random() * sum(mix.values())
+    for name, weight in sorted(mix.iteritems()):
+        point -= weight
+        if point < 0:
+            return name
+    return name
+
+
+def run(args):
+    """
+    Run the benchmark.
+
+    Args:
+        args: The parsed command line arguments.
+    Returns:
+        The summary of the run.
+    """
+    _setup_sdk(args.sdk)
+    bed = _activate_testbed()
+    try:
+        import api
+
+        rpcs = RpcCounter()
+        rpcs.install()
+        recorder = Recorder(rpcs)
+        simulation = Simulation(api.TicTacToeApi(), recorder,
+                                random.Random(args.seed),
+                                args.active_games, args.single_player)
+
+        start = time.time()
+        simulation.create_users(args.users)
+        for _ in xrange(args.ops):
+            simulation.step(_weighted_choice(simulation.rng, args.mix))
+        return summarize(recorder, time.time() - start)
+    finally:
+        bed.deactivate()
+
+
+def print_summary(summary):
+    """Print the summary of a run as a table."""
+    columns = (['calls', 'errors'] +
+               ['p{}_ms'.format(p) for p in PERCENTILES] +
+               ['ops_per_sec', 'datastore_v3_rpcs', 'memcache_rpcs'])
+    print '{:<20}'.format('endpoint') + ''.join(
+        '{:>18}'.format(column) for column in columns)
+    for name, endpoint in sorted(summary['endpoints'].iteritems()):
+        print '{:<20}'.format(name) + ''.join(
+            '{:>18.2f}'.format(endpoint[column]) for column in columns)
+    print '{} calls, {:.1f} ops/sec'.format(summary['calls'],
+                                            summary['ops_per_sec'])
+
+
+def compare(baseline, summary, threshold):
+    """
+    Print the change of each endpoint from a baseline.
+
+    Args:
+        baseline: The summary of the baseline run.
+        summary: The summary of this run.
+        threshold: The percentage change reported as a regression.
+    Returns:
+        A list of the regressions, as strings.
+    """
+    # Lower is better for these; for ops_per_sec higher is better
+    columns = (['p{}_ms'.format(p) for p in PERCENTILES] +
+               ['datastore_v3_rpcs', 'memcache_rpcs', 'ops_per_sec'])
+    regressions = []
+    for name, endpoint in sorted(summary['endpoints'].iteritems()):
+        old = baseline['endpoints'].get(name)
+        if old is None:
+            continue
+        changes = []
+        for column in columns:
+            if not old[column]:
+                continue
+            change = 100.0 * (endpoint[column] - old[column]) / old[column]
+            changes.append('{} {:+.1f}%'.format(column, change))
+            worse = -change if column == 'ops_per_sec' else change
+            if worse > threshold:
+                regressions.append('{} {}: {:.2f} -> {:.2f}'.format(
+                    name, column, old[column], endpoint[column]))
+        print '{:<20}{}'.format(name, ', '.join(changes))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the Tic Tac Toe API in process.')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='Path of the App Engine SDK, if it is not '
+                             'already importable.')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Number of users to create.')
+    parser.add_argument('--ops', type=int, default=20000,
+                        help='Number of calls to make after the users '
+                             'are created.')
+    parser.add_argument('--active-games', type=int, default=500,
+                        help='Most games in progress at once.')
+    parser.add_argument('--single-player', type=float, default=0.2,
+                        help='Fraction of games against the computer.')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Share of calls per endpoint, such as '
+                             'make_move=60,get_scores=5.')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed, so runs are repeatable.')
+    parser.add_argument('--save', help='Save the results to this file.')
+    parser.add_argument('--baseline',
+                        help='Compare the results with this saved file.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Percentage change reported as a regression.')
+    args = parser.parse_args()
+
+    summary = run(args)
+    print_summary(summary)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, summary, args.threshold)
+        if regressions:
+            print 'Regressions:'
+            for regression in regressions:
+                print ' - ' + regression
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""
+bitboard.py - Bitboard representation of the tic-tac-toe board.
+
+Each player's marks are held in an integer bitmask where bit n is set if
+the player occupies square n. Legality and win checks are then single
+bitwise operations instead of string slicing.
+
+The module level functions are for the standard 3x3 board. Larger boards,
+such as 15x15 five in a row, are described by a Shape. A Shape checks for
+a win by looking only along the four lines through the last move, so the
+check takes O(k) steps for k in a row whatever the size of the board.
+"""
+
+NUMBER_OF_SQUARES = 9
+
+# Mask with every square occupied.
+FULL_BOARD = (1 << NUMBER_OF_SQUARES) - 1
+
+# Single-square masks indexed by square number.
+SQUARE_MASKS = tuple(1 << square for square in range(NUMBER_OF_SQUARES))
+
+# Every line of three squares that wins the game.
+WIN_MASKS = (
+    # rows
+    0b000000111, 0b000111000, 0b111000000,
+    # columns
+    0b001001001, 0b010010010, 0b100100100,
+    # diagonals
+    0b100010001, 0b001010100,
+)
+
+# Lookup table indexed by a player's mask: True if the mask contains a
+# winning line.
+_WINNING_MASKS = tuple(
+    any((mask & win) == win for win in WIN_MASKS)
+    for mask in range(FULL_BOARD + 1))
+
+
+def is_win(mask):
+    """
+    Determine if a player's mask contains a winning line.
+
+    Args:
+        mask: The player's bitmask.
+    Returns:
+        True if the mask contains three in a row, False otherwise.
+    """
+    return _WINNING_MASKS[mask]
+
+
+def board_to_mask(board, player_symbol):
+    """
+    Convert a board string into the bitmask for one player.
+
+    Args:
+        board: The 9 character board string.
+        player_symbol: The symbol of the player.
+    Returns:
+        The bitmask of the squares occupied by the player.
+    """
+    mask = 0
+    for square, symbol in enumerate(board):
+        if symbol == player_symbol:
+            mask |= SQUARE_MASKS[square]
+    return mask
+
+
+# Smallest and largest width and height of a board.
+MIN_SIZE = 3
+MAX_SIZE = 19
+
+# Squares are written in move strings as base 36 numbers.
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# The directions of the lines through a square, as (column, row) steps:
+# across, down, down and right, and up and right.
+_DIRECTIONS = ((1, 0), (0, 1), (1, 1), (1, -1))
+
+
+class Shape(object):
+    """
+    The size of a board and the number of marks in a row that wins.
+
+    Args:
+        width: The number of columns.
+        height: The number of rows.
+        win_length: The number of marks in a row that wins.
+    """
+
+    def __init__(self, width, height, win_length):
+        self.width = width
+        self.height = height
+        self.win_length = win_length
+        self.number_of_squares = width * height
+        self.full_board = (1 << self.number_of_squares) - 1
+        self.square_masks = tuple(1 << square
+                                  for square in range(self.number_of_squares))
+        self.empty_board = ' ' * self.number_of_squares
+        # Each square in a move string takes this many characters
+        self.move_width = 1
+        while len(_DIGITS) ** self.move_width < self.number_of_squares:
+            self.move_width += 1
+        # Each square in a packed move log takes this many bytes
+        self.move_bytes = 1 if self.number_of_squares <= 256 else 2
+
+    def is_valid_square(self, square):
+        """
+        Determine if the given square number is on the board.
+
+        Args:
+            square: The square number.
+        Returns:
+            True if the square is on the board, False otherwise.
+        """
+        return 0 <= square < self.number_of_squares
+
+    def is_full(self, occupied):
+        """
+        Determine if every square on the board is taken.
+
+        Args:
+            occupied: The combined mask of both players.
+        Returns:
+            True if the board is full, False otherwise.
+        """
+        return occupied == self.full_board
+
+    def is_win_at(self, mask, square):
+        """
+        Determine if a player has won with a mark in the given square, by
+        counting their marks along each line through the square.
+
+        Args:
+            mask: The player's bitmask, including the square.
+            square: The square of the player's last move.
+        Returns:
+            True if the square is part of a winning line, False otherwise.
+        """
+        column, row = square % self.width, square // self.width
+        for column_step, row_step in _DIRECTIONS:
+            in_a_row = 1
+            for sign in (1, -1):
+                c = column + sign * column_step
+                r = row + sign * row_step
+                while (0 <= c < self.width and 0 <= r < self.height and
+                       mask >> (r * self.width + c) & 1):
+                    in_a_row += 1
+                    if in_a_row >= self.win_length:
+                        return True
+                    c += sign * column_step
+                    r += sign * row_step
+        return False
+
+    def board_to_mask(self, board, player_symbol):
+        """
+        Convert a board string into the bitmask for one player.
+
+        Args:
+            board: The board string, one character per square.
+            player_symbol: The symbol of the player.
+        Returns:
+            The bitmask of the squares occupied by the player.
+        """
+        mask = 0
+        for square, symbol in enumerate(board):
+            if symbol == player_symbol:
+                mask |= 1 << square
+        return mask
+
+    def mask_to_board(self, mask1, symbol1, mask2, symbol2):
+        """
+        Convert two player bitmasks back into a board string.
+
+        Args:
+            mask1, mask2: The bitmasks of the two players.
+            symbol1, symbol2: The symbols of the two players.
+        Returns:
+            The board string, one character per square.
+        """
+        squares = []
+        for bit in self.square_masks:
+            if mask1 & bit:
+                squares.append(symbol1)
+            elif mask2 & bit:
+                squares.append(symbol2)
+            else:
+                squares.append(' ')
+        return ''.join(squares)
+
+    def encode_move(self, square):
+        """
+        Write a square in a move string.
+
+        Args:
+            square: The square number.
+        Returns:
+            The square as move_width base 36 digits.
+        """
+        digits = []
+        for _ in range(self.move_width):
+            square, digit = divmod(square, len(_DIGITS))
+            digits.append(_DIGITS[digit])
+        return ''.join(reversed(digits))
+
+    def decode_moves(self, moves):
+        """
+        Read the squares of a move string. On a 3x3 board this is one
+        digit per move, which is how moves have always been stored.
+
+        Args:
+            moves: The move string. Trailing spaces are ignored.
+        Returns:
+            The list of squares, in the order they were played.
+        """
+        moves = moves.rstrip(' ')
+        return [int(moves[i:i + self.move_width], len(_DIGITS))
+                for i in range(0, len(moves), self.move_width)]
+
+    def pack_moves(self, squares):
+        """
+        Pack squares into a move log of move_bytes bytes per square, most
+        significant byte first.
+
+        Args:
+            squares: The squares, in the order they were played.
+        Returns:
+            The packed move log.
+        """
+        if self.move_bytes == 1:
+            return ''.join(chr(square) for square in squares)
+        return ''.join(chr(square >> 8) + chr(square & 0xff)
+                       for square in squares)
+
+    def unpack_moves(self, log):
+        """
+        Read the squares of a packed move log.
+
+        Args:
+            log: The packed move log.
+        Returns:
+            The list of squares, in the order they were played.
+        """
+        if self.move_bytes == 1:
+            return [ord(byte) for byte in log]
+        return [ord(log[i]) << 8 | ord(log[i + 1])
+                for i in range(0, len(log), 2)]
+
+
+_shapes = {}
+
+
+def get_shape(width=3, height=3, win_length=3):
+    """
+    Get the Shape of a board. Shapes are shared, so each is only built
+    once per instance.
+
+    Args:
+        width: The number of columns.
+        height: The number of rows.
+        win_length: The number of marks in a row that wins.
+    Returns:
+        The Shape.
+    Raises:
+        ValueError: If the board is too small or too large, or it is not
+        possible to get win_length in a row.
+    """
+    key = (width, height, win_length)
+    shape = _shapes.get(key)
+    if shape is None:
+        if not (MIN_SIZE <= width <= MAX_SIZE and
+                MIN_SIZE <= height <= MAX_SIZE):
+            raise ValueError('Boards must be from {0}x{0} to {1}x{1}'.format(
+                MIN_SIZE, MAX_SIZE))
+        if not 3 <= win_length <= max(width, height):
+            raise ValueError(
+                'Cannot get {} in a row on a {}x{} board'.format(
+                    win_length, width, height))
+        shape = _shapes[key] = Shape(width, height, win_length)
+    return shape
+
+
+# The standard tic-tac-toe board.
+STANDARD = get_shape()
@@ -0,0 +1,147 @@
+"""
+counters.py - Sharded counters.
+
+Each counter is split over several shard entities so that many requests
+can update it at once without contending for a single entity group. The
+total of each counter is cached in memcache, so reading a counter is
+usually a single memcache get and at worst one batch get of its shards.
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# Number of shards per counter.
+NUM_SHARDS = 20
+
+# Seconds a counter total is cached. Totals are kept up to date as the
+# counters change, but expire so that a missed memcache update is soon
+# corrected from the shards.
+CACHE_TIME = 60
+
+_MEMCACHE_PREFIX = 'counter:'
+
+
+class CounterShard(ndb.Model):
+    """One shard of a sharded counter."""
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def _shard_key(name, index):
+    return ndb.Key(CounterShard, '{}:{}'.format(name, index))
+
+
+def _shard_keys(name):
+    return [_shard_key(name, index) for index in range(NUM_SHARDS)]
+
+
+@ndb.transactional_tasklet(xg=True)
+def _increment_shards_async(deltas):
+    """Add each delta to a random shard of its counter."""
+    keys = [_shard_key(name, random.randrange(NUM_SHARDS))
+            for name in deltas]
+    shards = yield ndb.get_multi_async(keys)
+    for i, (key, delta) in enumerate(zip(keys, deltas.values())):
+        if shards[i] is None:
+            shards[i] = CounterShard(key=key, count=0)
+        shards[i].count += delta
+    yield ndb.put_multi_async(shards)
+
+
+@ndb.tasklet
+def increment_async(deltas):
+    """
+    Change the value of one or more counters.
+
+    Args:
+        deltas: A dict of counter name to the amount to add. The amount
+        can be negative.
+    Returns:
+        A future that is done when the counters have been changed.
+    """
+    deltas = dict((name, delta) for name, delta in deltas.iteritems()
+                  if delta)
+    if not deltas:
+        return
+    yield _increment_shards_async(deltas)
+    # Counters that are not cached are left alone; they are summed from
+    # the shards the next time they are read.
+    yield memcache.Client().offset_multi_async(deltas,
+                                               key_prefix=_MEMCACHE_PREFIX)
+
+
+def increment(deltas):
+    """
+    Change the value of one or more counters.
+
+    Args:
+        deltas: A dict of counter name to the amount to add. The amount
+        can be negative.
+    Returns:
+        None
+    """
+    increment_async(deltas).get_result()
+
+
+@ndb.tasklet
+def get_counts_async(names):
+    """
+    Get the values of counters.
+
+    Args:
+        names: The counter names.
+    Returns:
+        A future for a dict of counter name to value.
+    """
+    counts = yield memcache.Client().get_multi_async(
+        names, key_prefix=_MEMCACHE_PREFIX)
+    missing = [name for name in names if name not in counts]
+    if missing:
+        keys = []
+        for name in missing:
+            keys.extend(_shard_keys(name))
+        shards = yield ndb.get_multi_async(keys)
+        totals = {}
+        for i, name in enumerate(missing):
+            totals[name] = sum(
+                shard.count
+                for shard in shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS]
+                if shard)
+        memcache.add_multi(totals, time=CACHE_TIME,
+                           key_prefix=_MEMCACHE_PREFIX)
+        counts.update(totals)
+    raise ndb.Return(counts)
+
+
+def get_counts(names):
+    """
+    Get the values of counters.
+
+    Args:
+        names: The counter names.
+    Returns:
+        A dict of counter name to value.
+    """
+    return get_counts_async(names).get_result()
+
+
+@ndb.transactional(xg=True)
+def _set_shards(name, value):
+    shards = [CounterShard(key=key, count=0) for key in _shard_keys(name)]
+    shards[0].count = value
+    ndb.put_multi(shards)
+
+
+def set_count(name, value):
+    """
+    Overwrite the value of a counter.
+
+    Args:
+        name: The counter name.
+        value: The new value.
+    Returns:
+        None
+    """
+    _set_shards(name, value)
+    memcache.set(_MEMCACHE_PREFIX + name, value, time=CACHE_TIME)
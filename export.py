@@ -0,0 +1,248 @@
+"""
+export.py - Bulk export of the finished games for analytics.
+
+An export writes one CSV row per finished game, joining each TicTacToeScore
+to its TicTacToeGame. Players are given by user id instead of name and the
+board and moves are encoded as integers, so no user lookups are needed and
+the rows are small. Scores are read in the order they were saved with
+batched query iteration, and the games of each batch are fetched with one
+get_multi.
+
+The rows are written in parts by a chain of tasks. Each part is
+compressed as it is written and saved in an ExportPart entity, so a task
+holds at most one compressed part in memory however many games are
+exported. An export covers the scores saved from its since date up to,
+but not including, its until date. Scores are selected by the day they
+were saved rather than the day the game was played, so imported games
+with earlier dates are still picked up by the next incremental export.
+When an export finishes, its until date is saved as the checkpoint that
+the next incremental export starts from.
+
+The parts are CSV rather than NumPy arrays so that they can be read by any
+analytics tool, and they are kept in the datastore because the app has no
+Cloud Storage client. The export does not use NumPy, although the importer
+does.
+"""
+
+import csv
+import logging
+import time
+import zlib
+from cStringIO import StringIO
+from datetime import date
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import TicTacToeScore
+
+QUEUE_NAME = 'export'
+EXPORT_URL = '/tasks/export/part'
+FINISH_URL = '/tasks/export/finish'
+
+# Scores read in each batch.
+BATCH_SIZE = 500
+
+# Most rows in each part. A compressed part of this many rows is well
+# within the datastore's 1MB entity size limit.
+ROWS_PER_PART = 20000
+
+# Seconds a task writes rows for before it saves its part, well inside the
+# 10 minute task deadline.
+TASK_SECONDS = 300
+
+COLUMNS = ('game_id', 'date', 'player1_id', 'player2_id', 'player1_score',
+           'player2_score', 'winner', 'number_of_moves', 'width', 'height',
+           'win_length', 'player1_board', 'player2_board', 'moves',
+           'computer_game', 'difficulty')
+
+_CHECKPOINT_ID = 'scores'
+
+
+class ExportRun(ndb.Model):
+    """Progress of one export."""
+    since = ndb.DateProperty()
+    until = ndb.DateProperty(required=True)
+    cursor = ndb.StringProperty(indexed=False)
+    parts = ndb.IntegerProperty(required=True, default=0)
+    rows = ndb.IntegerProperty(required=True, default=0)
+    done = ndb.BooleanProperty(required=True, default=False)
+
+
+class ExportPart(ndb.Model):
+    """A zlib compressed CSV part of an ExportRun, keyed by part number."""
+    rows = ndb.IntegerProperty(required=True)
+    data = ndb.BlobProperty(required=True)
+
+
+class ExportCheckpoint(ndb.Model):
+    """The date that every score saved earlier has been exported up to."""
+    exported_until = ndb.DateProperty(required=True)
+
+
+def encode_moves(squares, number_of_squares):
+    """
+    Encode the squares of a game as one integer, with the first move in
+    the lowest digit of base number_of_squares. Decode it by taking the
+    remainder and quotient number_of_moves times.
+
+    Args:
+        squares: The squares, in the order they were played.
+        number_of_squares: The number of squares on the board.
+    Returns:
+        The moves as an integer.
+    """
+    code = 0
+    for square in reversed(squares):
+        code = code * number_of_squares + square
+    return code
+
+
+def _row(score, game):
+    """Get the CSV row of a score and its game."""
+    row = [score.game.id(), score.date.isoformat(), score.player1.id(),
+           score.player2.id() if score.player2 else '',
+           score.player1_score, score.player2_score, score.winner,
+           score.number_of_moves]
+    if game is None:
+        # The game is missing, so only the score can be exported
+        return row + [''] * (len(COLUMNS) - len(row))
+    shape = game.shape
+    mask1, mask2 = game.get_masks()
+    return row + [shape.width, shape.height, shape.win_length, mask1, mask2,
+                  encode_moves(game.get_moves(), shape.number_of_squares),
+                  int(game.computer_game), game.difficulty or '']
+
+
+def start(since=None, until=None):
+    """
+    Start an export. By default it continues from where the last finished
+    export stopped, up to the end of yesterday.
+
+    Args:
+        since: The day the first scores to export were saved, or None
+        for the date of the checkpoint. If there is no checkpoint, every
+        score saved before until is exported.
+        until: The day after the last scores to export were saved, or
+        None for today. Scores can still be added for today, so exporting only up
+        to today means that no score is missed by the next export.
+    Returns:
+        The id of the ExportRun.
+    """
+    if since is None:
+        checkpoint = ExportCheckpoint.get_by_id(_CHECKPOINT_ID)
+        if checkpoint:
+            since = checkpoint.exported_until
+    until = until or date.today()
+    run_key = ExportRun(since=since, until=until).put()
+    taskqueue.add(url=EXPORT_URL, params={'run_id': run_key.id()},
+                  queue_name=QUEUE_NAME)
+    return run_key.id()
+
+
+def export_part(run_id):
+    """
+    Write the next part of an export, and queue the task for the part
+    after it.
+
+    Args:
+        run_id: The id of the ExportRun.
+    Returns:
+        None
+    """
+    run = ExportRun.get_by_id(run_id)
+    if not run or run.done:
+        return
+    query = TicTacToeScore.query(TicTacToeScore.created < run.until)
+    if run.since:
+        query = query.filter(TicTacToeScore.created >= run.since)
+    query = query.order(TicTacToeScore.created)
+    start_cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+
+    buf = StringIO()
+    writer = csv.writer(buf)
+    compressor = zlib.compressobj()
+    chunks = []
+
+    def flush():
+        chunks.append(compressor.compress(buf.getvalue()))
+        buf.seek(0)
+        buf.truncate()
+
+    writer.writerow(COLUMNS)
+    rows = 0
+    deadline = time.time() + TASK_SECONDS
+    cursor = None
+    more = True
+    while more and rows < ROWS_PER_PART and time.time() < deadline:
+        limit = min(BATCH_SIZE, ROWS_PER_PART - rows)
+        scores, cursor, more = query.fetch_page(limit,
+                                                start_cursor=start_cursor)
+        games = ndb.get_multi([score.game for score in scores])
+        for score, game in zip(scores, games):
+            writer.writerow(_row(score, game))
+        rows += len(scores)
+        flush()
+        start_cursor = cursor
+    chunks.append(compressor.flush())
+
+    next_cursor = cursor.urlsafe() if more and cursor else None
+    _save_part(run.key, run.cursor, next_cursor, rows, ''.join(chunks))
+
+
+@ndb.transactional
+def _save_part(run_key, cursor, next_cursor, rows, data):
+    """
+    Save a part and the cursor of the next one, and queue the next task.
+    Nothing is done if another task has already saved the part.
+    """
+    run = run_key.get()
+    if run.done or run.cursor != cursor:
+        return
+    run.parts += 1
+    ExportPart(parent=run_key, id=run.parts, rows=rows, data=data).put()
+    run.rows += rows
+    run.cursor = next_cursor
+    run.done = next_cursor is None
+    run.put()
+    # The checkpoint is in its own entity group, so it is saved by a task
+    url = FINISH_URL if run.done else EXPORT_URL
+    taskqueue.add(url=url, params={'run_id': run_key.id()},
+                  queue_name=QUEUE_NAME, transactional=True)
+
+
+def finish(run_id):
+    """
+    Save the checkpoint of a finished export, so the next export starts
+    where it stopped.
+
+    Args:
+        run_id: The id of the ExportRun.
+    Returns:
+        None
+    """
+    run = ExportRun.get_by_id(run_id)
+    if not run or not run.done:
+        return
+    checkpoint = ExportCheckpoint.get_by_id(_CHECKPOINT_ID)
+    if checkpoint is None or checkpoint.exported_until < run.until:
+        ExportCheckpoint(id=_CHECKPOINT_ID, exported_until=run.until).put()
+    logging.info('Export %s wrote %d rows in %d parts', run_id, run.rows,
+                 run.parts)
+
+
+def get_part(run_id, part):
+    """
+    Get a part of an export as CSV.
+
+    Args:
+        run_id: The id of the ExportRun.
+        part: The part number, starting at 1.
+    Returns:
+        The CSV text of the part, or None if there is no such part.
+    """
+    entity = ndb.Key(ExportRun, run_id, ExportPart, part).get()
+    if entity is None:
+        return None
+    return zlib.decompress(entity.data)
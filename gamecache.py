@@ -0,0 +1,481 @@
+"""
+gamecache.py - Write-behind cache of the games in progress.
+
+A game in progress is read and written in memcache instead of the
+datastore. A move is saved by a compare and set of the cached game, so of
+two moves made at the same time only the first is saved. Each saved move
+also adds the game to a pull queue, tagged with the game's key. Adding a
+task is durable but much cheaper than a datastore write, so the queue
+stands in for the datastore until the game is written:
+
+ - A cron job leases the queued games every minute and writes the newest
+   version of each to the datastore, so a game is written about once a
+   minute however many moves are made in it.
+ - A game that ends is written straight away, with its score and the
+   players' rankings.
+ - If a game is evicted from memcache, the next read leases its queued
+   versions, writes the newest to the datastore, and caches it again, so
+   an eviction never loses a move.
+
+A game is loaded into the cache and written by a flush under the same
+memcache lock. A flush can only lock the games of the queued versions it
+has leased after leasing them, and until it does, the load of one of
+those games cannot see them. So a flush marks when it is leasing, and a
+load only caches a game if no flush was leasing while it read the game's
+queued versions. A flush gives back the queued versions of the games it
+cannot lock, so the load holding the lock can see them. A game whose
+newest version is not known is returned without being cached.
+
+A game's version goes up with every move, and a queued game is only ever
+written over an older version, so the queued writes can be applied in any
+order and more than once. A game that has been deleted stays deleted.
+
+Each queued version also carries the number of moves it added, which are
+added to the active game moves counter when the version is taken off the
+queue, so a move in a game in progress makes no datastore writes at all.
+"""
+
+import logging
+import random
+import struct
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+import counters
+from models import TicTacToeGame
+
+QUEUE_NAME = 'game-writes'
+
+# Sharded counters of the number of unfinished games, and the total number
+# of moves made in them and squares on their boards, used to find the
+# average moves remaining. The moves of games in progress are counted as
+# their queued versions are taken off the queue.
+ACTIVE_GAMES_COUNTER = 'active_games'
+ACTIVE_MOVES_COUNTER = 'active_game_moves'
+ACTIVE_SQUARES_COUNTER = 'active_game_squares'
+
+# Seconds queued games are leased for while they are written.
+LEASE_SECONDS = 60
+
+# Most queued games leased at once. A game has at most one queued version
+# per move.
+MAX_LEASE_TASKS = 500
+
+# Most tasks added to the queue in one call.
+MAX_TASKS_PER_ADD = 100
+
+# Seconds a flush leases and writes games for, well inside the 10 minute
+# cron deadline.
+FLUSH_SECONDS = 300
+
+# Seconds a game is cached. Games in progress are cached until they are
+# evicted; this only stops finished games staying in memcache forever.
+CACHE_TIME = 24 * 60 * 60
+
+# Seconds the lock taken to load a game into the cache is held, and how
+# long and how often other requests wait for the load.
+LOCK_SECONDS = 10
+LOCK_WAIT_SECONDS = 0.1
+LOCK_RETRIES = 10
+
+_MEMCACHE_PREFIX = 'game:'
+_LOCK_PREFIX = 'game_lock:'
+
+# Held while a flush runs, so only one flush runs at a time.
+_FLUSH_LOCK_KEY = 'game_flush_lock'
+
+# (_LEASING or _LEASED, a token for each batch leased by the flush). The
+# token changes with every batch, so a load can tell if a flush leased a
+# batch while it read a game's queued versions.
+_FLUSH_STATE_KEY = 'game_flush_state'
+_LEASING = 'leasing'
+_LEASED = 'leased'
+
+
+def _encode(game):
+    return ndb.model_to_protobuf(game).Encode()
+
+
+def _decode(data):
+    return ndb.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+def _cache_key(key):
+    return _MEMCACHE_PREFIX + key.urlsafe()
+
+
+# A queued version is the number of moves it added, then the game.
+_MOVES_FORMAT = '>I'
+_MOVES_SIZE = struct.calcsize(_MOVES_FORMAT)
+
+
+def _task(data, game, moves):
+    return taskqueue.Task(payload=struct.pack(_MOVES_FORMAT, moves) + data,
+                          method='PULL', tag=game.key.urlsafe())
+
+
+def _read_tasks(tasks):
+    """
+    Read queued versions.
+
+    Returns:
+        A tuple of the newest version of each game, by key, and the total
+        number of moves the versions added.
+    """
+    games = []
+    moves = 0
+    for task in tasks:
+        moves += struct.unpack(_MOVES_FORMAT,
+                               task.payload[:_MOVES_SIZE])[0]
+        games.append(_decode(task.payload[_MOVES_SIZE:]))
+    return _newest(games), moves
+
+
+@ndb.transactional_tasklet
+def _store_if_newer_async(game):
+    """
+    Write a game to the datastore unless the stored game is as new.
+
+    Returns:
+        A future for the stored game, or None if it has been deleted.
+    """
+    stored = yield game.key.get_async(use_cache=False)
+    if stored is None:
+        raise ndb.Return(None)
+    if stored.version >= game.version:
+        raise ndb.Return(stored)
+    yield game.put_async()
+    raise ndb.Return(game)
+
+
+def _newest(games):
+    """Get the newest version of each game, by key."""
+    newest = {}
+    for game in games:
+        if (game.key not in newest or
+                newest[game.key].version < game.version):
+            newest[game.key] = game
+    return newest
+
+
+def _recover(key):
+    """
+    Load a game into the cache, from the datastore and the newest of its
+    queued versions. The game is not cached if a flush may have leased
+    queued versions that could not be seen.
+    """
+    queue = taskqueue.Queue(QUEUE_NAME)
+    for _ in range(LOCK_RETRIES):
+        state = memcache.get(_FLUSH_STATE_KEY)
+        if state is not None and state[0] == _LEASING:
+            time.sleep(LOCK_WAIT_SECONDS)
+            continue
+        game = key.get(use_cache=False)
+        if game is None:
+            return None
+        if not game.game_over:
+            tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, MAX_LEASE_TASKS,
+                                             tag=key.urlsafe())
+            if tasks:
+                newest, moves = _read_tasks(tasks)
+                if newest[key].version > game.version:
+                    game = _store_if_newer_async(newest[key]).get_result()
+                queue.delete_tasks(tasks)
+                counters.increment({ACTIVE_MOVES_COUNTER: moves})
+                if game is None:
+                    return None
+        if memcache.get(_FLUSH_STATE_KEY) == state:
+            memcache.add(_cache_key(key), _encode(game), time=CACHE_TIME)
+            return game
+    logging.warning('Not caching game %s while queued moves are leased',
+                    key.urlsafe())
+    return key.get(use_cache=False)
+
+
+def _load(key):
+    """
+    Load a game that is not cached. Only one request loads a game at a
+    time; the others wait for it to be cached.
+    """
+    client = memcache.Client()
+    lock = _LOCK_PREFIX + key.urlsafe()
+    for _ in range(LOCK_RETRIES):
+        if client.add(lock, 1, time=LOCK_SECONDS):
+            try:
+                return _recover(key)
+            finally:
+                client.delete(lock)
+        time.sleep(LOCK_WAIT_SECONDS)
+        data = client.get(_cache_key(key))
+        if data is not None:
+            return _decode(data)
+    # The game may be missing moves that are still queued, so it is not
+    # cached, and it cannot be saved by save_move.
+    logging.warning('Timed out loading game %s', key.urlsafe())
+    return key.get()
+
+
+def get_game(key):
+    """
+    Get a game, from the cache if it is there.
+
+    Args:
+        key: The key of the game.
+    Returns:
+        The TicTacToeGame, or None if it does not exist.
+    """
+    data = memcache.get(_cache_key(key))
+    if data is not None:
+        return _decode(data)
+    return _load(key)
+
+
+def get_games_for_update(keys):
+    """
+    Get many games to make moves in, with one batch get from the cache.
+
+    Args:
+        keys: The keys of the games, without duplicates.
+    Returns:
+        A list of (TicTacToeGame, memcache client) pairs in the same order
+        as the keys, to pass to save_moves. The game is None if it does
+        not exist, and the client is None if the game could not be read
+        from the cache to update it.
+    """
+    client = memcache.Client()
+    cached = client.get_multi([_cache_key(key) for key in keys],
+                              for_cas=True)
+    loaded = {}
+    missing = [key for key in keys if _cache_key(key) not in cached]
+    if missing:
+        for key in missing:
+            loaded[key] = _load(key)
+        cached.update(client.get_multi([_cache_key(key) for key in missing],
+                                       for_cas=True))
+    updates = []
+    for key in keys:
+        data = cached.get(_cache_key(key))
+        if data is None:
+            updates.append((loaded[key], None))
+        else:
+            updates.append((_decode(data), client))
+    return updates
+
+
+def get_game_for_update(key):
+    """
+    Get a game to make a move in.
+
+    Args:
+        key: The key of the game.
+    Returns:
+        A tuple of the TicTacToeGame, or None if it does not exist, and
+        the memcache client to pass to save_move, or None if the game
+        could not be read from the cache to update it.
+    """
+    return get_games_for_update([key])[0]
+
+
+def save_moves(updates):
+    """
+    Save games after moves have been made in them, with one compare and
+    set of all of them. Games that have ended are written to the datastore
+    with their scores straight away; the others are saved in the cache and
+    queued to be written, and their moves are counted when they are
+    written. The caller counts the games that have ended.
+
+    Args:
+        updates: A list of (TicTacToeGame, memcache client, number of
+        moves) tuples, with the game and client from get_games_for_update
+        and the number of moves made in the game since it was read.
+    Returns:
+        A list of the games that were not saved because they were changed
+        by another request after they were read.
+    """
+    conflicts = []
+    client = None
+    values = {}
+    games = {}
+    moves = {}
+    for game, game_client, game_moves in updates:
+        if game_client is None:
+            conflicts.append(game)
+            continue
+        client = game_client
+        cache_key = _cache_key(game.key)
+        values[cache_key] = _encode(game)
+        games[cache_key] = game
+        moves[cache_key] = game_moves
+    if not values:
+        return conflicts
+
+    failed = set(client.cas_multi(values, time=CACHE_TIME))
+    conflicts.extend(games[cache_key] for cache_key in failed)
+    saved = [cache_key for cache_key in values if cache_key not in failed]
+    ended = [games[cache_key] for cache_key in saved
+             if games[cache_key].game_over]
+    playing = [cache_key for cache_key in saved
+               if not games[cache_key].game_over]
+    try:
+        if len(ended) == 1:
+            ended[0].save()
+        elif ended:
+            TicTacToeGame.save_games(ended)
+        tasks = [_task(values[cache_key], games[cache_key], moves[cache_key])
+                 for cache_key in playing]
+        queue = taskqueue.Queue(QUEUE_NAME)
+        for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+        TicTacToeGame.cache_versions([games[cache_key]
+                                      for cache_key in playing])
+    except Exception:
+        # The moves are not durable, so they are dropped from the cache
+        # too; the next read loads the games as they were saved
+        client.delete_multi(saved)
+        raise
+    return conflicts
+
+
+def save_move(game, client, moves):
+    """
+    Save a game after a move has been made in it. A game that has ended is
+    written to the datastore with its score straight away; otherwise the
+    game is saved in the cache and queued to be written.
+
+    Args:
+        game: The TicTacToeGame, from get_game_for_update.
+        client: The memcache client from get_game_for_update.
+        moves: The number of moves made in the game since it was read.
+    Returns:
+        True if the game was saved, False if it was not because it was
+        changed by another request after it was read.
+    """
+    return not save_moves([(game, client, moves)])
+
+
+def add_games(games):
+    """
+    Cache games that have just been created. Games that are already
+    cached are left alone, so a game being played is never replaced.
+
+    Args:
+        games: The new TicTacToeGame entities.
+    Returns:
+        None
+    """
+    memcache.add_multi(dict((game.key.urlsafe(), _encode(game))
+                            for game in games),
+                       time=CACHE_TIME, key_prefix=_MEMCACHE_PREFIX)
+
+
+def get_latest(games):
+    """
+    Bring games read by a query up to date with the cache, since the
+    datastore copy of a game in progress may be missing its latest moves.
+
+    Args:
+        games: The TicTacToeGame entities.
+    Returns:
+        The newest version of each game, in the same order.
+    """
+    if not games:
+        return games
+    cached = memcache.get_multi([game.key.urlsafe() for game in games],
+                                key_prefix=_MEMCACHE_PREFIX)
+    latest = []
+    for game in games:
+        data = cached.get(game.key.urlsafe())
+        if data is not None:
+            cached_game = _decode(data)
+            if cached_game.version > game.version:
+                game = cached_game
+        latest.append(game)
+    return latest
+
+
+def delete_game(key):
+    """
+    Remove a deleted game from the cache. Its queued versions are not
+    written, since a deleted game stays deleted.
+
+    Args:
+        key: The key of the game.
+    Returns:
+        None
+    """
+    memcache.delete(_cache_key(key))
+
+
+def _lease_and_lock(queue, client):
+    """
+    Lease a batch of queued games and lock them, so they are not loaded
+    into the cache while they are written. The leases of games that are
+    being loaded are given back, since the load may not have seen them.
+
+    Returns:
+        A tuple of the number of tasks leased, and a dict of the urlsafe
+        key of each locked game to its leased tasks.
+    """
+    token = random.getrandbits(64)
+    client.set(_FLUSH_STATE_KEY, (_LEASING, token), time=LEASE_SECONDS)
+    tasks = queue.lease_tasks(LEASE_SECONDS, MAX_LEASE_TASKS)
+    games = {}
+    for task in tasks:
+        games.setdefault(task.tag, []).append(task)
+    busy = client.add_multi(dict((tag, 1) for tag in games),
+                            time=LEASE_SECONDS, key_prefix=_LOCK_PREFIX)
+    for tag in busy:
+        for task in games.pop(tag):
+            queue.modify_task_lease(task, 0)
+    client.set(_FLUSH_STATE_KEY, (_LEASED, token))
+    return len(tasks), games
+
+
+def flush():
+    """
+    Write the newest queued version of each game to the datastore, and
+    count the moves of every queued version. Only one flush runs at a
+    time.
+
+    Args:
+        None
+    Returns:
+        None
+    """
+    client = memcache.Client()
+    if not client.add(_FLUSH_LOCK_KEY, 1,
+                      time=FLUSH_SECONDS + LEASE_SECONDS):
+        logging.info('Another flush is running')
+        return
+    queue = taskqueue.Queue(QUEUE_NAME)
+    deadline = time.time() + FLUSH_SECONDS
+    versions = 0
+    written = 0
+    try:
+        while time.time() < deadline:
+            leased, games = _lease_and_lock(queue, client)
+            if not leased:
+                break
+            try:
+                tasks = [task for tag_tasks in games.values()
+                         for task in tag_tasks]
+                newest, batch_moves = _read_tasks(tasks)
+                newest = newest.values()
+                futures = [_store_if_newer_async(game) for game in newest]
+                for game, future in zip(newest, futures):
+                    if future.get_result() is game:
+                        written += 1
+                if tasks:
+                    queue.delete_tasks(tasks)
+                    counters.increment({ACTIVE_MOVES_COUNTER: batch_moves})
+                versions += len(tasks)
+            finally:
+                client.delete_multi(games.keys(), key_prefix=_LOCK_PREFIX)
+    finally:
+        client.delete(_FLUSH_LOCK_KEY)
+    logging.info('Flushed %d queued versions with %d game writes',
+                 versions, written)
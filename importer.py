@@ -0,0 +1,351 @@
+"""
+importer.py - Bulk import of finished 3x3 games from another system.
+
+Each game is given by its players and its moves, the squares played in
+order as a string of digits such as '40812'. The moves of a whole batch
+of games are checked at once with NumPy arrays: every square must be on
+the board and played only once, the game must stop at the first win or
+when the board is full, and a recorded winner must agree with the moves.
+Valid games are then saved with their scores, and the players' rankings
+updated, in a few large put_multi calls instead of the several RPCs per
+move that replaying each game through make_move would take. Each game is
+keyed by its record id, or a hash of its players, date and moves, so a
+file can be imported again without counting its games twice.
+"""
+
+import hashlib
+import logging
+from datetime import date
+
+import numpy as np
+from google.appengine.ext import ndb
+
+import bitboard
+import leaderboard
+import openings
+import usercache
+from models import (
+    TicTacToeGame,
+    TicTacToePlayerRanking,
+    TicTacToeScore,
+    User,
+)
+
+# Entities written in each put_multi.
+PUT_BATCH_SIZE = 500
+
+# Most names in a single IN query.
+NAME_QUERY_SIZE = 30
+
+# Prefix of the ids of imported games and their scores.
+GAME_ID_PREFIX = 'import:'
+
+# Reasons a game is rejected, indexed by reason code. 0 means the game is
+# valid.
+VALID = 0
+REASONS = ('valid',
+           'too many moves',
+           'invalid square',
+           'square played more than once',
+           'moves after the game was won',
+           'game did not finish',
+           'winner does not match the moves')
+
+# Winners, as numbers in the result of validate.
+DRAW = -1
+PLAYER1 = 0
+PLAYER2 = 1
+
+_SQUARES = bitboard.NUMBER_OF_SQUARES
+
+# True for each mask that contains a winning line.
+_WINS = np.array([bitboard.is_win(mask)
+                  for mask in range(bitboard.FULL_BOARD + 1)])
+
+# The player who made each move: 0 for player 1 and 1 for player 2.
+_MOVER = np.arange(_SQUARES) % 2
+
+
+def validate(moves, winners=None):
+    """
+    Check the moves of many games at once.
+
+    Args:
+        moves: A list of moves strings, one per game.
+        winners: An optional list of the recorded winner of each game,
+        PLAYER1, PLAYER2, DRAW or None if it was not recorded.
+    Returns:
+        A tuple of three NumPy arrays with one entry per game: the reason
+        code of each game, VALID if it can be imported; the winner, as
+        PLAYER1, PLAYER2 or DRAW; and the bitmasks of the squares held by
+        each player at the end of the game, with shape (games, 2).
+    """
+    n = len(moves)
+    reasons = np.zeros(n, dtype=np.int8)
+    lengths = np.array([len(m) for m in moves], dtype=np.int16)
+    reasons[lengths > _SQUARES] = 1
+
+    # Parse every game at once; '?' pads the unplayed moves
+    text = ''.join(m[:_SQUARES].ljust(_SQUARES, '?') for m in moves)
+    squares = (np.fromstring(text, dtype=np.uint8).reshape(n, _SQUARES)
+               .astype(np.int16) - ord('0'))
+    played = np.arange(_SQUARES) < lengths[:, np.newaxis]
+    on_board = (squares >= 0) & (squares < _SQUARES)
+    invalid = (played & ~on_board).any(axis=1)
+    reasons[(reasons == VALID) & invalid] = 2
+
+    # Count how many times each square of each game is played
+    played &= on_board
+    squares = np.where(played, squares, 0)
+    rows = np.arange(n)[:, np.newaxis].repeat(_SQUARES, axis=1)
+    cells = (rows * _SQUARES + squares)[played]
+    if cells.size:
+        counts = np.bincount(cells, minlength=n * _SQUARES)
+        repeated = (counts.reshape(n, _SQUARES) > 1).any(axis=1)
+        reasons[(reasons == VALID) & repeated] = 3
+
+    # The masks of both players after each move. Squares are not repeated
+    # in the games that are still valid, so adding the bits is the same
+    # as or-ing them. The games already rejected are left empty, since a
+    # repeated square would add its bit twice and overflow the mask.
+    bits = np.where(played & (reasons == VALID)[:, np.newaxis],
+                    1 << squares, 0)
+    masks1 = np.cumsum(np.where(_MOVER == 0, bits, 0), axis=1)
+    masks2 = np.cumsum(np.where(_MOVER == 1, bits, 0), axis=1)
+    mover_masks = np.where(_MOVER == 0, masks1, masks2)
+    won = _WINS[mover_masks] & played
+    any_win = won.any(axis=1)
+    first_win = won.argmax(axis=1)
+    reasons[(reasons == VALID) & any_win & (lengths > first_win + 1)] = 4
+    reasons[(reasons == VALID) & ~any_win & (lengths < _SQUARES)] = 5
+
+    result = np.where(any_win, first_win % 2, DRAW)
+    if winners is not None:
+        recorded = np.array([DRAW - 1 if w is None else w for w in winners])
+        mismatch = (recorded != DRAW - 1) & (recorded != result)
+        reasons[(reasons == VALID) & mismatch] = 6
+
+    last = np.clip(lengths, 1, _SQUARES) - 1
+    final_masks = np.column_stack((masks1[np.arange(n), last],
+                                   masks2[np.arange(n), last]))
+    return reasons, result, final_masks
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _game_id(record):
+    """
+    Get the id of an imported game: its record id if it has one, or else
+    a hash of its players, date and moves, so importing it again gives
+    the same id.
+    """
+    if record.get('id'):
+        return GAME_ID_PREFIX + _utf8(record['id'])
+    game_date = record.get('date')
+    fields = [record['player1_name'], record.get('player2_name') or '',
+              game_date.isoformat() if game_date else '', record['moves']]
+    digest = hashlib.sha1('\n'.join(_utf8(field) for field in fields))
+    return GAME_ID_PREFIX + digest.hexdigest()
+
+
+def _skip_imported(valid, rejected):
+    """
+    Remove the games that have already been imported, or that repeat an
+    earlier game of the batch, from the valid games.
+
+    Args:
+        valid: A list of (index into the validated games, index of the
+        record, record, game id) tuples.
+        rejected: The list of (index of the record, reason) pairs that
+        the skipped games are added to.
+    Returns:
+        The valid games that have not been imported.
+    """
+    seen = set()
+    unique = []
+    for game in valid:
+        if game[3] in seen:
+            rejected.append((game[1], 'repeats an earlier game'))
+        else:
+            seen.add(game[3])
+            unique.append(game)
+    new = []
+    for i in range(0, len(unique), PUT_BATCH_SIZE):
+        batch = unique[i:i + PUT_BATCH_SIZE]
+        existing = ndb.get_multi([ndb.Key(TicTacToeGame, game[3])
+                                  for game in batch])
+        for game, entity in zip(batch, existing):
+            if entity is None:
+                new.append(game)
+            else:
+                rejected.append((game[1], 'already imported'))
+    return new
+
+
+def _get_or_create_users(names):
+    """
+    Get the keys of users by name, creating any that do not exist.
+
+    Returns:
+        A tuple of a dict of name to user key, and a list of the rankings
+        of the new users, which are not yet saved.
+    """
+    keys = usercache.user_keys.get_multi(names)
+    missing = [name for name in names if name not in keys]
+    for i in range(0, len(missing), NAME_QUERY_SIZE):
+        batch = missing[i:i + NAME_QUERY_SIZE]
+        for user in User.query(User.name.IN(batch)):
+            keys[user.name] = user.key
+
+    new_users = [User(name=name) for name in names if name not in keys]
+    new_rankings = []
+    for i in range(0, len(new_users), PUT_BATCH_SIZE):
+        ndb.put_multi(new_users[i:i + PUT_BATCH_SIZE])
+    for user in new_users:
+        keys[user.name] = user.key
+        new_rankings.append(TicTacToePlayerRanking(
+            key=TicTacToePlayerRanking.key_for(user.key), player=user.key))
+    usercache.user_keys.set_multi(dict((user.name, user.key)
+                                       for user in new_users))
+    usercache.user_names.set_multi(dict((user.key, user.name)
+                                        for user in new_users))
+    return keys, new_rankings
+
+
+def _update_rankings(results, new_rankings):
+    """
+    Add game results to the players' rankings and save them.
+
+    Args:
+        results: A dict of player key to a list of their points from each
+        game.
+        new_rankings: The unsaved rankings of players created by the
+        import.
+    Returns:
+        A list of (old ranking, TicTacToePlayerRanking) pairs for updating
+        the leaderboard.
+    """
+    rankings = dict((ranking.player, ranking) for ranking in new_rankings)
+    old_rankings = dict((player, None) for player in rankings)
+    existing = [player for player in results if player not in rankings]
+    for ranking in TicTacToePlayerRanking.get_for_players(existing):
+        rankings[ranking.player] = ranking
+        old_rankings[ranking.player] = ranking.ranking
+    for player, points in results.iteritems():
+        ranking = rankings[player]
+        ranking.total_games += len(points)
+        ranking.wins += points.count(3)
+        ranking.draws += points.count(1)
+        ranking.calculateRanking()
+
+    changed = rankings.values()
+    for i in range(0, len(changed), PUT_BATCH_SIZE):
+        ndb.put_multi(changed[i:i + PUT_BATCH_SIZE])
+    return [(old_rankings[ranking.player], ranking) for ranking in changed]
+
+
+def import_games(records):
+    """
+    Validate and save a batch of finished games.
+
+    Args:
+        records: A list of dicts, one per game, of player1_name,
+        player2_name, moves and optionally id, the game's id in the other
+        system, date, a datetime.date, and winner, 'X', 'O' or 'Draw'.
+        Player 1 plays X and moves first. If player2_name is empty, the
+        game was played against the computer and is not counted in the
+        rankings. Players that do not exist are created. Games that have
+        already been imported are skipped.
+    Returns:
+        A tuple of the number of games imported, and a list of
+        (index of the record, reason) pairs for the games that were not.
+    """
+    winner_codes = {'X': PLAYER1, 'O': PLAYER2, 'Draw': DRAW}
+    rejected = []
+    checked = []
+    for i, record in enumerate(records):
+        try:
+            record['moves'] = str(record.get('moves') or '')
+        except UnicodeError:
+            rejected.append((i, REASONS[2]))
+            continue
+        if not record.get('player1_name') or (
+                record.get('winner') not in (None, '', 'X', 'O', 'Draw')):
+            rejected.append((i, 'invalid record'))
+        else:
+            checked.append(i)
+    if not checked:
+        return 0, rejected
+
+    reasons, winners, masks = validate(
+        [records[i]['moves'] for i in checked],
+        [winner_codes.get(records[i].get('winner')) for i in checked])
+    valid = []
+    for j, i in enumerate(checked):
+        if reasons[j] == VALID:
+            valid.append((j, i, records[i], _game_id(records[i])))
+        else:
+            rejected.append((i, REASONS[reasons[j]]))
+    valid = _skip_imported(valid, rejected)
+    rejected.sort()
+    if not valid:
+        return 0, rejected
+
+    names = set()
+    for _, _, record, _ in valid:
+        names.add(record['player1_name'])
+        if record.get('player2_name'):
+            names.add(record['player2_name'])
+    keys, new_rankings = _get_or_create_users(list(names))
+
+    shape = bitboard.STANDARD
+    games = []
+    scores = []
+    results = {}
+    for j, _, record, game_id in valid:
+        player1 = keys[record['player1_name']]
+        player2 = keys.get(record.get('player2_name'))
+        squares = [int(square) for square in record['moves']]
+        game = TicTacToeGame(
+            id=game_id,
+            player1=player1,
+            player2=player2,
+            number_of_moves=len(squares),
+            game_over=True,
+            board=shape.mask_to_board(int(masks[j, 0]), 'X',
+                                      int(masks[j, 1]), 'O'),
+            move_log=shape.pack_moves(squares),
+            computer_game=player2 is None)
+        if winners[j] == PLAYER1:
+            points, winner = (3, 0), 'X'
+        elif winners[j] == PLAYER2:
+            points, winner = (0, 3), 'O'
+        else:
+            points, winner = (1, 1), 'Draw'
+        scores.append(TicTacToeScore(id=game_id,
+                                     player1=player1,
+                                     player2=player2,
+                                     player1_score=points[0],
+                                     player2_score=points[1],
+                                     date=record.get('date') or date.today(),
+                                     winner=winner,
+                                     number_of_moves=len(squares),
+                                     game=game.key))
+        games.append(game)
+        if player2 is not None:
+            results.setdefault(player1, []).append(points[0])
+            results.setdefault(player2, []).append(points[1])
+
+    entities = games + scores
+    for i in range(0, len(entities), PUT_BATCH_SIZE):
+        ndb.put_multi(entities[i:i + PUT_BATCH_SIZE])
+    changes = _update_rankings(results, new_rankings)
+    if changes:
+        leaderboard.queue_update(changes)
+    openings.record_games(games)
+    logging.info('Imported %d games, rejected %d', len(games), len(rejected))
+    return len(games), rejected
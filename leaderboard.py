@@ -0,0 +1,315 @@
+"""
+leaderboard.py - Materialized leaderboard of the player rankings.
+
+The top players are kept sorted in a single Leaderboard entity that is
+updated as rankings change, so showing the leaderboard is one get. To find
+a player's position without reading every ranking, the number of players
+is also counted in buckets of ranking (0.00, 0.01, ... 3.00). A player's
+rank is the number of players in the buckets above theirs, plus a count
+of the players above them within their own bucket.
+"""
+
+import json
+import logging
+import random
+import uuid
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import models
+
+# Number of players kept on the leaderboard.
+TOP_N = 100
+
+# Rankings range from 0.0 to 3.0, and are counted in buckets of 0.01.
+BUCKETS_PER_POINT = 100
+NUM_BUCKETS = 3 * BUCKETS_PER_POINT + 1
+
+# Bucket counts are sharded so that games ending at the same time do not
+# contend for one entity.
+NUM_SHARDS = 10
+
+# Seconds the summed bucket counts are cached.
+BUCKET_CACHE_TIME = 10
+
+QUEUE_NAME = 'leaderboard'
+UPDATE_URL = '/tasks/leaderboard/update'
+
+# Most changed rankings sent in one task, to stay under the task size limit.
+MAX_CHANGES_PER_TASK = 500
+
+# Most tasks added to a queue in one call.
+MAX_TASKS_PER_ADD = 100
+
+_TOP_ID = 'top'
+_TOP_MEMCACHE_KEY = 'leaderboard:top'
+_BUCKETS_MEMCACHE_KEY = 'leaderboard:buckets'
+
+
+class Leaderboard(ndb.Model):
+    """The top players, sorted from highest ranking to lowest."""
+    entries = ndb.JsonProperty()
+
+
+class LeaderboardBucketShard(ndb.Model):
+    """One shard of the number of players in each ranking bucket."""
+    counts = ndb.JsonProperty(required=True)
+
+
+class LeaderboardUpdate(ndb.Model):
+    """
+    Marks an update whose bucket counts have been applied, so a retried
+    task does not count its players twice. Keyed by the update id.
+    """
+    pass
+
+
+def bucket(ranking):
+    """
+    Get the bucket of a ranking. A ranking r is in bucket b if
+    b / 100.0 <= r < (b + 1) / 100.0, using the same float comparisons
+    as the datastore.
+
+    Args:
+        ranking: The player's ranking.
+    Returns:
+        The bucket number.
+    """
+    b = int(ranking * BUCKETS_PER_POINT)
+    if float(b + 1) / BUCKETS_PER_POINT <= ranking:
+        b += 1
+    elif float(b) / BUCKETS_PER_POINT > ranking:
+        b -= 1
+    return max(0, min(b, NUM_BUCKETS - 1))
+
+
+def _entry(ranking):
+    """Get the leaderboard entry of a TicTacToePlayerRanking."""
+    return {'player': ranking.player.urlsafe(),
+            'total_games': ranking.total_games,
+            'wins': ranking.wins,
+            'draws': ranking.draws,
+            'ranking': ranking.ranking}
+
+
+def _sort_key(entry):
+    return (-entry['ranking'], entry['player'])
+
+
+def _shard_key(index):
+    return ndb.Key(LeaderboardBucketShard, index + 1)
+
+
+@ndb.transactional(xg=True)
+def _update_buckets(update_id, deltas):
+    """Apply the bucket deltas of an update, unless they have been already."""
+    update_key = ndb.Key(LeaderboardUpdate, update_id)
+    if update_key.get() is not None:
+        return
+    key = _shard_key(random.randrange(NUM_SHARDS))
+    shard = key.get()
+    if shard is None:
+        shard = LeaderboardBucketShard(key=key, counts=[0] * NUM_BUCKETS)
+    for b, delta in deltas.iteritems():
+        shard.counts[b] += delta
+    ndb.put_multi([shard, LeaderboardUpdate(key=update_key)])
+
+
+@ndb.transactional
+def _update_top(entries):
+    """
+    Merge changed entries into the top players. Returns a tuple of False
+    if the top players need to be rebuilt from the rankings, and the new
+    top players, or None if they are unchanged. The new top players are
+    cached by the caller once the transaction has committed.
+    """
+    board = Leaderboard.get_by_id(_TOP_ID)
+    if board is None:
+        return False, None
+    top = dict((entry['player'], entry) for entry in board.entries)
+    full = len(board.entries) >= TOP_N
+    lowest = _sort_key(board.entries[-1]) if board.entries else None
+
+    changed = False
+    for entry in entries:
+        if entry['player'] in top:
+            # Updates can run out of order, so keep the newer entry
+            if top[entry['player']]['total_games'] > entry['total_games']:
+                continue
+            top[entry['player']] = entry
+            changed = True
+            # A player outside the leaderboard may now be above them
+            if full and _sort_key(entry) > lowest:
+                return False, None
+        elif not full or _sort_key(entry) < lowest:
+            top[entry['player']] = entry
+            changed = True
+    if not changed:
+        return True, None
+
+    board.entries = sorted(top.values(), key=_sort_key)[:TOP_N]
+    board.put()
+    return True, board.entries
+
+
+def queue_update(changes, transactional=False):
+    """
+    Queue the leaderboard to be updated after player rankings have
+    changed.
+
+    Args:
+        changes: A list of (old ranking, TicTacToePlayerRanking) pairs,
+        where the old ranking is None for a new player.
+        transactional: True to add the tasks in the current transaction,
+        so they only run if it commits. At most 5 tasks can be added in
+        one transaction.
+    Returns:
+        None
+    """
+    changes = [[old_ranking, _entry(ranking)]
+               for old_ranking, ranking in changes]
+    tasks = [taskqueue.Task(url=UPDATE_URL,
+                            params={'update': uuid.uuid4().hex,
+                                    'changes': json.dumps(
+                                        changes[i:i + MAX_CHANGES_PER_TASK])})
+             for i in range(0, len(changes), MAX_CHANGES_PER_TASK)]
+    queue = taskqueue.Queue(QUEUE_NAME)
+    for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        queue.add(tasks[i:i + MAX_TASKS_PER_ADD],
+                  transactional=transactional)
+
+
+def apply_update(update_id, changes):
+    """
+    Update the leaderboard after player rankings have changed. Run by the
+    tasks added by queue_update.
+
+    Args:
+        update_id: The id of the update, so a retried task only counts
+        its players once.
+        changes: A JSON list of [old ranking, leaderboard entry] pairs,
+        where the old ranking is None for a new player.
+    Returns:
+        None
+    """
+    changes = json.loads(changes)
+    deltas = {}
+    for old_ranking, entry in changes:
+        if old_ranking is not None:
+            b = bucket(old_ranking)
+            deltas[b] = deltas.get(b, 0) - 1
+        b = bucket(entry['ranking'])
+        deltas[b] = deltas.get(b, 0) + 1
+    deltas = dict((b, delta) for b, delta in deltas.iteritems() if delta)
+    if deltas:
+        _update_buckets(update_id, deltas)
+
+    merged, entries = _update_top([entry for _, entry in changes])
+    if not merged:
+        rebuild_top()
+    elif entries is not None:
+        memcache.set(_TOP_MEMCACHE_KEY, entries)
+
+
+def rebuild_top():
+    """
+    Rebuild the top players from the rankings.
+
+    Args:
+        None
+    Returns:
+        The leaderboard entries.
+    """
+    rankings = models.TicTacToePlayerRanking.query().order(
+        -models.TicTacToePlayerRanking.ranking).fetch(TOP_N)
+    entries = sorted([_entry(ranking) for ranking in rankings],
+                     key=_sort_key)
+    Leaderboard(id=_TOP_ID, entries=entries).put()
+    memcache.set(_TOP_MEMCACHE_KEY, entries)
+    return entries
+
+
+def rebuild():
+    """
+    Rebuild the top players and the bucket counts by reading every
+    ranking. Used to set up the leaderboard and to correct any drift.
+
+    Args:
+        None
+    Returns:
+        None
+    """
+    counts = [0] * NUM_BUCKETS
+    query = models.TicTacToePlayerRanking.query(
+        projection=[models.TicTacToePlayerRanking.ranking])
+    for ranking in query.iter(batch_size=1000):
+        counts[bucket(ranking.ranking)] += 1
+    shards = [LeaderboardBucketShard(key=_shard_key(index),
+                                     counts=[0] * NUM_BUCKETS)
+              for index in range(NUM_SHARDS)]
+    shards[0].counts = counts
+    ndb.put_multi(shards)
+    memcache.delete(_BUCKETS_MEMCACHE_KEY)
+    rebuild_top()
+    logging.info('Rebuilt the leaderboard of %d players', sum(counts))
+
+
+def get_top(limit=TOP_N):
+    """
+    Get the top players.
+
+    Args:
+        limit: The number of players to get, at most TOP_N.
+    Returns:
+        A list of leaderboard entries, from highest ranking to lowest.
+        Each entry is a dict of the player's urlsafe key, total_games,
+        wins, draws and ranking.
+    """
+    entries = memcache.get(_TOP_MEMCACHE_KEY)
+    if entries is None:
+        board = Leaderboard.get_by_id(_TOP_ID)
+        if board is None:
+            entries = rebuild_top()
+        else:
+            entries = board.entries
+            memcache.set(_TOP_MEMCACHE_KEY, entries)
+    return entries[:limit]
+
+
+def _bucket_counts():
+    """Get the number of players in each bucket, summed over the shards."""
+    counts = memcache.get(_BUCKETS_MEMCACHE_KEY)
+    if counts is None:
+        counts = [0] * NUM_BUCKETS
+        shards = ndb.get_multi([_shard_key(index)
+                                for index in range(NUM_SHARDS)])
+        for shard in shards:
+            if shard:
+                counts = [a + b for a, b in zip(counts, shard.counts)]
+        memcache.set(_BUCKETS_MEMCACHE_KEY, counts, time=BUCKET_CACHE_TIME)
+    return counts
+
+
+def get_rank(ranking):
+    """
+    Get a player's position on the leaderboard.
+
+    Args:
+        ranking: The player's TicTacToePlayerRanking.
+    Returns:
+        A tuple of the player's rank, starting at 1, and the total number
+        of players. Players with the same ranking share a rank.
+    """
+    counts = _bucket_counts()
+    b = bucket(ranking.ranking)
+    above = sum(counts[b + 1:])
+    # Count the players above this one within the same bucket
+    Ranking = models.TicTacToePlayerRanking
+    query = Ranking.query(Ranking.ranking > ranking.ranking)
+    if b + 1 < NUM_BUCKETS:
+        query = query.filter(
+            Ranking.ranking < float(b + 1) / BUCKETS_PER_POINT)
+    above += query.count()
+    return above + 1, sum(counts)
@@ -4,44 +4,296 @@
 main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs.
 """
+import csv
+import json
 import logging
+from datetime import datetime
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import TicTacToeApi
 
-from models import User
+from models import TicTacToeGame, TicTacToeScore
+import analysis
+import export
+import gamecache
+import importer
+import leaderboard
+import openings
+import recompute
+import reminders
+
+# Number of entities re-saved by each backfill task.
+BACKFILL_BATCH_SIZE = 500
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """
-        Send a reminder email every day to each User that has 
-        incomplete games.
-        """
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            if user.has_active_games():
-                # Only send email reminders to users that have games
-                # in progress
-                subject = 'Reminder: You have a tic-tac-toe game in progress!'
-                body = 'Hello {}, Your tic-tac-toe game needs your attention!'.format(user.name)
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+        Start the daily run that sends a reminder email to each User that
+        has incomplete games. Pass dry_run=1 to log the emails instead of
+        sending them.
+        """
+        reminders.start(dry_run=self.request.get('dry_run') == '1')
         self.response.set_status(200)
 
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+class ScanReminders(webapp2.RequestHandler):
+    def post(self):
+        """Queue reminder emails for the next page of active games."""
+        reminders.scan(self.request.get('run_id'))
+        self.response.set_status(204)
+
+
+class SendReminders(webapp2.RequestHandler):
+    def post(self):
+        """Send reminder emails to a batch of users."""
+        reminders.send(self.request.get('run_id'),
+                       self.request.get('user_keys').split(','))
+        self.response.set_status(204)
+
+
+class ReconcileGameCounters(webapp2.RequestHandler):
+    def get(self):
+        """Correct any drift in the active game counters."""
+        TicTacToeApi._reconcile_game_counters()
+        self.response.set_status(204)
+
+
+class FlushGames(webapp2.RequestHandler):
+    def get(self):
+        """Write the queued moves of games in progress to the datastore."""
+        gamecache.flush()
+        self.response.set_status(204)
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the leaderboard from the player rankings."""
+        leaderboard.rebuild()
+        self.response.set_status(204)
+
+
+class BackfillPlayers(webapp2.RequestHandler):
+    def post(self):
+        """
+        Re-save a batch of games or scores so that their computed players
+        property is stored, then queue a task for the next batch. Scores
+        saved before they had a created date are given their own date.
+        Start the backfill by posting kind=TicTacToeGame or
+        kind=TicTacToeScore.
+        """
+        models = {'TicTacToeGame': TicTacToeGame,
+                  'TicTacToeScore': TicTacToeScore}
+        kind = self.request.get('kind')
+        if kind not in models:
+            self.response.set_status(400)
+            return
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+
+        entities, next_cursor, more = models[kind].query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        if kind == 'TicTacToeScore':
+            for score in entities:
+                score.created = score.created or score.date
+        ndb.put_multi(entities)
+        logging.info('Backfilled players of %d %s entities',
+                     len(entities), kind)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_players',
+                          params={'kind': kind,
+                                  'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class RecordOpenings(webapp2.RequestHandler):
+    def post(self):
+        """Add the moves of a finished game to the opening counts."""
+        openings.record_game(self.request.get('game'))
+        self.response.set_status(204)
+
+
+class UpdateLeaderboard(webapp2.RequestHandler):
+    def post(self):
+        """Apply changed player rankings to the leaderboard."""
+        leaderboard.apply_update(self.request.get('update'),
+                                 self.request.get('changes'))
+        self.response.set_status(204)
+
+
+class StartAnalysis(webapp2.RequestHandler):
+    def post(self):
+        """Start scoring the moves of every finished game."""
+        run_id = analysis.start()
+        self.response.write(run_id)
+
+
+class ScanAnalysis(webapp2.RequestHandler):
+    def post(self):
+        """Queue the analysis of the next shards of finished games."""
+        analysis.scan(self.request.get('run_id'))
+        self.response.set_status(204)
+
+
+class AnalyzeShard(webapp2.RequestHandler):
+    def post(self):
+        """Score the moves of one shard of finished games."""
+        analysis.analyze(self.request.get('run_id'),
+                         int(self.request.get('shard')),
+                         self.request.get('start_cursor'),
+                         self.request.get('end_cursor'))
+        self.response.set_status(204)
+
+
+class MergeAnalysis(webapp2.RequestHandler):
+    def post(self):
+        """Save the accuracy of each player from the analyzed shards."""
+        analysis.merge(self.request.get('run_id'))
+        self.response.set_status(204)
+
+
+class StartRecompute(webapp2.RequestHandler):
+    def post(self):
+        """Start rebuilding every player's ranking from the scores."""
+        run_id = recompute.start()
+        self.response.write(run_id)
+
+
+class ScanRecompute(webapp2.RequestHandler):
     def post(self):
-        """Update game listing announcement in memcache."""
-        TicTacToeApi._cache_average_moves()
+        """Queue the aggregation of the next shards of scores."""
+        recompute.scan(self.request.get('run_id'))
         self.response.set_status(204)
 
 
+class AggregateRecompute(webapp2.RequestHandler):
+    def post(self):
+        """Sum the results of each player in one shard of scores."""
+        recompute.aggregate(self.request.get('run_id'),
+                            int(self.request.get('shard')),
+                            self.request.get('start_cursor'),
+                            self.request.get('end_cursor'))
+        self.response.set_status(204)
+
+
+class MergeRecompute(webapp2.RequestHandler):
+    def post(self):
+        """Write the rankings of one partition of players."""
+        recompute.merge(self.request.get('run_id'),
+                        int(self.request.get('partition')))
+        self.response.set_status(204)
+
+
+class SweepRecompute(webapp2.RequestHandler):
+    def post(self):
+        """Reset the next page of rankings that have no scores."""
+        recompute.sweep(self.request.get('run_id'),
+                        self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+def _parse_date(value):
+    """Parse an optional YYYY-MM-DD date."""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class StartExport(webapp2.RequestHandler):
+    def post(self):
+        """
+        Start exporting the finished games. Pass since and until as
+        YYYY-MM-DD dates to export the scores saved in a range of dates; by
+        default the export continues from where the last one stopped.
+        """
+        try:
+            since = _parse_date(self.request.get('since'))
+            until = _parse_date(self.request.get('until'))
+        except ValueError:
+            self.response.set_status(400)
+            return
+        run_id = export.start(since, until)
+        self.response.write(run_id)
+
+
+class WriteExportPart(webapp2.RequestHandler):
+    def post(self):
+        """Write the next part of an export."""
+        export.export_part(int(self.request.get('run_id')))
+        self.response.set_status(204)
+
+
+class FinishExport(webapp2.RequestHandler):
+    def post(self):
+        """Save the checkpoint of a finished export."""
+        export.finish(int(self.request.get('run_id')))
+        self.response.set_status(204)
+
+
+class DownloadExport(webapp2.RequestHandler):
+    def get(self):
+        """Download a part of an export as CSV."""
+        try:
+            data = export.get_part(int(self.request.get('run_id')),
+                                   int(self.request.get('part')))
+        except ValueError:
+            data = None
+        if data is None:
+            self.response.set_status(404)
+            return
+        self.response.headers['Content-Type'] = 'text/csv'
+        self.response.write(data)
+
+
+class ImportGames(webapp2.RequestHandler):
+    def post(self):
+        """
+        Import finished games from the CSV in the request body, with a
+        header row naming the player1_name, player2_name and moves columns,
+        and optionally id, date and winner. Responds with the number of
+        games imported and the line and reason of each game that was not.
+        """
+        records = list(csv.DictReader(self.request.body_file))
+        try:
+            for record in records:
+                record['date'] = _parse_date(record.get('date'))
+        except ValueError:
+            self.response.set_status(400)
+            return
+        imported, rejected = importer.import_games(records)
+        self.response.headers['Content-Type'] = 'application/json'
+        # Line 1 is the header
+        self.response.write(json.dumps({
+            'imported': imported,
+            'rejected': [{'line': i + 2, 'reason': reason}
+                         for i, reason in rejected]}))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_moves', UpdateAverageMovesRemaining),
+    ('/tasks/reminders/scan', ScanReminders),
+    ('/tasks/reminders/send', SendReminders),
+    ('/crons/reconcile_game_counters', ReconcileGameCounters),
+    ('/crons/rebuild_leaderboard', RebuildLeaderboard),
+    ('/crons/flush_games', FlushGames),
+    ('/tasks/backfill_players', BackfillPlayers),
+    ('/tasks/openings/record', RecordOpenings),
+    ('/tasks/leaderboard/update', UpdateLeaderboard),
+    ('/tasks/analysis/start', StartAnalysis),
+    ('/tasks/analysis/scan', ScanAnalysis),
+    ('/tasks/analysis/analyze', AnalyzeShard),
+    ('/tasks/analysis/merge', MergeAnalysis),
+    ('/tasks/recompute/start', StartRecompute),
+    ('/tasks/recompute/scan', ScanRecompute),
+    ('/tasks/recompute/aggregate', AggregateRecompute),
+    ('/tasks/recompute/merge', MergeRecompute),
+    ('/tasks/recompute/sweep', SweepRecompute),
+    ('/tasks/export/start', StartExport),
+    ('/tasks/export/part', WriteExportPart),
+    ('/tasks/export/finish', FinishExport),
+    ('/tasks/export/download', DownloadExport),
+    ('/tasks/import', ImportGames),
 ], debug=True)
@@ -0,0 +1,283 @@
+"""
+matchmaking.py - Pair up players of a similar ranking for two player games.
+
+A player joins the queue and is matched with another waiting player whose
+ranking is within a band of theirs. The band starts narrow and widens the
+longer the player waits, so a player is soon matched even when nobody
+close to their ranking is waiting.
+
+The waiting players are kept in memcache, in lists by ranking bucket, so
+every instance sees the same queue and finding an opponent is one batch
+get of the buckets in the band, however many players are waiting. Each
+bucket is split over a few shard lists that are changed with compare and
+set, so joins do not all contend for one memcache value. The lists are
+only an index; each player's MatchTicket in the datastore says whether
+they have been matched. A match sets the tickets of both players and
+creates their game in one cross-group transaction, so a player can never
+be matched twice. A waiting player who is lost from memcache is added back
+the next time they poll.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import gamecache
+from models import TicTacToeGame, TicTacToePlayerRanking
+
+# Rankings range from 0.0 to 3.0, and are queued in buckets of 0.1.
+BUCKETS_PER_POINT = 10
+NUM_BUCKETS = 3 * BUCKETS_PER_POINT + 1
+
+# Shard lists per bucket.
+NUM_SHARDS = 4
+
+# A player is first matched with players in buckets this far from their
+# own, and the band widens by one bucket for every WIDEN_SECONDS they wait.
+INITIAL_BAND = 1
+WIDEN_SECONDS = 5
+
+# Seconds a player stays in the queue without polling.
+TICKET_TIME = 120
+
+# Times a compare and set of a bucket is retried before giving up.
+CAS_RETRIES = 5
+
+# Candidates tried in one attempt to find a match.
+MAX_CANDIDATES = 10
+
+_MEMCACHE_PREFIX = 'matchmaking:'
+
+
+class MatchTicket(ndb.Model):
+    """A player's place in the queue. Keyed by user id."""
+    player = ndb.KeyProperty(required=True, kind='User')
+    bucket = ndb.IntegerProperty(required=True, indexed=False)
+    joined = ndb.DateTimeProperty(required=True, indexed=False)
+    last_poll = ndb.DateTimeProperty(required=True, indexed=False)
+    game = ndb.KeyProperty(kind='TicTacToeGame', indexed=False)
+
+    @classmethod
+    def key_for(cls, player):
+        return ndb.Key(cls, player.id())
+
+    def is_waiting(self, now):
+        """Determine if the player is still waiting for a match."""
+        return self.game is None and (
+            now - self.last_poll < timedelta(seconds=TICKET_TIME))
+
+    def band(self, now):
+        """Get how many buckets either side of their own to search."""
+        waited = (now - self.joined).total_seconds()
+        return INITIAL_BAND + int(waited // WIDEN_SECONDS)
+
+
+def bucket(ranking):
+    """
+    Get the queue bucket of a ranking.
+
+    Args:
+        ranking: The player's ranking.
+    Returns:
+        The bucket number.
+    """
+    return max(0, min(int(ranking * BUCKETS_PER_POINT), NUM_BUCKETS - 1))
+
+
+def _shard_key(b, index):
+    return '{}{}:{}'.format(_MEMCACHE_PREFIX, b, index)
+
+
+def _band_keys(b, band):
+    """Get the shard keys of the buckets in a band, nearest first."""
+    buckets = [b]
+    for distance in range(1, band + 1):
+        buckets.extend(near for near in (b - distance, b + distance)
+                       if 0 <= near < NUM_BUCKETS)
+    return [_shard_key(near, index)
+            for near in buckets for index in range(NUM_SHARDS)]
+
+
+def _change_list(key, change):
+    """
+    Change a waiting list with compare and set.
+
+    Args:
+        key: The memcache key of the list.
+        change: A function given the list that returns the new list, or
+        None to leave it alone.
+    Returns:
+        True if the list was changed, False otherwise.
+    """
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        waiting = client.gets(key)
+        if waiting is None:
+            new = change([])
+            if new is None:
+                return False
+            if client.add(key, new):
+                return True
+            continue
+        new = change(waiting)
+        if new is None:
+            return False
+        if client.cas(key, new):
+            return True
+    return False
+
+
+def _enqueue(ticket):
+    """Add a waiting player to a random shard of their bucket."""
+    user_id = ticket.player.id()
+    _change_list(_shard_key(ticket.bucket, random.randrange(NUM_SHARDS)),
+                 lambda waiting: waiting + [user_id])
+
+
+def _claim(key, user_id):
+    """Take a player off a waiting list. True if this caller removed them."""
+    def remove(waiting):
+        if user_id not in waiting:
+            return None
+        return [other for other in waiting if other != user_id]
+    return _change_list(key, remove)
+
+
+@ndb.transactional(xg=True)
+def _pair(ticket_key, opponent_key, now):
+    """
+    Match two waiting players and create their game. The player who has
+    waited longer moves first.
+
+    Returns:
+        The new TicTacToeGame, or None if either player is no longer
+        waiting.
+    """
+    ticket, opponent = ndb.get_multi([ticket_key, opponent_key])
+    if (ticket is None or opponent is None or not ticket.is_waiting(now) or
+            not opponent.is_waiting(now)):
+        return None
+    first, second = sorted((ticket, opponent), key=lambda t: t.joined)
+    game = TicTacToeGame.new_two_player_game(first.player, second.player)
+    ticket.game = game.key
+    opponent.game = game.key
+    ndb.put_multi([ticket, opponent])
+    return game
+
+
+def _find_match(ticket, now):
+    """
+    Look for an opponent in the band of a waiting player, and match them.
+
+    Returns:
+        A tuple of the player's TicTacToeGame, or None if no opponent was
+        found and the player is in the queue, and whether the game was
+        created by this call.
+    """
+    user_id = ticket.player.id()
+    keys = _band_keys(ticket.bucket, ticket.band(now))
+    lists = memcache.get_multi(keys)
+    queued = False
+    candidates = []
+    for key in keys:
+        for other_id in lists.get(key, []):
+            if other_id == user_id:
+                queued = True
+            else:
+                candidates.append((key, other_id))
+
+    for key, other_id in candidates[:MAX_CANDIDATES]:
+        # Whoever takes the opponent off the list tries the match, so two
+        # players do not try to match the same opponent at once
+        if not _claim(key, other_id):
+            continue
+        opponent_key = ndb.Key(MatchTicket, other_id)
+        game = _pair(ticket.key, opponent_key, now)
+        if game is not None:
+            gamecache.add_games([game])
+            if queued:
+                _remove(ticket)
+            return game, True
+        current, opponent = ndb.get_multi([ticket.key, opponent_key])
+        if opponent is not None and opponent.is_waiting(now):
+            # This player was matched by someone else in the meantime
+            _change_list(key, lambda waiting: waiting + [other_id])
+        if not current.is_waiting(now):
+            game = gamecache.get_game(current.game) if current.game else None
+            return game, False
+    if not queued:
+        _enqueue(ticket)
+    return None, False
+
+
+def _remove(ticket):
+    """Take a matched player off every shard of their bucket."""
+    user_id = ticket.player.id()
+    for index in range(NUM_SHARDS):
+        _claim(_shard_key(ticket.bucket, index), user_id)
+
+
+def join(player):
+    """
+    Put a player in the queue, matching them straight away if an opponent
+    of a similar ranking is waiting. A player who is already waiting keeps
+    their place.
+
+    Args:
+        player: The User key of the player.
+    Returns:
+        A tuple of the player's new TicTacToeGame, or None if they are
+        waiting, and whether the game was created by this call. A game is
+        created by whichever of its players finds the other.
+    """
+    now = datetime.utcnow()
+    key = MatchTicket.key_for(player)
+    ticket = key.get()
+    if ticket is None or not ticket.is_waiting(now):
+        ranking = TicTacToePlayerRanking.get_for_players([player])[0]
+        ticket = MatchTicket(key=key, player=player,
+                             bucket=bucket(ranking.ranking),
+                             joined=now, last_poll=now)
+        ticket.put()
+    return _find_match(ticket, now)
+
+
+def poll(player):
+    """
+    Check whether a player in the queue has been matched, and if not, look
+    again for an opponent with the band widened by the time they have
+    waited.
+
+    Args:
+        player: The User key of the player.
+    Returns:
+        A tuple of the player's TicTacToeGame, or None if they have not
+        been matched; whether they are in the queue or matched; and
+        whether the game was created by this call. A matched player
+        remains matched to their game until they join again.
+    """
+    now = datetime.utcnow()
+    ticket = _touch(MatchTicket.key_for(player), now)
+    if ticket is None:
+        return None, False, False
+    if ticket.game is not None:
+        return gamecache.get_game(ticket.game), True, False
+    if not ticket.is_waiting(now):
+        return None, False, False
+    game, created = _find_match(ticket, now)
+    return game, True, created
+
+
+@ndb.transactional
+def _touch(key, now):
+    """
+    Record that a waiting player has polled. Done in a transaction so that
+    a match made at the same time is not overwritten.
+    """
+    ticket = key.get()
+    if ticket is not None and ticket.is_waiting(now):
+        ticket.last_poll = now
+        ticket.put()
+    return ticket
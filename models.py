@@ -5,12 +5,79 @@ entities used by the Tic Tac Toe game.
 
 from datetime import date
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
-# Empty board used to initialize the board for a new game. Also used
-# to initialize the moves string.
+import bitboard
+import leaderboard
+import openings
+import solver
+import usercache
+
+# Empty board used to initialize the board for a new 3x3 game.
 EMPTY_BOARD = '         '
 
+# Name shown for the computer player in single player games.
+COMPUTER_NAME = 'Computer'
+
+# Positions of games are cached every this many moves, so a position can
+# be rebuilt by replaying at most this many moves from a cached one.
+POSITION_INTERVAL = 8
+
+# Number of game positions cached in memory on each instance.
+POSITION_CACHE_SIZE = 20000
+
+# (game key, number of moves) -> (player 1 mask, player 2 mask). Moves are
+# never changed once made, so a cached position never goes stale.
+_positions = usercache.LRUCache(POSITION_CACHE_SIZE)
+
+# Number of recent client move ids kept with each game, so that a retried
+# move is recognised as already made.
+MOVE_ID_HISTORY = 4
+
+# Seconds the version of a game is cached. Versions are cached as games
+# are saved, but expire so that a missed memcache update is soon noticed.
+VERSION_CACHE_TIME = 60
+
+_VERSION_MEMCACHE_PREFIX = 'game_version:'
+
+
+def _add_results(results, rankings):
+    """
+    Add game results to the player rankings.
+
+    Args:
+        results: A list of (player key, points) pairs.
+        rankings: The TicTacToePlayerRanking of the player of each result.
+        A player can appear more than once.
+    Returns:
+        A list of (old ranking, TicTacToePlayerRanking) pairs, one for
+        each player, for updating the leaderboard.
+    """
+    changes = {}
+    for (player, points), ranking in zip(results, rankings):
+        # The same player can have several results in a batch; use one
+        # entity for all of them.
+        if player not in changes:
+            changes[player] = (ranking.ranking, ranking)
+        changes[player][1].add_score(points)
+    return changes.values()
+
+
+def _player_name(names, key):
+    """
+    Get a player's name from a dict of user key to user name.
+
+    Args:
+        names: A dict of user key to user name.
+        key: The player's User key, or None for the computer player.
+    Returns:
+        The player's name.
+    """
+    if key is None:
+        return COMPUTER_NAME
+    return names[key]
+
 
 class User(ndb.Model):
     """User profile"""
@@ -30,60 +97,136 @@ class User(ndb.Model):
         """
         user = User(name=name, email=email)
         user.put()
+        usercache.user_names.set_multi({user.key: name})
+        usercache.user_keys.set_multi({name: user.key})
 
         # add an entry for the user in the player rankings
-        ranking = TicTacToePlayerRanking(player=user.key,
+        ranking_key = TicTacToePlayerRanking.key_for(user.key)
+        ranking = TicTacToePlayerRanking(key=ranking_key,
+                                         player=user.key,
                                          total_games=0,
                                          wins=0,
                                          draws=0,
                                          ranking=0.0)
         ranking.put()
+        leaderboard.queue_update([(None, ranking)])
 
         return user
 
-    def has_active_games(self):
+    @classmethod
+    @ndb.tasklet
+    def get_names_async(cls, keys):
         """
-        Determine if the user has any active games.
+        Look up the names of many users. Names are read from the user
+        cache, and any that are not cached are fetched with a single batch
+        get.
 
         Args:
-            None
+            keys: User keys. Duplicate and None keys are ignored.
         Returns:
-            True if the user has any games in progress,
-            False otherwise.
+            A future for a dict of user key to user name.
         """
-        count = TicTacToeGame.query(
-            TicTacToeGame.player1 == self.key,
-            TicTacToeGame.game_over is not True).count(1)
-        if count > 0:
-            return True
-        count = TicTacToeGame.query(
-            TicTacToeGame.player2 == self.key,
-            TicTacToeGame.game_over is not True).count(1)
-        if count > 0:
-            return True
-        return False
+        unique_keys = set(key for key in keys if key is not None)
+        names = yield usercache.user_names.get_multi_async(unique_keys)
+        missing = [key for key in unique_keys if key not in names]
+        if missing:
+            users = yield ndb.get_multi_async(missing)
+            fetched = dict((user.key, user.name) for user in users if user)
+            usercache.user_names.set_multi(fetched)
+            names.update(fetched)
+        raise ndb.Return(names)
+
+    @classmethod
+    def get_names(cls, keys):
+        """
+        Look up the names of many users. Names are read from the user
+        cache, and any that are not cached are fetched with a single batch
+        get.
+
+        Args:
+            keys: User keys. Duplicate and None keys are ignored.
+        Returns:
+            names: A dict of user key to user name.
+        """
+        return cls.get_names_async(keys).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_key_by_name_async(cls, name):
+        """
+        Look up a user's key by name, using the user cache.
+
+        Args:
+            name: The user name.
+        Returns:
+            A future for the user's key, or None if there is no user with
+            the name.
+        """
+        key = yield usercache.user_keys.get_async(name)
+        if key is None:
+            key = yield User.query(User.name == name).get_async(
+                keys_only=True)
+            if key is not None:
+                usercache.user_keys.set_multi({name: key})
+                usercache.user_names.set_multi({key: name})
+        raise ndb.Return(key)
+
+    @classmethod
+    def get_key_by_name(cls, name):
+        """
+        Look up a user's key by name, using the user cache.
+
+        Args:
+            name: The user name.
+        Returns:
+            key: The user's key, or None if there is no user with the name.
+        """
+        return cls.get_key_by_name_async(name).get_result()
 
 
 class TicTacToeGame(ndb.Model):
     """This class represents a Tic Tac Toe game."""
     player1 = ndb.KeyProperty(required=True, kind='User')
-    player2 = ndb.KeyProperty(required=True, kind='User')
+    player2 = ndb.KeyProperty(required=False, kind='User')
     player1_symbol = ndb.StringProperty(required=True, default='X')
     player2_symbol = ndb.StringProperty(required=True, default='O')
     number_of_moves = ndb.IntegerProperty(required=True, default=0)
     game_over = ndb.BooleanProperty(required=True, default=False)
     board = ndb.StringProperty(required=True, default=EMPTY_BOARD)
-    moves = ndb.StringProperty(required=True, default=EMPTY_BOARD)
+    # The squares played, in order, packed shape.move_bytes bytes each.
+    move_log = ndb.BlobProperty()
+    # The squares played as a string of digits, as games saved before the
+    # move log was added stored them. It is replaced by the move log on
+    # the next move.
+    moves = ndb.StringProperty(indexed=False)
+    width = ndb.IntegerProperty(required=True, default=3)
+    height = ndb.IntegerProperty(required=True, default=3)
+    win_length = ndb.IntegerProperty(required=True, default=3)
+    computer_game = ndb.BooleanProperty(required=True, default=False)
+    difficulty = ndb.StringProperty(required=False,
+                                    choices=solver.DIFFICULTIES)
+    # Both players, so a user's games can be found with one query.
+    players = ndb.ComputedProperty(
+        lambda self: [key for key in (self.player1, self.player2) if key],
+        repeated=True)
+    # Goes up by one with every move, so clients can tell if the game has
+    # changed since they last saw it.
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    # The client move ids of the latest moves, oldest first.
+    move_ids = ndb.StringProperty(repeated=True, indexed=False)
 
     @classmethod
-    def new_two_player_game(cls, player1, player2):
+    @ndb.tasklet
+    def new_two_player_game_async(cls, player1, player2,
+                                  shape=bitboard.STANDARD):
         """
         Create a new Tic Tac Toe game initialized for two players.
 
         Args:
-            player1, player2: User objects for the two players.
+            player1, player2: User keys for the two players.
+            shape: The bitboard.Shape of the board.
         Returns:
-            game: The newly created game.
+            A future for the newly created game.
         """
         game = TicTacToeGame(player1=player1,
                              player2=player2,
@@ -91,41 +234,192 @@ class TicTacToeGame(ndb.Model):
                              player2_symbol='O',
                              number_of_moves=0,
                              game_over=False,
+                             board=shape.empty_board,
+                             move_log='',
+                             width=shape.width,
+                             height=shape.height,
+                             win_length=shape.win_length)
+
+        yield game.put_async()
+        raise ndb.Return(game)
+
+    @classmethod
+    def new_two_player_game(cls, player1, player2, shape=bitboard.STANDARD):
+        """
+        Create a new Tic Tac Toe game initialized for two players.
+
+        Args:
+            player1, player2: User keys for the two players.
+            shape: The bitboard.Shape of the board.
+        Returns:
+            game: The newly created game.
+        """
+        return cls.new_two_player_game_async(player1, player2,
+                                             shape).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def new_single_player_game_async(cls, player1,
+                                     difficulty=solver.PERFECT):
+        """
+        Create a new Tic Tac Toe game against the computer. The user is
+        player 1 and always moves first. The game is played on a 3x3
+        board, which is the only board the computer can play.
+
+        Args:
+            player1: User key of the player.
+            difficulty: How well the computer plays.
+        Returns:
+            A future for the newly created game.
+        """
+        game = TicTacToeGame(player1=player1,
+                             player2=None,
+                             player1_symbol='X',
+                             player2_symbol='O',
+                             number_of_moves=0,
+                             game_over=False,
                              board=EMPTY_BOARD,
-                             moves=EMPTY_BOARD)
+                             move_log='',
+                             computer_game=True,
+                             difficulty=difficulty)
+
+        yield game.put_async()
+        raise ndb.Return(game)
+
+    @classmethod
+    def new_single_player_game(cls, player1, difficulty=solver.PERFECT):
+        """
+        Create a new Tic Tac Toe game against the computer. The user is
+        player 1 and always moves first.
+
+        Args:
+            player1: User key of the player.
+            difficulty: How well the computer plays.
+        Returns:
+            game: The newly created game.
+        """
+        return cls.new_single_player_game_async(player1,
+                                                difficulty).get_result()
 
-        game.put()
-        return game
+    def player_names(self, names=None):
+        """
+        Get the names of the two players.
+
+        Args:
+            names: Optional dict of user key to user name, as returned by
+            User.get_names. If it is not given, the names are looked up.
+        Returns:
+            A tuple of the player 1 and player 2 names. Player 2 is named
+            COMPUTER_NAME in a single player game.
+        """
+        if names is None:
+            names = User.get_names([self.player1, self.player2])
+        return (names[self.player1], _player_name(names, self.player2))
 
     def cancel_game(self):
         """
         Delete a game from the datastore.
         """
-        self.key.delete()
+        self.cancel_game_async().get_result()
+
+    @ndb.tasklet
+    def cancel_game_async(self):
+        """
+        Delete a game from the datastore.
 
-    def to_form(self, message=""):
+        Returns:
+            A future that is done when the game has been deleted.
+        """
+        yield (self.key.delete_async(),
+               memcache.Client().delete_async(
+                   _VERSION_MEMCACHE_PREFIX + self.key.urlsafe()))
+
+    @classmethod
+    def cache_versions(cls, games, replace=True):
+        """
+        Cache the versions of games, so clients polling for changes can be
+        answered without reading the games.
+
+        Args:
+            games: The saved TicTacToeGame entities.
+            replace: False to only cache the versions of games that are not
+            already cached, for a version read from the datastore that may
+            be older than one being cached by a save.
+        Returns:
+            None
+        """
+        versions = dict((game.key.urlsafe(), game.version) for game in games)
+        if replace:
+            memcache.set_multi(versions, time=VERSION_CACHE_TIME,
+                               key_prefix=_VERSION_MEMCACHE_PREFIX)
+        else:
+            memcache.add_multi(versions, time=VERSION_CACHE_TIME,
+                               key_prefix=_VERSION_MEMCACHE_PREFIX)
+
+    @classmethod
+    def get_cached_version_async(cls, key):
+        """
+        Get the cached version of a game.
+
+        Args:
+            key: The key of the game.
+        Returns:
+            A future for the version, or None if it is not cached.
+        """
+        return memcache.Client().get_async(
+            _VERSION_MEMCACHE_PREFIX + key.urlsafe())
+
+    def to_form(self, message="", names=None):
         """
         Returns a TicTacToeGameForm representation of the game.
 
         Args:
             message: A message to put into the game form.
+            names: Optional dict of user key to user name. Pass this when
+            building many forms so the names are looked up only once.
         Returns:
             form: The newly created form.
         """
+        player1_name, player2_name = self.player_names(names)
         form = TicTacToeGameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.player1_name = self.player1.get().name
+        form.player1_name = player1_name
         form.player1_symbol = self.player1_symbol
-        form.player2_name = self.player2.get().name
+        form.player2_name = player2_name
         form.player2_symbol = self.player2_symbol
         form.number_of_moves = self.number_of_moves
         form.game_over = self.game_over
         form.message = message
         form.board = self.board
-        form.moves = self.moves
+        form.moves = self.get_moves_string()
+        form.computer_game = self.computer_game
+        form.difficulty = self.difficulty
+        form.width = self.width
+        form.height = self.height
+        form.win_length = self.win_length
+        form.version = self.version
 
         return form
 
+    @ndb.tasklet
+    def to_form_async(self, message=""):
+        """
+        Returns a future for a TicTacToeGameForm representation of the
+        game.
+
+        Args:
+            message: A message to put into the game form.
+        Returns:
+            A future for the newly created form.
+        """
+        names = yield User.get_names_async([self.player1, self.player2])
+        raise ndb.Return(self.to_form(message, names))
+
+    @property
+    def shape(self):
+        """The bitboard.Shape of the game's board."""
+        return bitboard.get_shape(self.width, self.height, self.win_length)
+
     def next_to_move(self):
         """
         Get the next player to move.
@@ -142,7 +436,9 @@ class TicTacToeGame(ndb.Model):
 
     def end_game(self, winner):
         """
-        Ends the game.
+        Ends the game. The score of the game is created but not saved;
+        it is saved along with the players' rankings by save or
+        save_games.
 
         Args:
             winner: The symbol of the player who won the game,
@@ -151,85 +447,221 @@ class TicTacToeGame(ndb.Model):
             None
         """
         self.game_over = True
-        self.put()
-
-        # Calculate scores and rankings for each player. Players get 3 points
-        # for a win, 1 point for a draw, and 0 points for a loss.
-        # Ranking is the total score for all games divided by the number
-        # of games
-
-        # fetch each player's ranking
-        player1_ranking = TicTacToePlayerRanking.query(
-            TicTacToePlayerRanking.player == self.player1).get()
-        player2_ranking = TicTacToePlayerRanking.query(
-            TicTacToePlayerRanking.player == self.player2).get()
 
+        # Calculate scores for each player. Players get 3 points for a win,
+        # 1 point for a draw, and 0 points for a loss.
         if winner == 'Draw':
             player1_score = 1
-            player1_ranking.add_draw()
             player2_score = 1
-            player2_ranking.add_draw()
+        elif self.player1_symbol == winner:
+            player1_score = 3
+            player2_score = 0
         else:
-            if self.player1_symbol == winner:
-                player1_score = 3
-                player1_ranking.add_win()
-                player2_score = 0
-                player2_ranking.add_loss()
-            else:
-                player1_score = 0
-                player1_ranking.add_loss()
-                player2_score = 3
-                player2_ranking.add_win()
+            player1_score = 0
+            player2_score = 3
 
         # Add the game to the scoreboard
-        score = TicTacToeScore(player1=self.player1,
-                               player2=self.player2,
-                               player1_symbol=self.player1_symbol,
-                               player2_symbol=self.player2_symbol,
-                               player1_score=player1_score,
-                               player2_score=player2_score,
-                               date=date.today(),
-                               winner=winner,
-                               number_of_moves=self.number_of_moves,
-                               game=self.key)
-        score.put()
-
-        # udpate each player's rankings
-        player1_ranking.put()
-        player2_ranking.put()
+        self._score = TicTacToeScore(player1=self.player1,
+                                     player2=self.player2,
+                                     player1_symbol=self.player1_symbol,
+                                     player2_symbol=self.player2_symbol,
+                                     player1_score=player1_score,
+                                     player2_score=player2_score,
+                                     date=date.today(),
+                                     winner=winner,
+                                     number_of_moves=self.number_of_moves,
+                                     game=self.key)
+
+    def _pending_results(self):
+        """
+        Get the unsaved results of the game if it has just ended.
+
+        Returns:
+            A tuple of the unsaved TicTacToeScore, or None, and a list of
+            (player key, points) pairs for the rankings. Games against the
+            computer are recorded on the scoreboard but do not count
+            towards the player rankings.
+        """
+        score = getattr(self, '_score', None)
+        if score is None or self.computer_game:
+            return score, []
+        return score, [(score.player1, score.player1_score),
+                       (score.player2, score.player2_score)]
+
+    def add_move_id(self, move_id):
+        """
+        Remember the client move id of a move that has just been made.
+
+        Args:
+            move_id: The id the client gave the move, or None.
+        Returns:
+            None
+        """
+        if move_id:
+            self.move_ids = (self.move_ids + [move_id])[-MOVE_ID_HISTORY:]
+
+    def save(self):
+        """
+        Save the game. If the game has just ended, its score and the
+        players' rankings are saved in the same cross-group transaction,
+        so a game can never end without its results being recorded. Its
+        moves are queued to be added to the opening counts, and the
+        leaderboard is queued to be updated, in the same transaction.
+
+        Args:
+            None
+        Returns:
+            None
+        Raises:
+            ValueError: If a player's ranking cannot be found, in which
+            case nothing is saved.
+        """
+        score, results = self._pending_results()
+        if score is None:
+            self.put()
+            TicTacToeGame.cache_versions([self])
+            return
+
+        # A player can play against themselves, so each ranking is read
+        # and written once
+        ranking_keys = [TicTacToePlayerRanking.key_for(player)
+                        for player, _ in results]
+        unique_keys = list(set(ranking_keys))
+
+        @ndb.transactional(xg=True)
+        def _save():
+            rankings = ndb.get_multi(unique_keys)
+            if None in rankings:
+                return None
+            rankings = dict(zip(unique_keys, rankings))
+            changes = _add_results(results,
+                                   [rankings[key] for key in ranking_keys])
+            ndb.put_multi([self, score] +
+                          [ranking for _, ranking in changes])
+            openings.queue_games([self], transactional=True)
+            if changes:
+                leaderboard.queue_update(changes, transactional=True)
+            return changes
+
+        changes = _save()
+        if changes is None:
+            # Rankings created before they were keyed by user id are
+            # moved to their new keys, then the save is tried again.
+            TicTacToePlayerRanking.get_for_players(
+                [player for player, _ in results])
+            changes = _save()
+            if changes is None:
+                raise ValueError(
+                    'The rankings of the players of game {} are '
+                    'missing'.format(self.key.urlsafe()))
+        self._score = None
+        TicTacToeGame.cache_versions([self])
+
+    @classmethod
+    def save_games(cls, games):
+        """
+        Save many games, with the scores and players' rankings of any
+        that have just ended, in a single batch put.
+
+        Args:
+            games: The TicTacToeGame entities to save.
+        Returns:
+            None
+        """
+        games = list(games)
+        entities = list(games)
+        results = []
+        ended = []
+        for game in games:
+            score, game_results = game._pending_results()
+            if score is not None:
+                entities.append(score)
+                results.extend(game_results)
+                ended.append(game)
+            game._score = None
+
+        changes = []
+        if results:
+            rankings = TicTacToePlayerRanking.get_for_players(
+                [player for player, _ in results])
+            changes = _add_results(results, rankings)
+            entities.extend(ranking for _, ranking in changes)
+        ndb.put_multi(entities)
+        cls.cache_versions(games)
+        if changes:
+            leaderboard.queue_update(changes)
+        if ended:
+            openings.queue_games(ended)
+
+    def get_masks(self):
+        """
+        Get the bitboard masks for the two players.
+
+        The masks are derived from the board string and cached on the
+        entity until the board changes.
+
+        Args:
+            None
+        Returns:
+            A tuple of the player 1 and player 2 bitmasks.
+        """
+        board = self.board
+        cached = getattr(self, '_bitboard_cache', None)
+        if cached is None or cached[0] is not board:
+            shape = self.shape
+            cached = (board,
+                      shape.board_to_mask(board, self.player1_symbol),
+                      shape.board_to_mask(board, self.player2_symbol))
+            self._bitboard_cache = cached
+        return cached[1], cached[2]
+
+    def _set_masks(self, mask1, mask2):
+        """
+        Store new bitboard masks, updating the board string to match.
+
+        Args:
+            mask1, mask2: The bitmasks of the two players.
+        Returns:
+            None
+        """
+        self.board = self.shape.mask_to_board(mask1, self.player1_symbol,
+                                              mask2, self.player2_symbol)
+        self._bitboard_cache = (self.board, mask1, mask2)
 
     def is_winner(self, player_symbol):
         """
         Determine if the player indicated by the given symbol is the winner.
-        
+
         Args:
             player_symbol: The symbol of the player to test.
         Returns:
             True if the player has won or False otherwise.
         """
+        mask1, mask2 = self.get_masks()
+        if player_symbol == self.player1_symbol:
+            mask = mask1
+        elif player_symbol == self.player2_symbol:
+            mask = mask2
+        else:
+            return False
+        shape = self.shape
+        if shape is bitboard.STANDARD:
+            return bitboard.is_win(mask)
+        return any(shape.is_win_at(mask, square)
+                   for square, bit in enumerate(shape.square_masks)
+                   if mask & bit)
+
+    def is_square_occupied(self, square):
+        """
+        Determine if the given square is taken.
 
-        winning_string = player_symbol * 3
-        # Check each row for for a winning string
-        if ((winning_string == self.board[0:3]) or
-            (winning_string == self.board[3:6]) or
-                (winning_string == self.board[6:9])):
-            return True
-        # Check each column for a winning string
-        if ((winning_string == self.board[0:1] + self.board[3:4] +
-             self.board[6:7]) or
-            (winning_string == self.board[1:2] + self.board[4:5] +
-             self.board[7:8]) or
-            (winning_string == self.board[2:3] + self.board[5:6] +
-             self.board[8:9])):
-            return True
-        # Check each diagonal for a winning string
-        if ((winning_string == self.board[0:1] + self.board[4:5] +
-             self.board[8:9]) or
-            (winning_string == self.board[2:3] + self.board[4:5] +
-             self.board[6:7])):
-            return True
-
-        return False
+        Args:
+            square: The square to test.
+        Returns:
+            True if either player occupies the square, False otherwise.
+        """
+        mask1, mask2 = self.get_masks()
+        return bool((mask1 | mask2) & 1 << square)
 
     def get_square(self, square):
         """
@@ -241,12 +673,116 @@ class TicTacToeGame(ndb.Model):
             the player's symbol that occupies the square or ' '
             if the square is unoccupied.
         """
-        return self.board[square:square + 1]
+        mask1, mask2 = self.get_masks()
+        bit = 1 << square
+        if mask1 & bit:
+            return self.player1_symbol
+        if mask2 & bit:
+            return self.player2_symbol
+        return ' '
+
+    def get_moves(self):
+        """
+        Get the squares played in the game.
+
+        Args:
+            None
+        Returns:
+            The list of squares, in the order they were played.
+        """
+        if self.move_log is None:
+            return self.shape.decode_moves(self.moves or '')
+        return self.shape.unpack_moves(self.move_log)
+
+    def get_moves_string(self):
+        """
+        Get the squares played as a string, each written as
+        shape.move_width base 36 digits. A 3x3 game's string is padded
+        with spaces to 9 characters.
+
+        Args:
+            None
+        Returns:
+            The moves string.
+        """
+        shape = self.shape
+        moves = ''.join(shape.encode_move(square)
+                        for square in self.get_moves())
+        if shape is bitboard.STANDARD:
+            moves = moves.ljust(len(EMPTY_BOARD))
+        return moves
+
+    def get_position(self, ply):
+        """
+        Get the position after a number of moves. Positions are cached
+        every POSITION_INTERVAL moves, and at each ply asked for, so a
+        position is rebuilt by replaying a few moves from a cached one.
+
+        Args:
+            ply: The number of moves, from 0 to number_of_moves.
+        Returns:
+            A tuple of the player 1 and player 2 bitmasks.
+        """
+        if ply == self.number_of_moves:
+            return self.get_masks()
+        cached = _positions.get((self.key, ply))
+        if cached is not None:
+            return cached
+
+        # Start from the latest cached position at or before the ply
+        start = ply - ply % POSITION_INTERVAL
+        while start > 0:
+            cached = _positions.get((self.key, start))
+            if cached is not None:
+                break
+            start -= POSITION_INTERVAL
+        else:
+            start = 0
+            cached = (0, 0)
+
+        mask1, mask2 = cached
+        squares = self.get_moves()
+        shape = self.shape
+        for n in range(start, ply):
+            if n % 2 == 0:
+                mask1 |= shape.square_masks[squares[n]]
+            else:
+                mask2 |= shape.square_masks[squares[n]]
+            if (n + 1) % POSITION_INTERVAL == 0:
+                _positions.put((self.key, n + 1), (mask1, mask2))
+        _positions.put((self.key, ply), (mask1, mask2))
+        return mask1, mask2
 
-    def make_move(self, player_symbol, square):
+    def get_position_form(self, ply):
+        """
+        Get the board after a number of moves in a TicTacToePositionForm.
+
+        Args:
+            ply: The number of moves, from 0 to number_of_moves.
+        Returns:
+            TicTacToePositionForm: The board after the moves.
+        """
+        mask1, mask2 = self.get_position(ply)
+        form = TicTacToePositionForm(
+            urlsafe_key=self.key.urlsafe(),
+            ply=ply,
+            number_of_moves=self.number_of_moves,
+            board=self.shape.mask_to_board(mask1, self.player1_symbol,
+                                           mask2, self.player2_symbol))
+        if ply > 0:
+            form.last_square = self.get_moves()[ply - 1]
+        if ply < self.number_of_moves or not self.game_over:
+            if ply % 2 == 0:
+                form.next_to_move = self.player1_symbol
+            else:
+                form.next_to_move = self.player2_symbol
+        return form
+
+    def apply_move(self, player_symbol, square):
         """
         Make a tic-tac-toe move by marking a player's symbol into a given
-        square.
+        square. The game itself is not saved, so several moves or games
+        can be saved together by the caller.
 
         Args:
             player_symbol: The player's symbol.
@@ -256,58 +792,80 @@ class TicTacToeGame(ndb.Model):
         """
         if not self.game_over:
             # mark the symbol on the board
-            boardlist = list(self.board)
-            boardlist[square] = player_symbol
-            self.board = "".join(boardlist)
+            shape = self.shape
+            mask1, mask2 = self.get_masks()
+            bit = shape.square_masks[square]
+            if player_symbol == self.player1_symbol:
+                mask1 |= bit
+                player_mask = mask1
+            else:
+                mask2 |= bit
+                player_mask = mask2
+            self._set_masks(mask1, mask2)
 
             # save the move
-            moveslist = list(self.moves)
-            moveslist[self.number_of_moves] = str(square)
-            self.moves = "".join(moveslist)
+            if self.move_log is None:
+                self.move_log = shape.pack_moves(self.get_moves())
+                self.moves = None
+            self.move_log += shape.pack_moves([square])
 
-            self.number_of_moves = self.number_of_moves + 1
+            self.number_of_moves += 1
+            self.version += 1
 
-            # determine if the move has created a winner
-            if self.is_winner(player_symbol):
+            # determine if the move has created a winner; only the lines
+            # through the square just played need to be checked
+            if shape.is_win_at(player_mask, square):
                 self.end_game(player_symbol)
                 message = "Game over, {} wins!".format(player_symbol)
-            elif self.number_of_moves >= 9:
+            elif shape.is_full(mask1 | mask2):
                 self.end_game('Draw')
                 message = "Game over, it's a draw!"
             else:
                 message = "{} moved, it's {}'s turn.".format(
                     player_symbol,
                     self.next_to_move())
-            self.put()
             return message
 
-    def get_game_history_form(self):
+    def apply_computer_move(self):
         """
-        Get the game history in a TicTacToeGameHistoryForm.
+        Make the computer player's reply in a single player game. Like
+        apply_move, the game is not saved.
 
         Args:
             None
+        Return:
+            A message about the game state.
+        """
+        mask1, mask2 = self.get_masks()
+        square = solver.choose_move(mask2, mask1, self.difficulty)
+        return self.apply_move(self.player2_symbol, square)
+
+    def get_game_history_form(self, names=None):
+        """
+        Get the game history in a TicTacToeGameHistoryForm.
+
+        Args:
+            names: Optional dict of user key to user name.
         Returns:
             TicTacToGameHistoryForm: A form containing a representation
             of the game history.
         """
-        moveslist = list(self.moves)
         movesFormList = []
         move_number = 1
-        for move in moveslist:
-            if move != ' ':
-                if (move_number % 2 == 0):
-                    player_symbol = self.player2_symbol
-                else:
-                    player_symbol = self.player1_symbol
-                movesFormList.append(TicTacToeSingleMoveForm(
-                    move_number=move_number,
-                    player_symbol=player_symbol,
-                    square=int(move)))
-                move_number += 1
-        return TicTacToeGameHistoryForm(player1_name=self.player1.get().name,
+        for square in self.get_moves():
+            if (move_number % 2 == 0):
+                player_symbol = self.player2_symbol
+            else:
+                player_symbol = self.player1_symbol
+            movesFormList.append(TicTacToeSingleMoveForm(
+                move_number=move_number,
+                player_symbol=player_symbol,
+                square=square))
+            move_number += 1
+        player1_name, player2_name = self.player_names(names)
+        return TicTacToeGameHistoryForm(player1_name=player1_name,
                                         player1_symbol=self.player1_symbol,
-                                        player2_name=self.player2.get().name,
+                                        player2_name=player2_name,
                                         player2_symbol=self.player2_symbol,
                                         moves=movesFormList)
 
@@ -326,19 +884,30 @@ class TicTacToeScore(ndb.Model):
     winner = ndb.StringProperty(required=True)
     number_of_moves = ndb.IntegerProperty(required=True)
     game = ndb.KeyProperty(required=True, kind='TicTacToeGame')
-
-    def to_form(self):
+    # The day the score was saved, which is later than its date for
+    # imported games. Exports are checkpointed on it.
+    created = ndb.DateProperty(auto_now_add=True)
+    # Both players, so a user's scores can be found with one query.
+    players = ndb.ComputedProperty(
+        lambda self: [key for key in (self.player1, self.player2) if key],
+        repeated=True)
+
+    def to_form(self, names=None):
         """
         Get a form representation of the game score.
 
         Args:
-            None
+            names: Optional dict of user key to user name. Pass this when
+            building many forms so the names are looked up only once.
         Returns:
             TicTacToeScoreForm: A form containing the game score
             information.
         """
-        return TicTacToeScoreForm(player1_name=self.player1.get().name,
-                                  player2_name=self.player2.get().name,
+        if names is None:
+            names = User.get_names([self.player1, self.player2])
+        return TicTacToeScoreForm(player1_name=names[self.player1],
+                                  player2_name=_player_name(names,
+                                                            self.player2),
                                   player1_symbol=self.player1_symbol,
                                   player2_symbol=self.player2_symbol,
                                   player1_score=self.player1_score,
@@ -359,6 +928,53 @@ class TicTacToePlayerRanking(ndb.Model):
     draws = ndb.IntegerProperty(required=True, default=0)
     ranking = ndb.FloatProperty(required=True, default=0.0)
 
+    @classmethod
+    def key_for(cls, player):
+        """
+        Get the key of a player's ranking. Rankings are keyed by the id of
+        the user, so they can be fetched without a query.
+
+        Args:
+            player: The User key of the player.
+        Returns:
+            The key of the player's TicTacToePlayerRanking.
+        """
+        return ndb.Key(cls, player.id())
+
+    @classmethod
+    def get_for_players(cls, players):
+        """
+        Get the rankings of many players with a single batch get.
+
+        A ranking created before rankings were keyed by user id is found
+        with a query and moved to its new key.
+
+        Args:
+            players: User keys of the players.
+        Returns:
+            The TicTacToePlayerRanking of each player, in the same order.
+        """
+        rankings = ndb.get_multi([cls.key_for(player) for player in players])
+        for i, player in enumerate(players):
+            if rankings[i] is not None:
+                continue
+            old = cls.query(cls.player == player).get()
+            ranking = cls(key=cls.key_for(player), player=player)
+            if old is not None:
+                ranking.populate(total_games=old.total_games,
+                                 wins=old.wins,
+                                 draws=old.draws,
+                                 ranking=old.ranking)
+            ranking.put()
+            if old is not None and old.key != ranking.key:
+                old.key.delete()
+            rankings[i] = ranking
+            # the same player can appear more than once
+            for j in range(i + 1, len(players)):
+                if players[j] == player:
+                    rankings[j] = ranking
+        return rankings
+
     def getScore(self):
         """
         Get the total score for this player.
@@ -394,8 +1010,34 @@ class TicTacToePlayerRanking(ndb.Model):
         self.total_games += 1
         self.calculateRanking()
 
-    def to_form(self):
-        return TicTacToePlayerRankingForm(player_name=self.player.get().name,
+    def add_score(self, score):
+        """
+        Add a game result to the player's ranking.
+
+        Args:
+            score: The points the player got for the game: 3 for a win,
+            1 for a draw or 0 for a loss.
+        """
+        if score == 3:
+            self.add_win()
+        elif score == 1:
+            self.add_draw()
+        else:
+            self.add_loss()
+
+    def to_form(self, names=None):
+        """
+        Get a form representation of the player's ranking.
+
+        Args:
+            names: Optional dict of user key to user name. Pass this when
+            building many forms so the names are looked up only once.
+        Returns:
+            TicTacToePlayerRankingForm: A form containing the ranking.
+        """
+        if names is None:
+            names = User.get_names([self.player])
+        return TicTacToePlayerRankingForm(player_name=names[self.player],
                                           total_games=self.total_games,
                                           wins=self.wins,
                                           draws=self.draws,
@@ -414,6 +1056,12 @@ class TicTacToeGameForm(messages.Message):
     message = messages.StringField(9, required=True)
     board = messages.StringField(10, required=True)
     moves = messages.StringField(11, required=True)
+    computer_game = messages.BooleanField(12, required=True)
+    difficulty = messages.StringField(13, required=False)
+    width = messages.IntegerField(14, required=True)
+    height = messages.IntegerField(15, required=True)
+    win_length = messages.IntegerField(16, required=True)
+    version = messages.IntegerField(17, required=True)
 
 
 class TicTacToeGameForms(messages.Message):
@@ -421,6 +1069,17 @@ class TicTacToeGameForms(messages.Message):
     Return multiple TicTactoeGameForm.
     """
     games = messages.MessageField(TicTacToeGameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2, required=False)
+
+
+class TicTacToeGameChangesForm(messages.Message):
+    """
+    Whether a game has changed since the version a client last saw, and
+    the game if it has.
+    """
+    modified = messages.BooleanField(1, required=True)
+    version = messages.IntegerField(2, required=True)
+    game = messages.MessageField(TicTacToeGameForm, 3, required=False)
 
 
 class TicTacToeNewGameForm(messages.Message):
@@ -429,6 +1088,10 @@ class TicTacToeNewGameForm(messages.Message):
     """
     player1_name = messages.StringField(1, required=True)
     player2_name = messages.StringField(2, required=False)
+    difficulty = messages.StringField(3, required=False)
+    width = messages.IntegerField(4, default=3)
+    height = messages.IntegerField(5, default=3)
+    win_length = messages.IntegerField(6, default=3)
 
 
 class TicTacToeMakeMoveForm(messages.Message):
@@ -437,6 +1100,55 @@ class TicTacToeMakeMoveForm(messages.Message):
     """
     player_symbol = messages.StringField(1, required=True)
     square = messages.IntegerField(2, required=True)
+    # The version of the game the move was chosen against. The move is
+    # rejected if the game has changed since.
+    expected_version = messages.IntegerField(3, required=False)
+    # A client chosen id, so a retried move is not made twice.
+    move_id = messages.StringField(4, required=False)
+
+
+class TicTacToeBatchMoveForm(messages.Message):
+    """
+    A single move in a batch of moves.
+    """
+    urlsafe_game_key = messages.StringField(1, required=True)
+    player_symbol = messages.StringField(2, required=True)
+    square = messages.IntegerField(3, required=True)
+
+
+class TicTacToeBatchMoveForms(messages.Message):
+    """
+    Used to make moves in many games at once.
+    """
+    moves = messages.MessageField(TicTacToeBatchMoveForm, 1, repeated=True)
+
+
+class TicTacToeBatchMoveResultForm(messages.Message):
+    """
+    The result of a single move in a batch. Contains either the game
+    state after the move or an error message.
+    """
+    urlsafe_game_key = messages.StringField(1, required=True)
+    game = messages.MessageField(TicTacToeGameForm, 2, required=False)
+    error = messages.StringField(3, required=False)
+
+
+class TicTacToeBatchMoveResultForms(messages.Message):
+    """
+    Return the results of a batch of moves, in the same order as the moves.
+    """
+    items = messages.MessageField(TicTacToeBatchMoveResultForm, 1,
+                                  repeated=True)
+
+
+class TicTacToeMatchForm(messages.Message):
+    """
+    A player's place in the matchmaking queue, and their game once they
+    have been matched.
+    """
+    matched = messages.BooleanField(1, required=True)
+    game = messages.MessageField(TicTacToeGameForm, 2, required=False)
+    message = messages.StringField(3, required=True)
 
 
 class TicTacToeScoreForm(messages.Message):
@@ -460,6 +1172,7 @@ class TicTacToeScoreForms(messages.Message):
     Return multiple TicTacToeScoreForms.
     """
     items = messages.MessageField(TicTacToeScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2, required=False)
 
 
 class TicTacToePlayerRankingForm(messages.Message):
@@ -478,6 +1191,17 @@ class TicTacToePlayerRankingForms(messages.Message):
     Return multiple TicTacToePlayerRankingForms.
     """
     items = messages.MessageField(TicTacToePlayerRankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2, required=False)
+
+
+class TicTacToePlayerRankForm(messages.Message):
+    """
+    A player's position on the leaderboard.
+    """
+    player_name = messages.StringField(1, required=True)
+    rank = messages.IntegerField(2, required=True)
+    total_players = messages.IntegerField(3, required=True)
+    ranking = messages.FloatField(4, required=True)
 
 
 class TicTacToeSingleMoveForm(messages.Message):
@@ -489,6 +1213,39 @@ class TicTacToeSingleMoveForm(messages.Message):
     square = messages.IntegerField(3, required=True)
 
 
+class TicTacToePositionForm(messages.Message):
+    """
+    The board of a game after a number of moves.
+    """
+    urlsafe_key = messages.StringField(1, required=True)
+    ply = messages.IntegerField(2, required=True)
+    number_of_moves = messages.IntegerField(3, required=True)
+    board = messages.StringField(4, required=True)
+    last_square = messages.IntegerField(5, required=False)
+    next_to_move = messages.StringField(6, required=False)
+
+
+class TicTacToeOpeningMoveForm(messages.Message):
+    """
+    The results of the games in which a move was played from a position,
+    from the point of view of the player who made the move.
+    """
+    square = messages.IntegerField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    draws = messages.IntegerField(4, required=True)
+    losses = messages.IntegerField(5, required=True)
+
+
+class TicTacToeOpeningForms(messages.Message):
+    """
+    Every move played from a position.
+    """
+    board = messages.StringField(1, required=True)
+    next_to_move = messages.StringField(2, required=True)
+    items = messages.MessageField(TicTacToeOpeningMoveForm, 3, repeated=True)
+
+
 class TicTacToeGameHistoryForm(messages.Message):
     """
     Show the move history of a game.
@@ -500,6 +1257,57 @@ class TicTacToeGameHistoryForm(messages.Message):
     moves = messages.MessageField(TicTacToeSingleMoveForm, 5, repeated=True)
 
 
+class CacheStatsForm(messages.Message):
+    """
+    Hit and miss counters of a cache.
+    """
+    name = messages.StringField(1, required=True)
+    size = messages.IntegerField(2, required=True)
+    max_size = messages.IntegerField(3, required=True)
+    lru_hits = messages.IntegerField(4, required=True)
+    memcache_hits = messages.IntegerField(5, required=True)
+    misses = messages.IntegerField(6, required=True)
+    evictions = messages.IntegerField(7, required=True)
+
+
+class CacheStatsForms(messages.Message):
+    """
+    Return multiple CacheStatsForm.
+    """
+    items = messages.MessageField(CacheStatsForm, 1, repeated=True)
+
+
+class EndpointStatsForm(messages.Message):
+    """
+    Latency and mean RPCs per call of an API endpoint.
+    """
+    name = messages.StringField(1, required=True)
+    calls = messages.IntegerField(2, required=True)
+    errors = messages.IntegerField(3, required=True)
+    mean_ms = messages.FloatField(4, required=True)
+    p50_ms = messages.FloatField(5, required=True)
+    p95_ms = messages.FloatField(6, required=True)
+    p99_ms = messages.FloatField(7, required=True)
+    max_ms = messages.FloatField(8, required=True)
+    datastore_gets = messages.FloatField(9, required=True)
+    datastore_puts = messages.FloatField(10, required=True)
+    datastore_queries = messages.FloatField(11, required=True)
+    datastore_other = messages.FloatField(12, required=True)
+    memcache_ops = messages.FloatField(13, required=True)
+
+
+class EndpointStatsForms(messages.Message):
+    """
+    Return multiple EndpointStatsForm.
+    """
+    window_minutes = messages.IntegerField(1, required=True)
+    items = messages.MessageField(EndpointStatsForm, 2, repeated=True)
+    # Across all instances: moves rejected because the game changed, and
+    # retried moves that had already been made.
+    move_conflicts = messages.IntegerField(3, required=True)
+    move_retries = messages.IntegerField(4, required=True)
+
+
 class StringMessage(messages.Message):
     """
     StringMessage-- outbound (single) string message
@@ -0,0 +1,219 @@
+"""
+openings.py - Win, draw and loss counts of every move played from a position.
+
+When a 3x3 game ends, each of its positions is counted with the move that
+was played from it and the result of the game. Positions are folded under
+the 8 symmetries of the board, so a move and its reflections share their
+counts. The counts of every move from a position are kept together in one
+entity, keyed by the position's canonical key, so looking a position up
+is a single batch get. The early positions are reached by nearly every
+game, so each position's counts are split over a few shard entities.
+
+The moves of a game are counted by a task queued when the game is saved,
+so contention on the shards never fails the move that ended the game, and
+a count that fails is retried on its own. A game is marked as counted in
+the same transaction as its counts, so a retried task counts it only once.
+"""
+
+import random
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import bitboard
+import solver
+
+# Number of shards per position.
+NUM_SHARDS = 5
+
+# Most positions updated in one cross-group transaction.
+MAX_ENTITY_GROUPS = 25
+
+QUEUE_NAME = 'openings'
+RECORD_URL = '/tasks/openings/record'
+
+# Most tasks added to a queue in one call.
+MAX_TASKS_PER_ADD = 100
+
+# Index of each count in a move's list of counts, from the point of view
+# of the player making the move.
+WINS, DRAWS, LOSSES = range(3)
+
+
+class OpeningShard(ndb.Model):
+    """
+    One shard of the counts of the moves played from a position. The id
+    is the position's canonical key and the shard number.
+    """
+    # Canonical key of the position after the move -> [wins, draws,
+    # losses] of the player who made it.
+    moves = ndb.JsonProperty(required=True)
+
+
+class OpeningRecord(ndb.Model):
+    """Marks a game whose moves have been counted. Keyed by the game key."""
+    pass
+
+
+def _shard_key(position, index):
+    return ndb.Key(OpeningShard, '{}:{}'.format(position, index))
+
+
+def _position_key(mask1, mask2, ply):
+    """Get the canonical key of a position, with the player to move first."""
+    if ply % 2 == 0:
+        return solver.canonical_key(mask1, mask2)
+    return solver.canonical_key(mask2, mask1)
+
+
+def _game_counts(game, counts):
+    """Add the moves of a finished game to a dict of counts."""
+    if game.shape is not bitboard.STANDARD:
+        return
+    winner = None
+    if game.is_winner(game.player1_symbol):
+        winner = 0
+    elif game.is_winner(game.player2_symbol):
+        winner = 1
+    masks = [0, 0]
+    for ply, square in enumerate(game.get_moves()):
+        mover = ply % 2
+        position = _position_key(masks[0], masks[1], ply)
+        masks[mover] |= bitboard.SQUARE_MASKS[square]
+        move = str(_position_key(masks[0], masks[1], ply + 1))
+        if winner is None:
+            result = DRAWS
+        elif winner == mover:
+            result = WINS
+        else:
+            result = LOSSES
+        position_counts = counts.setdefault(position, {})
+        position_counts.setdefault(move, [0, 0, 0])[result] += 1
+
+
+def _put_counts(counts):
+    keys = [_shard_key(position, random.randrange(NUM_SHARDS))
+            for position in counts]
+    shards = ndb.get_multi(keys)
+    for i, (key, position_counts) in enumerate(zip(keys, counts.values())):
+        if shards[i] is None:
+            shards[i] = OpeningShard(key=key, moves={})
+        moves = shards[i].moves
+        for move, move_counts in position_counts.iteritems():
+            old = moves.get(move, [0, 0, 0])
+            moves[move] = [a + b for a, b in zip(old, move_counts)]
+    ndb.put_multi(shards)
+
+
+@ndb.transactional(xg=True)
+def _add_counts(counts):
+    _put_counts(counts)
+
+
+@ndb.transactional(xg=True)
+def _add_game_counts(game):
+    """Count the moves of a game, unless it has been counted already."""
+    record_key = ndb.Key(OpeningRecord, game.key.urlsafe())
+    if record_key.get() is not None:
+        return
+    counts = {}
+    _game_counts(game, counts)
+    # A 3x3 game has at most 9 positions, so they fit in one transaction
+    # with the record
+    _put_counts(counts)
+    OpeningRecord(key=record_key).put()
+
+
+def queue_games(games, transactional=False):
+    """
+    Queue the moves of games that have just ended to be counted.
+
+    Args:
+        games: The finished TicTacToeGame entities. Games on boards other
+        than 3x3 are skipped.
+        transactional: True to add the tasks in the current transaction,
+        so they only run if it commits. At most 5 tasks can be added in
+        one transaction.
+    Returns:
+        None
+    """
+    tasks = [taskqueue.Task(url=RECORD_URL,
+                            params={'game': game.key.urlsafe()})
+             for game in games if game.shape is bitboard.STANDARD]
+    queue = taskqueue.Queue(QUEUE_NAME)
+    for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        queue.add(tasks[i:i + MAX_TASKS_PER_ADD],
+                  transactional=transactional)
+
+
+def record_game(urlsafe_game_key):
+    """
+    Count the moves of a game that has ended, if they have not been
+    counted already. Run by the tasks added by queue_games.
+
+    Args:
+        urlsafe_game_key: The urlsafe key of the game.
+    Returns:
+        None
+    """
+    game = ndb.Key(urlsafe=urlsafe_game_key).get()
+    if game is None or not game.game_over:
+        return
+    _add_game_counts(game)
+
+
+def record_games(games):
+    """
+    Count the moves of games that have just ended.
+
+    Args:
+        games: The finished TicTacToeGame entities. Games on boards other
+        than 3x3 are skipped.
+    Returns:
+        None
+    """
+    counts = {}
+    for game in games:
+        _game_counts(game, counts)
+    positions = counts.keys()
+    for i in range(0, len(positions), MAX_ENTITY_GROUPS):
+        _add_counts(dict((position, counts[position])
+                         for position in positions[i:i + MAX_ENTITY_GROUPS]))
+
+
+def get_moves(mask1, mask2):
+    """
+    Get the counts of every move played from a position.
+
+    Args:
+        mask1: The bitmask of player 1, who moves first.
+        mask2: The bitmask of player 2.
+    Returns:
+        A dict of square to a list of the wins, draws and losses of the
+        player who moved there. Squares that were never played from the
+        position, or any of its reflections, are left out.
+    """
+    ply = bin(mask1 | mask2).count('1')
+    position = _position_key(mask1, mask2, ply)
+    shards = ndb.get_multi([_shard_key(position, index)
+                            for index in range(NUM_SHARDS)])
+    totals = {}
+    for shard in shards:
+        if shard is None:
+            continue
+        for move, move_counts in shard.moves.iteritems():
+            old = totals.get(move, [0, 0, 0])
+            totals[move] = [a + b for a, b in zip(old, move_counts)]
+
+    moves = {}
+    mover = ply % 2
+    for square, bit in enumerate(bitboard.SQUARE_MASKS):
+        if (mask1 | mask2) & bit:
+            continue
+        masks = [mask1, mask2]
+        masks[mover] |= bit
+        move_counts = totals.get(str(_position_key(masks[0], masks[1],
+                                                   ply + 1)))
+        if move_counts:
+            moves[square] = move_counts
+    return moves
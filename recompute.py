@@ -0,0 +1,420 @@
+"""
+recompute.py - Rebuild every player's ranking from the saved scores.
+
+Rankings are normally changed in place as each game ends, so a ranking
+that drifts from the scores is never corrected. A recompute counts the
+games, wins and draws of each player from every TicTacToeScore and writes
+the totals back over the rankings.
+
+The scores are split into shards that are aggregated in parallel by
+tasks, as in analysis.py. Each shard encodes the players of its scores as
+integers and sums their results with NumPy bincount, then saves the
+totals as packed arrays in a RecomputeShard, so a shard of thousands of
+scores is one small entity. Once every shard is done, a chain of merge
+tasks adds up the shards one partition of players at a time, by user id
+modulo NUM_PARTITIONS, so no task holds the totals of every player. Each
+merge saves the ids of its players; a final sweep resets the rankings of
+players who have games recorded but no scores, and rebuilds the
+leaderboard.
+
+Games that end while a recompute runs may be missed by it. Run it when
+the game is quiet, or run it again afterwards.
+"""
+
+import logging
+from datetime import datetime
+
+import numpy as np
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import leaderboard
+from models import TicTacToePlayerRanking, TicTacToeScore
+
+QUEUE_NAME = 'recompute'
+SCAN_URL = '/tasks/recompute/scan'
+AGGREGATE_URL = '/tasks/recompute/aggregate'
+MERGE_URL = '/tasks/recompute/merge'
+SWEEP_URL = '/tasks/recompute/sweep'
+
+# Scores aggregated by each shard.
+SHARD_SIZE = 5000
+
+# Shards queued by each scan task. A transaction can queue at most 5
+# tasks, and each scan also queues the next scan.
+SHARDS_PER_SCAN = 4
+
+# Scores read in each batch of a shard.
+BATCH_SIZE = 500
+
+# Players are merged in this many partitions. Each partition saves the ids
+# of its players in one entity of 8 bytes per player, so this allows for
+# several million players within the 1MB entity size limit.
+NUM_PARTITIONS = 32
+
+# Rankings read and written in each batch of a merge or sweep.
+RANKING_BATCH_SIZE = 500
+
+# Rows of the counts arrays.
+_TOTAL_GAMES, _WINS, _DRAWS = range(3)
+
+
+class RecomputeRun(ndb.Model):
+    """Progress of one recompute of the rankings."""
+    started = ndb.DateTimeProperty(required=True, auto_now_add=True)
+    cursor = ndb.StringProperty(indexed=False)
+    shards = ndb.IntegerProperty(required=True, default=0)
+    shards_done = ndb.IntegerProperty(required=True, default=0)
+    scan_done = ndb.BooleanProperty(required=True, default=False)
+    done = ndb.BooleanProperty(required=True, default=False)
+
+
+class RecomputeShard(ndb.Model):
+    """
+    The totals of one shard of a RecomputeRun, keyed by shard number. The
+    arrays are packed as 64 bit integers.
+    """
+    scores = ndb.IntegerProperty(required=True, default=0)
+    # Sorted user ids of the players in the shard.
+    ids = ndb.BlobProperty(required=True)
+    # The total games, wins and draws of each player, one row each.
+    counts = ndb.BlobProperty(required=True)
+
+
+class RecomputePartition(ndb.Model):
+    """
+    The user ids of the players merged in one partition of a RecomputeRun,
+    packed as sorted 64 bit integers. Keyed by partition number.
+    """
+    ids = ndb.BlobProperty(required=True)
+
+
+def _pack(array):
+    return array.astype(np.int64).tostring()
+
+
+def _unpack(data):
+    return np.fromstring(data, dtype=np.int64)
+
+
+def aggregate_scores(scores):
+    """
+    Sum the results of each player in a batch of scores. Games against the
+    computer do not count towards the rankings and are skipped.
+
+    Args:
+        scores: The TicTacToeScore entities.
+    Returns:
+        A tuple of a sorted NumPy array of the user ids of the players, and
+        an array of their total games, wins and draws with one row each.
+    """
+    ids = []
+    points = []
+    for score in scores:
+        if score.player2 is None:
+            continue
+        ids.append(score.player1.id())
+        points.append(score.player1_score)
+        ids.append(score.player2.id())
+        points.append(score.player2_score)
+    ids = np.array(ids, dtype=np.int64)
+    points = np.array(points, dtype=np.int64)
+    return _sum_by_player(ids, np.vstack((np.ones_like(points),
+                                          points == 3,
+                                          points == 1)))
+
+
+def _sum_by_player(ids, counts):
+    """
+    Add up the columns of counts that belong to the same player.
+
+    Args:
+        ids: An array of user ids, which may repeat.
+        counts: An array of counts with one column per entry of ids.
+    Returns:
+        A tuple of the sorted unique ids and their summed counts.
+    """
+    if not ids.size:
+        return ids, np.zeros((3, 0), dtype=np.int64)
+    players, codes = np.unique(ids, return_inverse=True)
+    totals = np.vstack([np.bincount(codes, weights=row,
+                                    minlength=len(players))
+                        for row in counts])
+    return players, totals.round().astype(np.int64)
+
+
+def _scores():
+    return TicTacToeScore.query().order(TicTacToeScore.key)
+
+
+def start():
+    """
+    Start recomputing every player's ranking.
+
+    Args:
+        None
+    Returns:
+        The id of the RecomputeRun.
+    """
+    run_id = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    RecomputeRun(id=run_id).put()
+    taskqueue.add(url=SCAN_URL, params={'run_id': run_id},
+                  queue_name=QUEUE_NAME)
+    return run_id
+
+
+def scan(run_id):
+    """
+    Find the next shards of scores and queue a task to aggregate each of
+    them.
+
+    Args:
+        run_id: The id of the RecomputeRun.
+    Returns:
+        None
+    """
+    run = RecomputeRun.get_by_id(run_id)
+    if not run or run.scan_done:
+        return
+    cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+    shards = []
+    more = True
+    while more and len(shards) < SHARDS_PER_SCAN:
+        keys, next_cursor, more = _scores().fetch_page(
+            SHARD_SIZE, start_cursor=cursor, keys_only=True)
+        if not keys:
+            break
+        shards.append((cursor.urlsafe() if cursor else '',
+                       next_cursor.urlsafe()))
+        cursor = next_cursor
+    next_cursor = cursor.urlsafe() if more and cursor else None
+    _checkpoint(run.key, run.cursor, next_cursor, shards)
+
+
+@ndb.transactional
+def _checkpoint(run_key, cursor, next_cursor, shards):
+    """
+    Save the cursor of the next scan and queue the tasks of the shards.
+    Nothing is done if another task has already handled the scan.
+    """
+    run = run_key.get()
+    if run.scan_done or run.cursor != cursor:
+        return
+    for start_cursor, end_cursor in shards:
+        taskqueue.add(url=AGGREGATE_URL,
+                      params={'run_id': run_key.id(),
+                              'shard': run.shards,
+                              'start_cursor': start_cursor,
+                              'end_cursor': end_cursor},
+                      queue_name=QUEUE_NAME,
+                      transactional=True)
+        run.shards += 1
+    run.cursor = next_cursor
+    run.scan_done = next_cursor is None
+    if not run.scan_done:
+        taskqueue.add(url=SCAN_URL, params={'run_id': run_key.id()},
+                      queue_name=QUEUE_NAME, transactional=True)
+    elif run.shards_done == run.shards:
+        _queue_merge(run_key, 0)
+    run.put()
+
+
+def aggregate(run_id, shard, start_cursor, end_cursor):
+    """
+    Sum the results of each player in one shard of scores.
+
+    Args:
+        run_id: The id of the RecomputeRun.
+        shard: The number of the shard.
+        start_cursor: The urlsafe cursor of the first score of the shard,
+        or an empty string to start from the first score.
+        end_cursor: The urlsafe cursor after the last score of the shard.
+    Returns:
+        None
+    """
+    start_cursor = Cursor(urlsafe=start_cursor) if start_cursor else None
+    scores = _scores().iter(start_cursor=start_cursor,
+                            end_cursor=Cursor(urlsafe=end_cursor),
+                            batch_size=BATCH_SIZE)
+    ids = [np.zeros(0, dtype=np.int64)]
+    counts = [np.zeros((3, 0), dtype=np.int64)]
+    number_of_scores = 0
+    batch = []
+    for score in scores:
+        batch.append(score)
+        if len(batch) == BATCH_SIZE:
+            batch_ids, batch_counts = aggregate_scores(batch)
+            ids.append(batch_ids)
+            counts.append(batch_counts)
+            number_of_scores += len(batch)
+            batch = []
+    batch_ids, batch_counts = aggregate_scores(batch)
+    ids.append(batch_ids)
+    counts.append(batch_counts)
+    number_of_scores += len(batch)
+
+    ids, counts = _sum_by_player(np.concatenate(ids),
+                                 np.hstack(counts))
+    _save_shard(ndb.Key(RecomputeRun, run_id), shard, number_of_scores,
+                ids, counts)
+
+
+@ndb.transactional
+def _save_shard(run_key, shard, scores, ids, counts):
+    """
+    Save the totals of a shard and mark it done, queueing the merge if it
+    is the last shard. Nothing is done if the shard was already saved.
+    """
+    shard_key = ndb.Key(RecomputeShard, shard + 1, parent=run_key)
+    run, saved = ndb.get_multi([run_key, shard_key])
+    if run is None or saved is not None:
+        return
+    run.shards_done += 1
+    if run.scan_done and run.shards_done == run.shards:
+        _queue_merge(run_key, 0)
+    ndb.put_multi([run, RecomputeShard(key=shard_key, scores=scores,
+                                       ids=_pack(ids),
+                                       counts=_pack(counts))])
+
+
+def _queue_merge(run_key, partition):
+    taskqueue.add(url=MERGE_URL,
+                  params={'run_id': run_key.id(), 'partition': partition},
+                  queue_name=QUEUE_NAME, transactional=True)
+
+
+def merge(run_id, partition):
+    """
+    Add up the totals of one partition of players from every shard and
+    write them over their rankings, then queue the next partition.
+
+    Args:
+        run_id: The id of the RecomputeRun.
+        partition: The number of the partition, from 0 to
+        NUM_PARTITIONS - 1.
+    Returns:
+        None
+    """
+    run_key = ndb.Key(RecomputeRun, run_id)
+    partition_key = ndb.Key(RecomputePartition, partition + 1,
+                            parent=run_key)
+    if partition_key.get() is not None:
+        return
+    ids = [np.zeros(0, dtype=np.int64)]
+    counts = [np.zeros((3, 0), dtype=np.int64)]
+    for shard in RecomputeShard.query(ancestor=run_key):
+        shard_ids = _unpack(shard.ids)
+        in_partition = shard_ids % NUM_PARTITIONS == partition
+        ids.append(shard_ids[in_partition])
+        counts.append(_unpack(shard.counts).reshape(3, -1)[:, in_partition])
+    ids, counts = _sum_by_player(np.concatenate(ids), np.hstack(counts))
+
+    changed = 0
+    for i in range(0, len(ids), RANKING_BATCH_SIZE):
+        players = [ndb.Key('User', int(user_id))
+                   for user_id in ids[i:i + RANKING_BATCH_SIZE]]
+        rankings = TicTacToePlayerRanking.get_for_players(players)
+        batch = []
+        for j, ranking in enumerate(rankings):
+            column = counts[:, i + j]
+            if _set_counts(ranking, column[_TOTAL_GAMES], column[_WINS],
+                           column[_DRAWS]):
+                batch.append(ranking)
+        ndb.put_multi(batch)
+        changed += len(batch)
+    logging.info('Recompute %s corrected %d of %d rankings in partition %d',
+                 run_id, changed, len(ids), partition)
+    _save_partition(partition_key, ids)
+
+
+@ndb.transactional
+def _save_partition(partition_key, ids):
+    """
+    Save the players of a merged partition and queue the next partition,
+    or the sweep after the last one. Nothing is done if the partition was
+    already saved.
+    """
+    if partition_key.get() is not None:
+        return
+    RecomputePartition(key=partition_key, ids=_pack(ids)).put()
+    run_key = partition_key.parent()
+    partition = partition_key.id()
+    if partition < NUM_PARTITIONS:
+        _queue_merge(run_key, partition)
+    else:
+        taskqueue.add(url=SWEEP_URL, params={'run_id': run_key.id()},
+                      queue_name=QUEUE_NAME, transactional=True)
+
+
+def _set_counts(ranking, total_games, wins, draws):
+    """
+    Set the totals of a ranking.
+
+    Returns:
+        True if the ranking changed, False otherwise.
+    """
+    total_games, wins, draws = int(total_games), int(wins), int(draws)
+    if (ranking.total_games, ranking.wins, ranking.draws) == (
+            total_games, wins, draws):
+        return False
+    ranking.total_games = total_games
+    ranking.wins = wins
+    ranking.draws = draws
+    if total_games:
+        ranking.calculateRanking()
+    else:
+        ranking.ranking = 0.0
+    return True
+
+
+def sweep(run_id, cursor=None):
+    """
+    Reset the rankings of players who have games recorded but no scores,
+    then queue the next page. After the last page, the leaderboard is
+    rebuilt and the run is marked done.
+
+    Args:
+        run_id: The id of the RecomputeRun.
+        cursor: The urlsafe cursor of the next page of rankings, or None to
+        start from the first.
+    Returns:
+        None
+    """
+    run_key = ndb.Key(RecomputeRun, run_id)
+    query = TicTacToePlayerRanking.query(
+        TicTacToePlayerRanking.total_games > 0).order(
+            TicTacToePlayerRanking.total_games, TicTacToePlayerRanking.key)
+    rankings, next_cursor, more = query.fetch_page(
+        RANKING_BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+    partitions = {}
+    reset = []
+    for ranking in rankings:
+        user_id = ranking.player.id()
+        partition = user_id % NUM_PARTITIONS
+        if partition not in partitions:
+            partitions[partition] = _unpack(ndb.Key(
+                RecomputePartition, partition + 1, parent=run_key).get().ids)
+        ids = partitions[partition]
+        i = np.searchsorted(ids, user_id)
+        if i == len(ids) or ids[i] != user_id:
+            _set_counts(ranking, 0, 0, 0)
+            reset.append(ranking)
+    ndb.put_multi(reset)
+    if reset:
+        logging.info('Recompute %s reset %d rankings with no scores',
+                     run_id, len(reset))
+
+    if more and next_cursor:
+        taskqueue.add(url=SWEEP_URL,
+                      params={'run_id': run_id,
+                              'cursor': next_cursor.urlsafe()},
+                      queue_name=QUEUE_NAME)
+        return
+    leaderboard.rebuild()
+    run = run_key.get()
+    run.done = True
+    run.put()
+    logging.info('Recompute %s finished', run_id)
@@ -0,0 +1,159 @@
+"""
+reminders.py - Send reminder emails to users that have games in progress.
+
+A run scans the unfinished games one page at a time with a projection
+query on their players. Each page queues tasks that email a batch of
+players, and queues the task that scans the next page. The cursor of the
+next page is saved in a ReminderRun entity in the same transaction that
+queues the tasks, so a run that stops part way can be resumed without
+scanning a page twice.
+"""
+
+import logging
+from datetime import date
+
+from google.appengine.api import app_identity, mail, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import TicTacToeGame
+
+QUEUE_NAME = 'reminders'
+SCAN_URL = '/tasks/reminders/scan'
+SEND_URL = '/tasks/reminders/send'
+
+# Rows scanned per page, and users emailed per send task. A transaction
+# can queue at most 5 tasks, and each page queues one task per send
+# batch plus one for the next page. The projection on the repeated
+# players property returns one row per player of each game, so a page
+# of 200 rows has at most 200 players, which is 2 send batches.
+SCAN_BATCH_SIZE = 200
+SEND_BATCH_SIZE = 100
+
+# Seconds to remember that a user has been sent a reminder, so a user
+# with games on several pages, or a retried task, sends only one email.
+SENT_MEMCACHE_TIME = 24 * 60 * 60
+
+SUBJECT = 'Reminder: You have a tic-tac-toe game in progress!'
+BODY = 'Hello {}, Your tic-tac-toe game needs your attention!'
+
+
+class ReminderRun(ndb.Model):
+    """Progress of one reminder run."""
+    dry_run = ndb.BooleanProperty(required=True, default=False)
+    cursor = ndb.StringProperty(indexed=False)
+    pages = ndb.IntegerProperty(required=True, default=0)
+    users = ndb.IntegerProperty(required=True, default=0)
+    done = ndb.BooleanProperty(required=True, default=False)
+
+
+def start(dry_run=False):
+    """
+    Start today's reminder run, or resume it if it did not finish.
+
+    Args:
+        dry_run: If True, log the emails instead of sending them.
+    Returns:
+        None
+    """
+    run_id = date.today().isoformat()
+    if dry_run:
+        run_id += '-dry-run'
+    run = ReminderRun.get_or_insert(run_id, dry_run=dry_run)
+    if run.done:
+        logging.info('Reminder run %s has already finished', run_id)
+        return
+    taskqueue.add(url=SCAN_URL, params={'run_id': run_id},
+                  queue_name=QUEUE_NAME)
+
+
+def scan(run_id):
+    """
+    Scan the next page of unfinished games and queue reminder emails to
+    their players.
+
+    Args:
+        run_id: The id of the ReminderRun.
+    Returns:
+        None
+    """
+    run = ReminderRun.get_by_id(run_id)
+    if not run or run.done:
+        return
+    start_cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+    games, next_cursor, more = TicTacToeGame.query(
+        TicTacToeGame.game_over == False).fetch_page(
+            SCAN_BATCH_SIZE, start_cursor=start_cursor,
+            projection=[TicTacToeGame.players])
+
+    user_keys = set()
+    for game in games:
+        user_keys.update(game.players)
+    user_keys = [key.urlsafe() for key in user_keys]
+    batches = [user_keys[i:i + SEND_BATCH_SIZE]
+               for i in range(0, len(user_keys), SEND_BATCH_SIZE)]
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    _checkpoint(run.key, run.cursor, next_cursor, batches)
+
+
+@ndb.transactional
+def _checkpoint(run_key, cursor, next_cursor, batches):
+    """
+    Save the cursor of the next page and queue the tasks for this page.
+    Nothing is done if another task has already handled the page.
+    """
+    run = run_key.get()
+    if run.done or run.cursor != cursor:
+        return
+    run.cursor = next_cursor
+    run.pages += 1
+    run.users += sum(len(batch) for batch in batches)
+    run.done = next_cursor is None
+    run.put()
+
+    for batch in batches:
+        taskqueue.add(url=SEND_URL,
+                      params={'run_id': run_key.id(),
+                              'user_keys': ','.join(batch)},
+                      queue_name=QUEUE_NAME,
+                      transactional=True)
+    if run.done:
+        logging.info('Reminder run %s queued emails to %d users',
+                     run_key.id(), run.users)
+    else:
+        taskqueue.add(url=SCAN_URL, params={'run_id': run_key.id()},
+                      queue_name=QUEUE_NAME, transactional=True)
+
+
+def send(run_id, user_keys):
+    """
+    Email a batch of users. A failed email raises an error so that the
+    task is retried; users that were already emailed are skipped.
+
+    Args:
+        run_id: The id of the ReminderRun.
+        user_keys: Urlsafe keys of the users to email.
+    Returns:
+        None
+    """
+    run = ReminderRun.get_by_id(run_id)
+    if not run:
+        return
+    sender = 'noreply@{}.appspotmail.com'.format(
+        app_identity.get_application_id())
+    users = ndb.get_multi([ndb.Key(urlsafe=key) for key in user_keys])
+    for user in users:
+        if not user or not user.email:
+            continue
+        sent_key = 'reminder:{}:{}'.format(run_id, user.key.urlsafe())
+        if not memcache.add(sent_key, True, time=SENT_MEMCACHE_TIME):
+            continue
+        if run.dry_run:
+            logging.info('Dry run: reminder to %s', user.email)
+            continue
+        try:
+            mail.send_mail(sender, user.email, SUBJECT,
+                           BODY.format(user.name))
+        except Exception:
+            memcache.delete(sent_key)
+            raise
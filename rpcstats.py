@@ -0,0 +1,206 @@
+"""
+rpcstats.py - Per endpoint timing and RPC counts.
+
+An API proxy hook counts the datastore and memcache RPCs made while an
+instrumented API method runs. When the method returns, its wall time and
+RPC counts are logged as one JSON line and added to rolling per minute
+histograms kept in the instance's memory. Counting an RPC is one dict
+update, so the instrumentation is cheap enough to leave on.
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+# Length in seconds of each window of the rolling stats, and the number of
+# windows kept.
+WINDOW_SECONDS = 60
+NUM_WINDOWS = 15
+
+# Upper bounds in milliseconds of the latency histogram buckets. The last
+# bucket holds every call slower than the last bound.
+LATENCY_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                     10000)
+
+# Log a JSON line for every instrumented call.
+LOG_CALLS = True
+
+# The RPC counters of each call.
+COUNTERS = ('datastore_gets', 'datastore_puts', 'datastore_queries',
+            'datastore_other', 'memcache_ops')
+
+_DATASTORE_CALLS = {'Get': 'datastore_gets',
+                    'Put': 'datastore_puts',
+                    'RunQuery': 'datastore_queries',
+                    'Next': 'datastore_queries'}
+
+_local = threading.local()
+
+
+def _hook(service, call, request, response):
+    """Count an RPC against the instrumented call running on this thread."""
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3':
+        counts[_DATASTORE_CALLS.get(call, 'datastore_other')] += 1
+    elif service == 'memcache':
+        counts['memcache_ops'] += 1
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpcstats', _hook)
+
+
+class _EndpointWindow(object):
+    """The calls to one endpoint during one window."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.latencies = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+        self.counts = dict((counter, 0) for counter in COUNTERS)
+
+    def add(self, elapsed_ms, error, counts):
+        self.calls += 1
+        self.errors += error
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for i, bound in enumerate(LATENCY_BOUNDS_MS):
+            if elapsed_ms <= bound:
+                break
+        else:
+            i = len(LATENCY_BOUNDS_MS)
+        self.latencies[i] += 1
+        for counter, count in counts.iteritems():
+            self.counts[counter] += count
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        self.latencies = [a + b for a, b in
+                          zip(self.latencies, other.latencies)]
+        for counter, count in other.counts.iteritems():
+            self.counts[counter] += count
+
+    def percentile(self, percentile):
+        """
+        Estimate a latency percentile as the upper bound of the bucket it
+        falls in, or the slowest call if it is in the last bucket.
+        """
+        rank = percentile / 100.0 * self.calls
+        seen = 0
+        for i, count in enumerate(self.latencies):
+            seen += count
+            if count and seen >= rank:
+                if i < len(LATENCY_BOUNDS_MS):
+                    return min(float(LATENCY_BOUNDS_MS[i]), self.max_ms)
+                break
+        return self.max_ms
+
+
+_lock = threading.Lock()
+# Window start time -> endpoint name -> _EndpointWindow
+_windows = {}
+
+
+def _record(name, elapsed_ms, error, counts):
+    start = int(time.time()) // WINDOW_SECONDS * WINDOW_SECONDS
+    with _lock:
+        window = _windows.get(start)
+        if window is None:
+            window = _windows[start] = {}
+            oldest = start - NUM_WINDOWS * WINDOW_SECONDS
+            for old_start in [s for s in _windows if s <= oldest]:
+                del _windows[old_start]
+        endpoint = window.get(name)
+        if endpoint is None:
+            endpoint = window[name] = _EndpointWindow()
+        endpoint.add(elapsed_ms, error, counts)
+
+
+def instrument(method):
+    """
+    Decorator that records the wall time and RPCs of an API method.
+
+    Args:
+        method: The API method. Put this decorator beneath
+            endpoints.method, so the RPCs of ndb.toplevel are included.
+    Returns:
+        The wrapped method.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        outer_counts = getattr(_local, 'counts', None)
+        counts = _local.counts = dict((counter, 0) for counter in COUNTERS)
+        error = True
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            elapsed_ms = (time.time() - start) * 1000
+            _local.counts = outer_counts
+            if outer_counts is not None:
+                for counter, count in counts.iteritems():
+                    outer_counts[counter] += count
+            _record(name, elapsed_ms, error, counts)
+            if LOG_CALLS:
+                entry = dict(counts, endpoint=name, error=error,
+                             elapsed_ms=round(elapsed_ms, 1))
+                logging.info('rpcstats %s', json.dumps(entry,
+                                                       sort_keys=True))
+    return wrapper
+
+
+def get_stats(minutes=NUM_WINDOWS):
+    """
+    Get the stats of each endpoint on this instance.
+
+    Args:
+        minutes: The number of recent minutes to include, at most
+            NUM_WINDOWS.
+    Returns:
+        A list of dicts, one per endpoint sorted by name, of the number of
+        calls and errors, the mean and p50/p95/p99/max latency in
+        milliseconds, and the mean of each RPC counter per call.
+    """
+    since = time.time() - min(minutes, NUM_WINDOWS) * WINDOW_SECONDS
+    totals = {}
+    with _lock:
+        for start, window in _windows.iteritems():
+            if start + WINDOW_SECONDS <= since:
+                continue
+            for name, endpoint in window.iteritems():
+                totals.setdefault(name, _EndpointWindow()).merge(endpoint)
+
+    stats = []
+    for name, endpoint in sorted(totals.iteritems()):
+        entry = {'name': name,
+                 'calls': endpoint.calls,
+                 'errors': endpoint.errors,
+                 'mean_ms': endpoint.total_ms / endpoint.calls,
+                 'p50_ms': endpoint.percentile(50),
+                 'p95_ms': endpoint.percentile(95),
+                 'p99_ms': endpoint.percentile(99),
+                 'max_ms': endpoint.max_ms}
+        for counter, count in endpoint.counts.iteritems():
+            entry[counter] = float(count) / endpoint.calls
+        stats.append(entry)
+    return stats
+
+
+def reset():
+    """Clear the stats of this instance."""
+    with _lock:
+        _windows.clear()
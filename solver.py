@@ -0,0 +1,183 @@
+"""
+solver.py - Computer opponent for single player tic-tac-toe games.
+
+Perfect play comes from a minimax solution of every reachable position.
+Positions are folded under the 8 symmetries of the board before they are
+stored, so the whole game fits in a table of a few hundred entries. The
+table is built once per instance and shared by every request, so choosing
+a move is a handful of lookups instead of a tree search.
+"""
+
+import random
+
+import bitboard
+
+# Difficulty levels for the computer player.
+RANDOM = 'random'
+HEURISTIC = 'heuristic'
+PERFECT = 'perfect'
+DIFFICULTIES = (RANDOM, HEURISTIC, PERFECT)
+
+# The 8 symmetries of the board as permutations of the squares. Square n
+# of the transformed board is square SYMMETRY[n] of the original board.
+SYMMETRIES = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8),  # identity
+    (6, 3, 0, 7, 4, 1, 8, 5, 2),  # rotate 90
+    (8, 7, 6, 5, 4, 3, 2, 1, 0),  # rotate 180
+    (2, 5, 8, 1, 4, 7, 0, 3, 6),  # rotate 270
+    (2, 1, 0, 5, 4, 3, 8, 7, 6),  # mirror left to right
+    (6, 7, 8, 3, 4, 5, 0, 1, 2),  # mirror top to bottom
+    (0, 3, 6, 1, 4, 7, 2, 5, 8),  # mirror on the main diagonal
+    (8, 5, 2, 7, 4, 1, 6, 3, 0),  # mirror on the anti-diagonal
+)
+
+# Preferred squares for the heuristic player: center, corners, then edges.
+_HEURISTIC_ORDER = (4, 0, 2, 6, 8, 1, 3, 5, 7)
+
+
+def _transform_table(symmetry):
+    """Build a lookup table mapping every mask to its transformed mask."""
+    table = []
+    for mask in range(bitboard.FULL_BOARD + 1):
+        transformed = 0
+        for square, source in enumerate(symmetry):
+            if mask & bitboard.SQUARE_MASKS[source]:
+                transformed |= bitboard.SQUARE_MASKS[square]
+        table.append(transformed)
+    return tuple(table)
+
+
+_TRANSFORM_TABLES = tuple(_transform_table(s) for s in SYMMETRIES)
+
+# Transposition table of canonical position -> value for the player to
+# move. Built on first use by _get_table().
+_table = None
+
+
+def canonical_key(mover, other):
+    """
+    Get the key of a position folded under the board symmetries.
+
+    Args:
+        mover: The bitmask of the player to move.
+        other: The bitmask of the other player.
+    Returns:
+        An integer that is the same for every symmetric position.
+    """
+    return min((table[mover] << bitboard.NUMBER_OF_SQUARES) | table[other]
+               for table in _TRANSFORM_TABLES)
+
+
+def _empty_squares(occupied):
+    """Get the empty squares of a board."""
+    return [square for square, bit in enumerate(bitboard.SQUARE_MASKS)
+            if not occupied & bit]
+
+
+def _solve(mover, other, table):
+    """
+    Negamax search that fills the transposition table.
+
+    A win is scored higher the sooner it happens so the computer does not
+    put off finishing a game it has already won.
+    """
+    key = canonical_key(mover, other)
+    value = table.get(key)
+    if value is not None:
+        return value
+
+    occupied = mover | other
+    empty = _empty_squares(occupied)
+    if bitboard.is_win(other):
+        value = -(len(empty) + 1)
+    elif not empty:
+        value = 0
+    else:
+        value = max(-_solve(other, mover | bitboard.SQUARE_MASKS[square],
+                            table)
+                    for square in empty)
+    table[key] = value
+    return value
+
+
+def _get_table():
+    """Get the shared transposition table, building it if needed."""
+    global _table
+    if _table is None:
+        table = {}
+        _solve(0, 0, table)
+        _table = table
+    return _table
+
+
+def position_value(mover, other):
+    """
+    Get the value of a position for the player to move.
+
+    Args:
+        mover: The bitmask of the player to move.
+        other: The bitmask of the other player.
+    Returns:
+        A positive number if the player to move wins with perfect play,
+        a negative number if they lose, or 0 for a draw.
+    """
+    table = _get_table()
+    value = table.get(canonical_key(mover, other))
+    if value is None:
+        value = _solve(mover, other, table)
+    return value
+
+
+def best_moves(mover, other):
+    """
+    Get every move that keeps the best result for the player to move.
+
+    Args:
+        mover: The bitmask of the player to move.
+        other: The bitmask of the other player.
+    Returns:
+        A list of square numbers.
+    """
+    best = None
+    moves = []
+    for square in _empty_squares(mover | other):
+        value = -position_value(other, mover | bitboard.SQUARE_MASKS[square])
+        if best is None or value > best:
+            best = value
+            moves = [square]
+        elif value == best:
+            moves.append(square)
+    return moves
+
+
+def _heuristic_move(mover, other):
+    """Win if possible, otherwise block, otherwise take the best square."""
+    empty = _empty_squares(mover | other)
+    for mask in (mover, other):
+        for square in empty:
+            if bitboard.is_win(mask | bitboard.SQUARE_MASKS[square]):
+                return square
+    for square in _HEURISTIC_ORDER:
+        if square in empty:
+            return square
+
+
+def choose_move(mover, other, difficulty=PERFECT):
+    """
+    Choose a move for the computer player.
+
+    Args:
+        mover: The bitmask of the computer player.
+        other: The bitmask of the opponent.
+        difficulty: One of RANDOM, HEURISTIC or PERFECT.
+    Returns:
+        The square to move into, or None if the board is full.
+    """
+    empty = _empty_squares(mover | other)
+    if not empty:
+        return None
+    if difficulty == RANDOM:
+        return random.choice(empty)
+    if difficulty == HEURISTIC:
+        return _heuristic_move(mover, other)
+    return random.choice(best_moves(mover, other))
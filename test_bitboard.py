@@ -0,0 +1,92 @@
+"""
+test_bitboard.py - Unit tests for the bitboard helpers.
+
+Run with: python -m unittest discover -p 'test_*.py'
+"""
+
+import unittest
+
+import bitboard
+
+
+def _mask(shape, *squares):
+    """Get the bitmask of some (column, row) squares of a board."""
+    mask = 0
+    for column, row in squares:
+        mask |= 1 << (row * shape.width + column)
+    return mask
+
+
+class IsWinTest(unittest.TestCase):
+    def test_every_line_wins(self):
+        for mask in bitboard.WIN_MASKS:
+            self.assertTrue(bitboard.is_win(mask))
+
+    def test_two_in_a_row_does_not_win(self):
+        self.assertFalse(bitboard.is_win(0b000000011))
+
+    def test_full_board_wins(self):
+        self.assertTrue(bitboard.is_win(bitboard.FULL_BOARD))
+
+
+class BoardToMaskTest(unittest.TestCase):
+    def test_board_to_mask(self):
+        board = 'X-O-X---O'
+        self.assertEqual(bitboard.board_to_mask(board, 'X'), 0b000010001)
+        self.assertEqual(bitboard.board_to_mask(board, 'O'), 0b100000100)
+
+    def test_mask_to_board_round_trip(self):
+        shape = bitboard.STANDARD
+        board = shape.mask_to_board(0b000010001, 'X', 0b100000100, 'O')
+        self.assertEqual(board, 'X O X   O')
+        self.assertEqual(shape.board_to_mask(board, 'X'), 0b000010001)
+
+
+class ShapeTest(unittest.TestCase):
+    def setUp(self):
+        self.shape = bitboard.get_shape(15, 15, 5)
+
+    def test_five_in_a_row_wins(self):
+        lines = (
+            [(c, 7) for c in range(3, 8)],  # across
+            [(7, r) for r in range(3, 8)],  # down
+            [(i, i) for i in range(10, 15)],  # diagonal to the corner
+            [(4 + i, 4 - i) for i in range(5)],  # anti-diagonal
+        )
+        for line in lines:
+            mask = _mask(self.shape, *line)
+            # The winning move can be at the end or in the middle
+            for column, row in (line[0], line[2], line[4]):
+                self.assertTrue(
+                    self.shape.is_win_at(mask, row * 15 + column), line)
+
+    def test_four_in_a_row_does_not_win(self):
+        mask = _mask(self.shape, *[(c, 0) for c in range(4)])
+        self.assertFalse(self.shape.is_win_at(mask, 3))
+
+    def test_lines_do_not_wrap_around_the_edge(self):
+        # Squares 13, 14 of row 0 and 0, 1, 2 of row 1 are consecutive bits
+        mask = _mask(self.shape, (13, 0), (14, 0), (0, 1), (1, 1), (2, 1))
+        self.assertFalse(self.shape.is_win_at(mask, 14))
+        self.assertFalse(self.shape.is_win_at(mask, 15))
+
+    def test_broken_line_does_not_win(self):
+        mask = _mask(self.shape, (0, 0), (1, 0), (3, 0), (4, 0), (5, 0))
+        self.assertFalse(self.shape.is_win_at(mask, 1))
+
+    def test_get_shape_is_shared(self):
+        self.assertIs(bitboard.get_shape(15, 15, 5), self.shape)
+
+    def test_get_shape_rejects_impossible_wins(self):
+        self.assertRaises(ValueError, bitboard.get_shape, 3, 3, 4)
+        self.assertRaises(ValueError, bitboard.get_shape, 20, 20, 5)
+
+    def test_pack_moves_round_trip(self):
+        shape = bitboard.get_shape(19, 19, 5)
+        squares = [0, 255, 256, 360]
+        self.assertEqual(shape.unpack_moves(shape.pack_moves(squares)),
+                         squares)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+test_importer.py - Unit tests for the validation of imported games.
+
+The importer needs NumPy and the App Engine SDK on the path, so these
+tests are skipped without them.
+
+Run with: python -m unittest discover -p 'test_*.py'
+"""
+
+import unittest
+
+try:
+    import importer
+except ImportError:
+    importer = None
+
+# X takes the top row on the fifth move.
+X_WINS = '03142'
+
+# Every square is played and neither player gets three in a row.
+DRAW = '012435768'
+
+
+@unittest.skipIf(importer is None,
+                 'needs NumPy and the App Engine SDK on the path')
+class ValidateTest(unittest.TestCase):
+    def _reason(self, moves, winner=None):
+        reasons, _, _ = importer.validate([moves], [winner])
+        return importer.REASONS[reasons[0]]
+
+    def test_valid_win(self):
+        reasons, winners, masks = importer.validate([X_WINS])
+        self.assertEqual(reasons[0], importer.VALID)
+        self.assertEqual(winners[0], importer.PLAYER1)
+        self.assertEqual((masks[0, 0], masks[0, 1]), (0b000000111,
+                                                      0b000011000))
+
+    def test_valid_draw(self):
+        reasons, winners, _ = importer.validate([DRAW], [importer.DRAW])
+        self.assertEqual(reasons[0], importer.VALID)
+        self.assertEqual(winners[0], importer.DRAW)
+
+    def test_too_many_moves(self):
+        self.assertEqual(self._reason(DRAW + '0'), 'too many moves')
+
+    def test_invalid_square(self):
+        self.assertEqual(self._reason('039'), 'invalid square')
+
+    def test_square_played_more_than_once(self):
+        self.assertEqual(self._reason('00'), 'square played more than once')
+
+    def test_moves_after_the_game_was_won(self):
+        self.assertEqual(self._reason(X_WINS + '8'),
+                         'moves after the game was won')
+
+    def test_game_did_not_finish(self):
+        self.assertEqual(self._reason('40812'), 'game did not finish')
+
+    def test_winner_does_not_match_the_moves(self):
+        self.assertEqual(self._reason(X_WINS, importer.PLAYER2),
+                         'winner does not match the moves')
+
+    def test_games_are_checked_together(self):
+        moves = [X_WINS, '00', DRAW, '40812']
+        reasons, _, _ = importer.validate(moves)
+        self.assertEqual([importer.REASONS[r] for r in reasons],
+                         ['valid', 'square played more than once', 'valid',
+                          'game did not finish'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+test_solver.py - Unit tests for the computer opponent.
+
+Run with: python -m unittest discover -p 'test_*.py'
+"""
+
+import unittest
+
+import solver
+
+
+def _mask(*squares):
+    """Get the bitmask of some squares."""
+    mask = 0
+    for square in squares:
+        mask |= 1 << square
+    return mask
+
+
+class PositionValueTest(unittest.TestCase):
+    def test_empty_board_is_a_draw(self):
+        self.assertEqual(solver.position_value(0, 0), 0)
+
+    def test_lost_position_is_negative(self):
+        # O has three in a row, so X to move has lost
+        self.assertLess(solver.position_value(_mask(0, 1), _mask(3, 4, 5)),
+                        0)
+
+    def test_full_board_without_a_win_is_a_draw(self):
+        x = _mask(0, 2, 3, 7, 8)
+        o = _mask(1, 4, 5, 6)
+        self.assertEqual(solver.position_value(o, x), 0)
+
+
+class CanonicalKeyTest(unittest.TestCase):
+    def test_symmetric_positions_share_a_key(self):
+        # A corner opening looks the same from every corner
+        keys = set(solver.canonical_key(0, _mask(square))
+                   for square in (0, 2, 6, 8))
+        self.assertEqual(len(keys), 1)
+
+    def test_different_positions_have_different_keys(self):
+        self.assertNotEqual(solver.canonical_key(0, _mask(0)),
+                            solver.canonical_key(0, _mask(4)))
+
+
+class BestMovesTest(unittest.TestCase):
+    def test_takes_the_winning_square(self):
+        self.assertEqual(solver.best_moves(_mask(0, 1), _mask(3, 4)), [2])
+
+    def test_blocks_the_opponent(self):
+        self.assertEqual(solver.best_moves(_mask(0), _mask(3, 4)), [5])
+
+    def test_choose_move_on_a_full_board(self):
+        x = _mask(0, 2, 3, 7, 8)
+        o = _mask(1, 4, 5, 6)
+        for difficulty in solver.DIFFICULTIES:
+            self.assertIsNone(solver.choose_move(o, x, difficulty))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+"""
+usercache.py - Two tier cache for looking up user names and keys.
+
+User names never change once a user is created, so lookups between a
+user's key and name are cached. The first tier is a bounded LRU cache in
+the instance's memory, and the second tier is memcache, which is shared
+by every instance. Each cache counts its hits and misses so its size can
+be tuned.
+"""
+
+import threading
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# Number of entries held in memory by each cache on an instance.
+LRU_SIZE = 10000
+
+# Seconds an entry is kept in memcache. 0 means no expiry; memcache may
+# still evict entries when it needs the space.
+MEMCACHE_TIME = 0
+
+
+class LRUCache(object):
+    """A bounded, thread safe, least recently used cache."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get a value, marking it as the most recently used.
+
+        Args:
+            key: The key to look up.
+        Returns:
+            The value, or None if the key is not cached.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """
+        Add a value, evicting the least recently used entry if the cache
+        is full.
+
+        Args:
+            key: The key to store.
+            value: The value to store.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+
+
+class TwoTierCache(object):
+    """
+    A cache with an in memory LRU tier in front of a memcache tier.
+
+    Args:
+        prefix: A string put in front of every memcache key.
+        key_to_string: A function that turns a cache key into a string
+            for use in memcache.
+        max_size: The number of entries held in memory.
+    """
+
+    def __init__(self, prefix, key_to_string=str, max_size=LRU_SIZE):
+        self.prefix = prefix
+        self.key_to_string = key_to_string
+        self.lru = LRUCache(max_size)
+        self.lru_hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+
+    def _memcache_key(self, key):
+        return self.prefix + self.key_to_string(key)
+
+    @ndb.tasklet
+    def get_multi_async(self, keys):
+        """
+        Look up many keys, first in memory and then in memcache.
+
+        Args:
+            keys: The keys to look up.
+        Returns:
+            A future for a dict of the keys that were found to their values.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.lru.get(key)
+            if value is not None:
+                found[key] = value
+            else:
+                missing.append(key)
+        self.lru_hits += len(found)
+        if not missing:
+            raise ndb.Return(found)
+
+        memcache_keys = dict((self._memcache_key(key), key)
+                             for key in missing)
+        cached = yield memcache.Client().get_multi_async(
+            memcache_keys.keys())
+        for memcache_key, value in cached.iteritems():
+            key = memcache_keys[memcache_key]
+            self.lru.put(key, value)
+            found[key] = value
+        self.memcache_hits += len(cached)
+        self.misses += len(missing) - len(cached)
+        raise ndb.Return(found)
+
+    def get_multi(self, keys):
+        """
+        Look up many keys, first in memory and then in memcache.
+
+        Args:
+            keys: The keys to look up.
+        Returns:
+            A dict of the keys that were found to their values.
+        """
+        return self.get_multi_async(keys).get_result()
+
+    @ndb.tasklet
+    def get_async(self, key):
+        """
+        Look up a single key.
+
+        Args:
+            key: The key to look up.
+        Returns:
+            A future for the value, or None if the key is not cached.
+        """
+        found = yield self.get_multi_async([key])
+        raise ndb.Return(found.get(key))
+
+    def get(self, key):
+        """
+        Look up a single key.
+
+        Args:
+            key: The key to look up.
+        Returns:
+            The value, or None if the key is not cached.
+        """
+        return self.get_multi([key]).get(key)
+
+    def set_multi(self, mapping):
+        """
+        Add values to both tiers.
+
+        Args:
+            mapping: A dict of keys to values.
+        """
+        if not mapping:
+            return
+        for key, value in mapping.iteritems():
+            self.lru.put(key, value)
+        memcache.set_multi(
+            dict((self._memcache_key(key), value)
+                 for key, value in mapping.iteritems()),
+            time=MEMCACHE_TIME)
+
+    def stats(self):
+        """
+        Get the hit and miss counters of the cache.
+
+        Returns:
+            A dict of counter name to value.
+        """
+        return {'size': len(self.lru),
+                'max_size': self.lru.max_size,
+                'lru_hits': self.lru_hits,
+                'memcache_hits': self.memcache_hits,
+                'misses': self.misses,
+                'evictions': self.lru.evictions}
+
+
+def _encode_name(name):
+    """Encode a user name for use in a memcache key."""
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+
+# User key -> user name.
+user_names = TwoTierCache('user_name:', lambda key: key.urlsafe())
+
+# User name -> user key.
+user_keys = TwoTierCache('user_key:', _encode_name)